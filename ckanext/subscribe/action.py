@@ -3,19 +3,26 @@
 import logging
 import datetime
 
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+
 import ckan.plugins as p
+from ckan.model.types import make_uuid
 from ckan.lib.helpers import url_for
 from ckan.logic import validate  # put in toolkit?
 from ckan.lib.mailer import MailerException
 
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 from ckanext.subscribe.model import Subscription, Frequency
+from ckanext.subscribe import model as subscribe_model
 from ckanext.subscribe import (
     schema,
     dictization,
     email_verification,
     email_auth,
+    migration,
     notification,
+    object_index,
 )
 
 log = logging.getLogger(__name__)
@@ -48,6 +55,7 @@ def subscribe_signup(context, data_dict):
     model = context['model']
 
     _check_access('subscribe_signup', context, data_dict)
+    migration.require_current_version()
 
     data = {
         'email': data_dict['email'],
@@ -68,23 +76,15 @@ def subscribe_signup(context, data_dict):
         data['object_id'] = group_obj.id
         data['object_name'] = group_obj.name
 
-    # must be unique combination of email/object_type/object_id
-    existing = model.Session.query(Subscription) \
-        .filter_by(email=data['email']) \
-        .filter_by(object_type=data['object_type']) \
-        .filter_by(object_id=data['object_id']) \
-        .first()
-    if existing:
-        # reuse existing subscription
-        subscription = existing
-        subscription.frequency = data['frequency']
-    else:
-        # create subscription object
-        if p.toolkit.check_ckan_version(max_version='2.8.99'):
-            rev = model.repo.new_revision()
-            rev.author = context['user']
-        subscription = dictization.subscription_save(data, context)
-        model.repo.commit()
+    # must be unique combination of email/object_type/object_id, so reuse an
+    # existing subscription
+    if p.toolkit.check_ckan_version(max_version='2.8.99'):
+        rev = model.repo.new_revision()
+        rev.author = context['user']
+    subscription, created = _upsert_subscription(context, data)
+    if created and object_index.is_enabled():
+        object_index.add_subscription(subscription.id)
+    model.repo.commit()
 
     # send 'confirm your request' email
     if data_dict['skip_verification']:
@@ -103,6 +103,53 @@ def subscribe_signup(context, data_dict):
     return subscription_dict
 
 
+def _upsert_subscription(context, data):
+    '''Creates a subscription, or if the email is already subscribed to the
+    object, sets its frequency. The unique index on email/object_type/object_id
+    means that concurrent signups can't create duplicates.
+
+    :returns: (subscription, created)
+    '''
+    model = context['model']
+    if model.Session.get_bind().dialect.name == 'postgresql':
+        # atomic upsert, in one statement
+        subscription_table = subscribe_model.subscription_table
+        new_id = make_uuid()
+        insert = postgresql.insert(subscription_table).values(
+            id=new_id,
+            email=data['email'],
+            object_type=data['object_type'],
+            object_id=data['object_id'],
+            frequency=data['frequency'],
+        )
+        id_ = model.Session.execute(
+            insert.on_conflict_do_update(
+                index_elements=['email', 'object_type', 'object_id'],
+                set_={'frequency': insert.excluded.frequency})
+            .returning(subscription_table.c.id)).scalar()
+        subscription = model.Session.query(Subscription) \
+            .populate_existing().get(id_)
+        return subscription, id_ == new_id
+
+    def get_existing():
+        return model.Session.query(Subscription) \
+            .filter_by(email=data['email']) \
+            .filter_by(object_type=data['object_type']) \
+            .filter_by(object_id=data['object_id']) \
+            .first()
+    existing = get_existing()
+    if not existing:
+        try:
+            with model.Session.begin_nested():
+                subscription = dictization.subscription_save(data, context)
+            return subscription, True
+        except IntegrityError:
+            # another signup created it in the meantime
+            existing = get_existing()
+    existing.frequency = data['frequency']
+    return existing, False
+
+
 def subscribe_verify(context, data_dict):
     '''Verify (confirm) a subscription
 
@@ -269,6 +316,8 @@ def subscribe_unsubscribe(context, data_dict):
     if not subscription:
         raise p.toolkit.ObjectNotFound(
             'That user is not subscribed to that object')
+    if object_index.is_enabled():
+        object_index.remove_subscriptions([subscription.id])
     model.Session.delete(subscription)
     model.repo.commit()
 
@@ -298,6 +347,8 @@ def subscribe_unsubscribe_all(context, data_dict):
     if not subscriptions:
         raise p.toolkit.ObjectNotFound(
             'That user has no subscriptions')
+    if object_index.is_enabled():
+        object_index.remove_subscriptions([s.id for s in subscriptions])
     for subscription in subscriptions:
         model.Session.delete(subscription)
     model.repo.commit()
@@ -339,6 +390,46 @@ def subscribe_send_any_notifications(context, data_dict):
     '''Check for activity and for any subscribers, send emails with the
     notifications.
     '''
-    notification.send_any_immediate_notifications()
-    notification.send_weekly_notifications_if_its_time_to()
-    notification.send_daily_notifications_if_its_time_to()
+    notification.send_any_notifications()
+
+
+@p.toolkit.chained_action
+def member_create(original_action, context, data_dict):
+    '''Keeps the subscription object index up to date when a dataset is
+    added to a group.'''
+    member = original_action(context, data_dict)
+    _refresh_object_index_for_member(context, data_dict)
+    return member
+
+
+@p.toolkit.chained_action
+def member_delete(original_action, context, data_dict):
+    '''Keeps the subscription object index up to date when a dataset is
+    removed from a group.'''
+    original_action(context, data_dict)
+    _refresh_object_index_for_member(context, data_dict)
+
+
+@p.toolkit.chained_action
+def package_owner_org_update(original_action, context, data_dict):
+    '''Keeps the subscription object index up to date when a dataset is
+    moved to another org.'''
+    original_action(context, data_dict)
+    if object_index.is_enabled():
+        model = context['model']
+        pkg = model.Package.get(data_dict['id'])
+        object_index.refresh_package(pkg.id)
+        if not context.get('defer_commit'):
+            model.repo.commit()
+
+
+def _refresh_object_index_for_member(context, data_dict):
+    if not object_index.is_enabled() or \
+            data_dict.get('object_type') != 'package':
+        return
+    model = context['model']
+    pkg = model.Package.get(data_dict['object'])
+    if pkg:
+        object_index.refresh_package(pkg.id)
+        if not context.get('defer_commit'):
+            model.repo.commit()
@@ -1,5 +1,6 @@
 import sys
 import datetime
+import signal
 import time
 
 from ckan import model
@@ -12,15 +13,62 @@ def initdb():
     setup()
 
 
+def migrate():
+    from ckanext.subscribe.model import setup_definitions
+    from ckanext.subscribe import migration
+    setup_definitions()
+    applied = migration.upgrade()
+    return applied, migration.current_version()
+
+
+def rebuild_object_index():
+    from ckanext.subscribe import object_index
+    object_index.rebuild()
+    model.Session.commit()
+
+
+def backfill_events():
+    from ckanext.subscribe import event_store
+    num_added = event_store.backfill()
+    model.Session.commit()
+    return num_added
+
+
 def send_any_notifications(repeatedly):
+    from ckanext.subscribe import leader
+    from ckanext.subscribe import notification
+    from ckanext.subscribe import scheduler
+    log = __import__('logging').getLogger(__name__)
+
+    if repeatedly:
+        scheduler_ = scheduler.Scheduler()
+        signal.signal(signal.SIGTERM, scheduler_.stop)
+        signal.signal(signal.SIGINT, scheduler_.stop)
+        scheduler_.run()
+        return
+
+    # if this is run on several nodes, only the leader sends
+    with leader.Leadership(leader.SCHEDULER) as leadership:
+        if not leadership.is_leader():
+            log.info('Not sending - another node is the scheduler')
+            return
+        # (called directly, rather than via the subscribe_send_any_
+        # notifications action, so it can stop if it loses the lease)
+        try:
+            notification.send_any_notifications(leadership=leadership)
+        except leader.LostLeadership as e:
+            log.warning('Notification run stopped: {}'.format(e))
+
+
+def worker(repeatedly):
+    from ckanext.subscribe import outbox
     log = __import__('logging').getLogger(__name__)
 
     while True:
-        p.toolkit.get_action('subscribe_send_any_notifications')({
-            'model': model,
-            'ignore_auth': True},
-            {}
-        )
+        num_sent, num_failed = outbox.send_pending()
+        if num_sent or num_failed:
+            log.info('Outbox: {} emails sent, {} failed'
+                     .format(num_sent, num_failed))
         if not repeatedly:
             break
         log.debug('Repeating in 10s')
@@ -67,14 +115,30 @@ if not IS_CKAN_29_OR_HIGHER:
         Usage:
 
             subscribe initdb
-                Initialize the the ckanext-subscribe's database table
+                Initialize the the ckanext-subscribe's database table (applies
+                any migrations too)
+
+            subscribe migrate
+                Apply any database schema migrations that are needed (e.g.
+                after upgrading ckanext-subscribe)
 
             subscribe send-any-notifications [-r]
                 Check for activity and for any subscribers, send emails with the
                 notifications.
+                Option:
+                  -r --repeatedly - keeps running, sending notifications as
+                                    they become due (stop with SIGTERM)
+
+            subscribe worker [-r]
+                Send the emails waiting in the outbox (only relevant if
+                ckanext.subscribe.outbox is enabled).
                 Option:
                   -r --repeatedly - does it repeatedly every 10s
 
+            subscribe backfill-events
+                Fill the event store with the existing activity (only
+                relevant if ckanext.subscribe.event_store is enabled).
+
             subscribe create-test-activity {package-name|group-name|org-name}
                 Create some activity for testing purposes, for a given existing
                 object.
@@ -83,6 +147,10 @@ if not IS_CKAN_29_OR_HIGHER:
                 Delete any test activity (i.e. clean up after doing
                 'create-test-activity'). Works for test activity on all objects.
 
+            subscribe rebuild-object-index
+                Rebuild the subscription object index from scratch (only
+                relevant if ckanext.subscribe.object_index is enabled).
+
         '''
 
         summary = __doc__.split('\n')[0]
@@ -100,15 +168,27 @@ if not IS_CKAN_29_OR_HIGHER:
                 print(self.usage)
                 sys.exit(1)
             if self.options.repeatedly:
-                assert self.args[0] == 'send-any-notifications'
+                assert self.args[0] in ('send-any-notifications', 'worker')
             if self.args[0] == 'initdb':
                 self._load_config()
                 initdb()
                 print('DB tables created')
+            elif self.args[0] == 'migrate':
+                self._load_config()
+                applied, version = migrate()
+                print('Applied migrations: {} - schema is now version {}'
+                      .format(applied or 'none', version))
             elif self.args[0] == 'send-any-notifications':
                 self._load_config()
-                initdb()
                 send_any_notifications(self.options.repeatedly)
+            elif self.args[0] == 'worker':
+                self._load_config()
+                worker(self.options.repeatedly)
+            elif self.args[0] == 'backfill-events':
+                self._load_config()
+                num_added = backfill_events()
+                print('Event store backfilled - {} events added'
+                      .format(num_added))
             elif self.args[0] == 'create-test-activity':
                 self._load_config()
                 object_id = self.args[1]
@@ -116,6 +196,10 @@ if not IS_CKAN_29_OR_HIGHER:
             elif self.args[0] == 'delete-test-activity':
                 self._load_config()
                 delete_test_activity()
+            elif self.args[0] == 'rebuild-object-index':
+                self._load_config()
+                rebuild_object_index()
+                print('Subscription object index rebuilt')
             else:
                 self.parser.error('Unrecognized command')
 
@@ -133,14 +217,35 @@ if IS_CKAN_29_OR_HIGHER:
     def initd_cmd():
         initdb()
 
+    @subscribe.command('migrate', short_help="Apply any database schema migrations that are needed.")
+    def migrate_cmd():
+        applied, version = migrate()
+        click.secho('Applied migrations: {} - schema is now version {}'
+                    .format(applied or 'none', version), fg='green')
+
     @subscribe.command('send-any-notifications',
                        short_help="Check for activity and for any subscribers, send emails with the notifications.")
     @click.option('-r', '--repeatedly',
-                  help='Does it repeatedly every 10s',
+                  help='Keeps running, sending notifications as they become due',
                   is_flag=True)
     def send_any_notifications_cmd(repeatedly):
         send_any_notifications(repeatedly)
 
+    @subscribe.command('worker',
+                       short_help="Send the emails waiting in the outbox.")
+    @click.option('-r', '--repeatedly',
+                  help='Does it repeatedly every 10s',
+                  is_flag=True)
+    def worker_cmd(repeatedly):
+        worker(repeatedly)
+
+    @subscribe.command('backfill-events',
+                       short_help="Fill the event store with the existing activity.")
+    def backfill_events_cmd():
+        num_added = backfill_events()
+        click.secho('Event store backfilled - {} events added'
+                    .format(num_added), fg='green')
+
     @subscribe.command('create-test-activity',
                        short_help="Create some activity for testing purposes, for a given existing object.")
     @click.argument('object_id')
@@ -152,3 +257,9 @@ if IS_CKAN_29_OR_HIGHER:
                                   "Works for test activity on all objects.")
     def delete_test_activity_cmd():
         delete_test_activity()
+
+    @subscribe.command('rebuild-object-index',
+                       short_help="Rebuild the subscription object index from scratch.")
+    def rebuild_object_index_cmd():
+        rebuild_object_index()
+        click.secho('Subscription object index rebuilt', fg='green')
@@ -18,15 +18,25 @@ messing with your subscriptions.
 This login is separate to CKAN's normal login, which uses a password.
 '''
 
+import base64
+import calendar
 import datetime
+import hashlib
+import hmac
+import json
 import random
 import string
 
+import six
 from six import text_type
 
 import ckan.plugins as p
 from ckan import model
-from ckanext.subscribe import mailer
+from ckan.exceptions import CkanConfigurationException
+from ckan.model.types import make_uuid
+from ckanext.subscribe import outbox
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import email_templates
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 from ckanext.subscribe.model import LoginCode
 
@@ -40,12 +50,12 @@ def send_subscription_confirmation_email(code, subscription=None):
     subject, plain_text_body, html_body = \
         get_subscription_confirmation_email_contents(
             code=code, subscription=subscription)
-    mailer.mail_recipient(recipient_name=subscription.email,
-                          recipient_email=subscription.email,
-                          subject=subject,
-                          body=plain_text_body,
-                          body_html=html_body,
-                          headers={})
+    outbox.deliver(recipient_name=subscription.email,
+                   recipient_email=subscription.email,
+                   subject=subject,
+                   body=plain_text_body,
+                   body_html=html_body,
+                   headers={})
 
 
 def get_subscription_confirmation_email_contents(code, subscription):
@@ -59,39 +69,22 @@ def get_subscription_confirmation_email_contents(code, subscription):
     # Make sure subject is only one line
     subject = subject.split('\n')[0]
 
-    html_body = '''
-<p>You have subscribed to notifications about:<br/>
-{object_type}: <a href="{object_link}">{object_title} ({object_name})</a></p>
-
-<p>To manage subscriptions for {email}, click this link:<br/>
-{manage_link}</p>
-
---
-{html_footer}
-'''.format(**email_vars)
-    plain_text_body = '''
-You have subscribed to notifications about:
-{object_type}: {object_title} ({object_name})
-{object_link}
-
-To manage subscriptions for {email}, click this link:
-{manage_link}
-
---
-{plain_text_footer}
-'''.format(**email_vars)
+    html_body = email_templates.render('subscription_confirmation.html',
+                                       **email_vars)
+    plain_text_body = email_templates.render(
+        'subscription_confirmation.txt', **email_vars)
     return subject, plain_text_body, html_body
 
 
 def send_manage_email(code, subscription=None, email=None):
     subject, plain_text_body, html_body = \
         get_manage_email_contents(code, subscription=subscription, email=email)
-    mailer.mail_recipient(recipient_name=email,
-                          recipient_email=email,
-                          subject=subject,
-                          body=plain_text_body,
-                          body_html=html_body,
-                          headers={})
+    outbox.deliver(recipient_name=email,
+                   recipient_email=email,
+                   subject=subject,
+                   body=plain_text_body,
+                   body_html=html_body,
+                   headers={})
 
 
 def get_manage_email_contents(code, subscription=None, email=None):
@@ -105,63 +98,16 @@ def get_manage_email_contents(code, subscription=None, email=None):
     # Make sure subject is only one line
     subject = subject.split('\n')[0]
 
-    html_body = '''
-<p>{site_title} subscription options<br/>
-
-<p>To manage subscriptions for {email}, click this link:<br/>
-<a href="{manage_link}">{manage_link}</a></p>
-
---
-{html_footer}
-'''.format(**email_vars)
-    plain_text_body = '''
-{site_title} subscription requested:
-
-<p>To manage subscriptions for {email}, click this link:<br/>
-{manage_link}
-
---
-{plain_text_footer}
-'''.format(**email_vars)
+    html_body = email_templates.render('manage.html', **email_vars)
+    plain_text_body = email_templates.render('manage.txt', **email_vars)
     return subject, plain_text_body, html_body
 
 
 def get_footer_contents(code, subscription=None, email=None):
     email_vars = get_email_vars(code, subscription=subscription, email=email)
 
-    html_lines = []
-    if subscription:
-        html_lines.append(
-            'To stop receiving emails of this type: '
-            '<a href="{unsubscribe_link}">'
-            'unsubscribe from {object_type} "{object_title}"</a>'
-        )
-    else:
-        html_lines.append(
-            'To stop receiving all subscription emails from {site_title}: '
-            '<a href="{unsubscribe_all_link}">'
-            'unsubscribe all</a>'
-        )
-    html_lines.append('<a href="{manage_link}">Manage settings</a>')
-    html_footer = '\n'.join(
-        '<p style="font-size:10px;line-height:200%;text-align:center;'
-        'color:#9EA3A8=;padding-top:0px">{line}</p>'.format(line=line)
-        for line in html_lines).format(**email_vars)
-
-    plain_text_footer = ''
-    if subscription:
-        plain_text_footer += '''
-You can unsubscribe from notifications emails for {object_type}: "{object_title}" by going to {unsubscribe_link}.
-'''.format(**email_vars)
-    else:
-        plain_text_footer += (
-            'To stop receiving all subscription emails from {site_title}: '
-            '<a href="{unsubscribe_all_link}">'
-            'unsubscribe all</a>'
-        ).format(**email_vars)
-    plain_text_footer += '''
-Manage your settings at {manage_link}.
-'''.format(**email_vars)
+    html_footer = email_templates.render('footer.html', **email_vars)
+    plain_text_footer = email_templates.render('footer.txt', **email_vars)
     return plain_text_footer, html_footer
 
 
@@ -238,6 +184,8 @@ def get_email_vars(code, subscription=None, email=None):
 
 
 def create_code(email):
+    if signed_codes_enabled():
+        return make_signed_code(email)
     if p.toolkit.check_ckan_version(max_version='2.8.99'):
         model.repo.new_revision()
     code = text_type(make_code())
@@ -250,6 +198,31 @@ def create_code(email):
     return code
 
 
+def create_codes(emails, commit=True):
+    '''Creates a login code for each of the email addresses, with one
+    multi-row INSERT and one commit, for when emailing lots of people at once
+    (i.e. notifications).
+
+    :param emails: iterable of email addresses
+    :param commit: whether to commit the codes, or leave that to the caller
+
+    :returns: {email: code}
+    '''
+    if signed_codes_enabled():
+        return dict((email, make_signed_code(email)) for email in emails)
+    expires = datetime.datetime.now() + CODE_EXPIRY
+    codes = dict((email, text_type(make_code())) for email in emails)
+    if not codes:
+        return codes
+    model.Session.execute(
+        subscribe_model.login_code_table.insert().values([
+            dict(id=make_uuid(), email=email, code=code, expires=expires)
+            for email, code in codes.items()]))
+    if commit:
+        model.Session.commit()
+    return codes
+
+
 def make_code():
     # random.SystemRandom() is documented as suitable for cryptographic use
     return ''.join(
@@ -258,8 +231,113 @@ def make_code():
 
 
 def authenticate_with_code(code):
+    if code and SIGNED_CODE_SEPARATOR in code:
+        return validate_signed_code(code)
+
     # check the code is valid
     login_code = LoginCode.validate_code(code)
 
     # do the login
     return login_code.email
+
+
+# Signed codes
+#
+# Rather than storing a random code in the LoginCode table, the code can be a
+# token that says who it is for and when it expires, signed with a secret, so
+# it can be checked without the database. They are enabled with
+# ckanext.subscribe.signed_codes. Codes already stored in the LoginCode table
+# still work, because they don't contain the separator.
+
+SIGNED_CODE_SEPARATOR = '.'
+SIGNED_CODE_PURPOSE = 'manage'
+
+
+def signed_codes_enabled():
+    return p.toolkit.asbool(
+        config.get('ckanext.subscribe.signed_codes', False))
+
+
+def get_code_secret():
+    ''':raises CkanConfigurationException: if no secret is configured'''
+    secret = config.get('ckanext.subscribe.code_secret') or \
+        config.get('beaker.session.secret')
+    if not secret:
+        raise CkanConfigurationException(
+            'ckanext.subscribe.signed_codes needs a secret - '
+            'set ckanext.subscribe.code_secret')
+    return six.ensure_binary(secret)
+
+
+def check_config():
+    '''Checks at start-up that signed codes can be made, if they are enabled,
+    rather than failing on the first request.
+
+    :raises CkanConfigurationException: if not
+    '''
+    if signed_codes_enabled():
+        get_code_secret()
+
+
+def make_signed_code(email, expires=None):
+    '''Creates a code for the email address, that can be checked without
+    the database.
+
+    :param expires: datetime (optional, default: now + CODE_EXPIRY)
+    '''
+    expires = expires or datetime.datetime.now() + CODE_EXPIRY
+    payload = _b64encode(json.dumps({
+        'e': email,
+        'x': int(calendar.timegm(expires.timetuple())),
+        'p': SIGNED_CODE_PURPOSE,
+    }, separators=(',', ':'), sort_keys=True))
+    return text_type(payload + SIGNED_CODE_SEPARATOR + _sign(payload))
+
+
+def validate_signed_code(code):
+    '''Checks a code made by make_signed_code()
+
+    :returns: the email address
+    :raises: ValueError if the code is not valid
+    '''
+    try:
+        payload, signature = code.split(SIGNED_CODE_SEPARATOR)
+    except ValueError:
+        raise ValueError('Code not recognized')
+    try:
+        expected_signature = _sign(payload)
+    except CkanConfigurationException:
+        # this site doesn't make signed codes, so it can't have made this one
+        raise ValueError('Code not recognized')
+    # (compared as bytes, because compare_digest() refuses non-ASCII str,
+    # and the code comes from the URL)
+    if not hmac.compare_digest(six.ensure_binary(expected_signature),
+                               six.ensure_binary(signature)):
+        raise ValueError('Code not recognized')
+    try:
+        data = json.loads(_b64decode(payload))
+        email, expires, purpose = data['e'], data['x'], data['p']
+    except (ValueError, TypeError, KeyError):
+        raise ValueError('Code not recognized')
+    if purpose != SIGNED_CODE_PURPOSE:
+        raise ValueError('Code not recognized')
+    if calendar.timegm(datetime.datetime.now().timetuple()) > expires:
+        raise ValueError('Code expired')
+    return email
+
+
+def _sign(payload):
+    return _b64encode(hmac.new(get_code_secret(),
+                               six.ensure_binary(payload),
+                               hashlib.sha256).digest())
+
+
+def _b64encode(value):
+    return six.ensure_str(
+        base64.urlsafe_b64encode(six.ensure_binary(value)).rstrip(b'='))
+
+
+def _b64decode(value):
+    value = six.ensure_binary(value)
+    return six.ensure_text(
+        base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4)))
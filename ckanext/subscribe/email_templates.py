@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+'''
+The bodies of the emails are Jinja2 templates, in
+templates/subscribe/emails/. They are compiled once, by a module-level
+Environment, and the compiled templates are reused for every email.
+
+A site can override any of them by putting a file of the same name (e.g.
+subscribe/emails/notification.html) in the template directory of one of its
+own extensions, registered with toolkit.add_template_directory().
+
+The .html templates are autoescaped, because they include titles and other
+values that users set. Values that are already HTML (e.g. the footer) are
+marked with |safe in the templates. The .txt templates are not escaped.
+'''
+
+import os
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import ckan.plugins as p
+
+config = p.toolkit.config
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+_environment = None
+
+
+def get_environment():
+    '''Returns the Jinja2 Environment for the emails, creating it on first
+    use, once the site's template paths are known.
+    '''
+    global _environment
+    if _environment is None:
+        # the site's template directories first, so they can override ours
+        search_path = list(config.get('computed_template_paths') or [])
+        if TEMPLATE_DIR not in search_path:
+            search_path.append(TEMPLATE_DIR)
+        _environment = Environment(
+            loader=FileSystemLoader(search_path),
+            autoescape=select_autoescape(['html']),
+            # the templates don't change while running, so don't check them
+            auto_reload=False,
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+    return _environment
+
+
+def render(template_name, **extra_vars):
+    '''Renders one of the email templates e.g. 'notification.html'
+
+    :param template_name: file name, in subscribe/emails/
+    '''
+    return get_environment() \
+        .get_template('subscribe/emails/' + template_name) \
+        .render(**extra_vars)
@@ -8,7 +8,8 @@ from six import text_type
 import ckan.plugins as p
 from ckan import model
 from ckan.lib.helpers import url_for
-from ckanext.subscribe import mailer
+from ckanext.subscribe import outbox
+from ckanext.subscribe import email_templates
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 config = p.toolkit.config
 
@@ -18,12 +19,12 @@ CODE_EXPIRY = datetime.timedelta(hours=8)
 def send_request_email(subscription):
     subject, plain_text_body, html_body = \
         get_verification_email_contents(subscription)
-    mailer.mail_recipient(recipient_name=subscription.email,
-                          recipient_email=subscription.email,
-                          subject=subject,
-                          body=plain_text_body,
-                          body_html=html_body,
-                          headers={})
+    outbox.deliver(recipient_name=subscription.email,
+                   recipient_email=subscription.email,
+                   subject=subject,
+                   body=plain_text_body,
+                   body_html=html_body,
+                   headers={})
 
 
 def get_verification_email_contents(subscription):
@@ -33,20 +34,9 @@ def get_verification_email_contents(subscription):
     # Make sure subject is only one line
     subject = subject.split('\n')[0]
 
-    html_body = '''
-<p>{site_title} subscription requested<br/>
-    {object_type}: "{object_title}" ({object_name})</p>
-
-<p>To confirm this email subscription, click this link:<br/>
-<a href="{verification_link}">{verification_link}</a></p>
-'''.format(**email_vars)
-    plain_text_body = '''
-{site_title} subscription requested:
-{object_type}: {object_title} ({object_name})
-
-To confirm this email subscription, click this link:
-{verification_link}
-'''.format(**email_vars)
+    html_body = email_templates.render('verification.html', **email_vars)
+    plain_text_body = email_templates.render('verification.txt',
+                                             **email_vars)
     return subject, plain_text_body, html_body
 
 
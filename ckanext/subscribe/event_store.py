@@ -0,0 +1,133 @@
+# encoding: utf-8
+
+'''
+The event store is a compact copy of the recent activity, in the
+subscribe_event table, with just what the notification emails need - the
+object, type, time and the dataset/group's name and title. The notification
+queries use it instead of CKAN's activity table, which is much bigger (each
+activity holds a whole dataset dict) and isn't indexed for them.
+
+It is brought up to date with the new activity before each notification run,
+and activity older than any notification needs (the weekly period plus the
+catch-up period) is pruned from it.
+
+To fill it with the existing activity, after enabling it, run:
+
+    ckan subscribe backfill-events
+
+The store is only maintained and used if ckanext.subscribe.event_store is
+enabled.
+'''
+
+import datetime
+from itertools import islice
+
+from sqlalchemy import exists, func
+
+from ckan import model
+from ckan.model import Activity
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.notification import (
+    get_config,
+    activity_projection,
+    compact_activity_dict,
+)
+
+log = __import__('logging').getLogger(__name__)
+
+# number of events inserted at a time
+BATCH_SIZE = 1000
+
+# how far back each sync looks before the latest event, to catch activity
+# that was committed after later activity
+SYNC_OVERLAP = datetime.timedelta(minutes=5)
+
+
+def is_enabled():
+    return get_config('event_store')
+
+
+def retention_cutoff(now=None):
+    '''Returns the time before which activity is not needed for any
+    notification - the longest (weekly) period plus the catch-up period.
+    '''
+    now = now or datetime.datetime.now()
+    return now - datetime.timedelta(days=7) - \
+        get_config('email_notifications_since')
+
+
+def sync(since=None):
+    '''Copies the activity that isn't in the event store yet into it, and
+    prunes the old events. (The caller needs to commit.)
+
+    :param since: copy activity after this time (optional - defaults to just
+        before the latest event)
+
+    :returns: the number of events added
+    '''
+    event_table = subscribe_model.event_table
+    cutoff = retention_cutoff()
+    if since is None:
+        latest = model.Session.query(
+            func.max(event_table.c.timestamp)).scalar()
+        since = latest - SYNC_OVERLAP if latest else cutoff
+    since = max(since, cutoff)
+
+    rows = model.Session.query(activity_projection()) \
+        .filter(Activity.timestamp > since) \
+        .filter(~exists().where(event_table.c.id == Activity.id)) \
+        .order_by(Activity.timestamp) \
+        .yield_per(BATCH_SIZE)
+    activities = (activity for activity, in rows)
+    num_added = 0
+    while True:
+        batch = list(islice(activities, BATCH_SIZE))
+        if not batch:
+            break
+        model.Session.execute(event_table.insert(),
+                              [event_row(activity) for activity in batch])
+        num_added += len(batch)
+    prune(cutoff)
+    log.debug('Event store synced - {} events added'.format(num_added))
+    return num_added
+
+
+def event_row(activity):
+    '''Returns the event table row for an activity record from
+    activity_projection()'''
+    activity_dict = compact_activity_dict(activity)
+    row = dict(id=activity.id,
+               object_id=activity.object_id,
+               package_id=None,
+               activity_type=activity.activity_type,
+               timestamp=activity.timestamp,
+               name=None,
+               title=None)
+    data = activity_dict['data']
+    object_dict = data.get('package') or data.get('group')
+    if object_dict:
+        if 'package' in data:
+            row['package_id'] = object_dict['id']
+        row['name'] = object_dict['name']
+        row['title'] = object_dict['title']
+    return row
+
+
+def prune(cutoff=None):
+    '''Deletes the events that are too old to be notified.
+    (The caller needs to commit.)
+    '''
+    event_table = subscribe_model.event_table
+    model.Session.execute(
+        event_table.delete()
+        .where(event_table.c.timestamp <= (cutoff or retention_cutoff())))
+
+
+def backfill():
+    '''Fills the event store with all the activity that could still be
+    notified. (The caller needs to commit.)
+
+    :returns: the number of events added
+    '''
+    return sync(since=retention_cutoff())
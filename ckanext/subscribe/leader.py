@@ -0,0 +1,164 @@
+# encoding: utf-8
+
+'''
+Leader election, so that the notification scheduler (send-any-notifications)
+can be run on several nodes, for availability, while only one of them - the
+leader - works out and sends the notifications at a time.
+
+The leader holds a lease on a named row in the subscribe_lock table, which a
+heartbeat thread keeps renewing. If the leader dies, its lease expires and a
+standby node takes it over. (The nodes' clocks need to be roughly in sync,
+e.g. with NTP.)
+
+The leader only counts itself as the leader until its lease would expire,
+unless the heartbeat has renewed it by then. Work that only the leader may
+do (e.g. sending the notifications) calls Leadership.check() as it goes, and
+stops if the lease has been lost - e.g. if the database was unreachable for
+a while during a long run, and a standby may have taken over.
+'''
+
+import datetime
+import os
+import socket
+import threading
+from time import time
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+
+import ckan.plugins as p
+from ckan import model
+
+from ckanext.subscribe import model as subscribe_model
+
+log = __import__('logging').getLogger(__name__)
+
+config = p.toolkit.config
+
+# the lock held by the node running the notification scheduler
+SCHEDULER = u'scheduler'
+
+
+class LostLeadership(Exception):
+    '''This node is no longer the leader, so must stop what it is doing'''
+
+
+def get_lease_duration():
+    return datetime.timedelta(
+        seconds=int(config.get('ckanext.subscribe.scheduler.lease', 15)))
+
+
+def get_holder_id():
+    return u'{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def try_acquire(name, holder):
+    '''Takes the lease on the lock, or renews it if the holder has it
+    already. It uses its own connection, rather than the Session, so it is
+    safe to call from the heartbeat thread.
+
+    :returns: whether the holder has the lease
+    '''
+    lock_table = subscribe_model.lock_table
+    now = datetime.datetime.utcnow()
+    lease = dict(holder=holder, expires=now + get_lease_duration())
+    engine = model.meta.engine
+    with engine.begin() as connection:
+        result = connection.execute(
+            lock_table.update()
+            .where(and_(lock_table.c.name == name,
+                        or_(lock_table.c.holder == holder,
+                            lock_table.c.expires <= now)))
+            .values(**lease))
+        if result.rowcount:
+            return True
+        if connection.execute(select([lock_table.c.name])
+                              .where(lock_table.c.name == name)).first():
+            # someone else has it
+            return False
+    try:
+        with engine.begin() as connection:
+            connection.execute(lock_table.insert().values(name=name, **lease))
+    except IntegrityError:
+        # someone else took it first
+        return False
+    return True
+
+
+def release(name, holder):
+    '''Gives up the lease, if the holder has it, so a standby can take over
+    straight away.'''
+    lock_table = subscribe_model.lock_table
+    with model.meta.engine.begin() as connection:
+        connection.execute(
+            lock_table.delete()
+            .where(and_(lock_table.c.name == name,
+                        lock_table.c.holder == holder)))
+
+
+class Leadership(object):
+    '''Tries to be the leader for the lock, for as long as the context is
+    open. A heartbeat thread renews the lease while this is the leader, and
+    keeps trying to take it while it is not. e.g.
+
+        with Leadership(SCHEDULER) as leadership:
+            while True:
+                if leadership.is_leader():
+                    do_work()
+                time.sleep(10)
+    '''
+    def __init__(self, name, holder=None):
+        self.name = name
+        self.holder = holder or get_holder_id()
+        self._leader = False
+        # (time()) when the lease expires, unless it is renewed
+        self._lease_expires = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._heartbeat()
+        self._thread = threading.Thread(target=self._run,
+                                        name='subscribe-leader-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        if self._leader:
+            release(self.name, self.holder)
+            self._leader = False
+
+    def is_leader(self):
+        return self._leader and time() < self._lease_expires
+
+    def check(self):
+        '''Raises LostLeadership unless this is still the leader. Call it
+        before each part of the leader's work, so that it stops if the lease
+        has run out.'''
+        if not self.is_leader():
+            raise LostLeadership(
+                '{} is no longer the {} leader'.format(self.holder, self.name))
+
+    def _run(self):
+        interval = get_lease_duration().total_seconds() / 3
+        while not self._stop.wait(interval):
+            self._heartbeat()
+
+    def _heartbeat(self):
+        # the lease runs from (at the latest) when it was asked for
+        started = time()
+        try:
+            leader = try_acquire(self.name, self.holder)
+        except Exception:
+            log.exception('Could not renew the {} lease'.format(self.name))
+            leader = False
+        if leader:
+            self._lease_expires = \
+                started + get_lease_duration().total_seconds()
+        if leader != self._leader:
+            log.info('{} is {} the {} leader'.format(
+                self.holder, 'now' if leader else 'no longer', self.name))
+        self._leader = leader
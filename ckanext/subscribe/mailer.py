@@ -2,9 +2,12 @@
 
 # For sending HTML emails. Based on core ckan's mailer
 
-from time import time
+from contextlib import contextmanager
+from time import time, sleep
+import atexit
 import smtplib
 import socket
+import threading
 
 
 from email.mime.multipart import MIMEMultipart
@@ -22,9 +25,39 @@ _ = p.toolkit._
 asbool = p.toolkit.asbool
 
 
+class MailerDeferred(MailerException):
+    '''The email was temporarily refused (an SMTP 4xx reply, e.g. because we
+    are sending too fast), or is being held back after such a refusal, so it
+    should be sent again later, after `retry_after` seconds.
+
+    `recipient_only` says if it was just this recipient that was refused
+    (e.g. their domain is throttling us), rather than the whole email.
+    '''
+    def __init__(self, message, retry_after=None, recipient_only=False):
+        super(MailerDeferred, self).__init__(message)
+        if retry_after is None:
+            retry_after = get_deferral_delay()
+        self.retry_after = retry_after
+        self.recipient_only = recipient_only
+
+
+def get_deferral_delay():
+    return int(config.get('ckanext.subscribe.smtp.deferral_delay', 300))
+
+
 def _mail_recipient(recipient_name, recipient_email,
                     sender_name, sender_url, subject,
                     body, body_html=None, headers=None):
+    msg = _make_message(recipient_name, recipient_email,
+                        sender_name, sender_url, subject,
+                        body, body_html=body_html, headers=headers)
+    mail_from = config.get('smtp.mail_from')
+    _mail_payload(msg, mail_from, recipient_email)
+
+
+def _make_message(recipient_name, recipient_email,
+                  sender_name, sender_url, subject,
+                  body, body_html=None, headers=None):
 
     if not headers:
         headers = {}
@@ -55,38 +88,53 @@ def _mail_recipient(recipient_name, recipient_email,
     msg['X-Mailer'] = 'CKAN %s' % ckan.__version__
     if reply_to and reply_to != '':
         msg['Reply-to'] = reply_to
-    _mail_payload(msg, mail_from, recipient_email)
+    return msg
 
 
 def _mail_payload(msg, mail_from, recipient_email):
-    # Send the email using Python's smtplib.
+    # Send the email using a pooled SMTP connection, within the rate limits
+    limiter = get_send_limiter()
+    with limiter.limit(recipient_email):
+        try:
+            get_connection_pool().sendmail(mail_from, recipient_email,
+                                           msg.as_string())
+        except MailerDeferred as e:
+            limiter.hold_off(recipient_email, e)
+            raise
+    log.info('Sent email to {0}'.format(recipient_email))
+
+
+def _get_smtp_settings():
     if 'smtp.test_server' in config:
         # If 'smtp.test_server' is configured we assume we're running tests,
         # and don't use the smtp.server, starttls, user, password etc. options.
-        smtp_server = config['smtp.test_server']
-        smtp_starttls = False
-        smtp_user = None
-        smtp_password = None
-    else:
-        smtp_server = config.get('smtp.server', 'localhost')
-        smtp_starttls = asbool(
-            config.get('smtp.starttls'))
-        smtp_user = config.get('smtp.user')
-        smtp_password = config.get('smtp.password')
+        return dict(server=config['smtp.test_server'],
+                    starttls=False,
+                    user=None,
+                    password=None)
+    return dict(server=config.get('smtp.server', 'localhost'),
+                starttls=asbool(config.get('smtp.starttls')),
+                user=config.get('smtp.user'),
+                password=config.get('smtp.password'))
+
 
+def _connect(settings):
+    '''Opens an SMTP connection, and does the EHLO, STARTTLS and login
+    handshakes, as configured.
+    '''
     try:
-        smtp_connection = smtplib.SMTP(smtp_server)
+        smtp_connection = smtplib.SMTP(settings['server'])
     except (socket.error, smtplib.SMTPConnectError) as e:
         log.exception(e)
         raise MailerException('SMTP server could not be connected to: "%s" %s'
-                              % (smtp_server, e))
+                              % (settings['server'], e))
     try:
         # Identify ourselves and prompt the server for supported features.
         smtp_connection.ehlo()
 
         # If 'smtp.starttls' is on in CKAN config, try to put the SMTP
         # connection into TLS mode.
-        if smtp_starttls:
+        if settings['starttls']:
             if smtp_connection.has_extn('STARTTLS'):
                 smtp_connection.starttls()
                 # Re-identify ourselves over TLS connection.
@@ -95,20 +143,323 @@ def _mail_payload(msg, mail_from, recipient_email):
                 raise MailerException('SMTP server does not support STARTTLS')
 
         # If 'smtp.user' is in CKAN config, try to login to SMTP server.
-        if smtp_user:
-            assert smtp_password, ('If smtp.user is configured then '
-                                   'smtp.password must be configured as well.')
-            smtp_connection.login(smtp_user, smtp_password)
-
-        smtp_connection.sendmail(mail_from, [recipient_email], msg.as_string())
-        log.info('Sent email to {0}'.format(recipient_email))
-
-    except smtplib.SMTPException as e:
+        if settings['user']:
+            assert settings['password'], (
+                'If smtp.user is configured then '
+                'smtp.password must be configured as well.')
+            smtp_connection.login(settings['user'], settings['password'])
+    except (smtplib.SMTPException, socket.error) as e:
+        _quit(smtp_connection)
         msg = '%r' % e
         log.exception(msg)
         raise MailerException(msg)
-    finally:
+    except Exception:
+        _quit(smtp_connection)
+        raise
+    return smtp_connection
+
+
+def _quit(smtp_connection):
+    try:
         smtp_connection.quit()
+    except (smtplib.SMTPException, socket.error):
+        # the server has probably gone already
+        smtp_connection.close()
+
+
+def _is_disconnection(exc):
+    # smtplib raises SMTPServerDisconnected if the server dropped an idle
+    # connection, but a reset socket comes through as a plain socket.error
+    # (which SMTPException is a subclass of, in python 3)
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(exc, socket.error) and \
+        not isinstance(exc, smtplib.SMTPException)
+
+
+def _is_temporary_failure(exc):
+    # a 4xx reply means "try again later". A refused recipient's reply is in
+    # the exception's {recipient: (code, message)}
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+    else:
+        codes = [getattr(exc, 'smtp_code', None)]
+    return bool(codes) and all(
+        isinstance(code, int) and 400 <= code < 500 for code in codes)
+
+
+class _PooledConnection(object):
+    def __init__(self, smtp_connection):
+        self.smtp_connection = smtp_connection
+        self.opened = time()
+        self.messages_sent = 0
+
+    def is_worn_out(self, max_messages, max_age):
+        return (max_messages and self.messages_sent >= max_messages) or \
+            (max_age and time() - self.opened >= max_age)
+
+    def close(self):
+        _quit(self.smtp_connection)
+
+
+class SMTPConnectionPool(object):
+    '''A bounded set of authenticated SMTP connections, kept open between
+    emails, to save doing the connect/EHLO/STARTTLS/login handshakes for every
+    message.
+
+    Connections are recycled after sending `max_messages` emails or being
+    open for `max_age` seconds. If the server has closed a connection, it is
+    reopened and the email is retried once. It is safe to share between
+    threads - no more than `size` connections are open at once.
+    '''
+    def __init__(self, size=4, max_messages=100, max_age=60):
+        self.size = size
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def sendmail(self, mail_from, recipient_email, msg_string):
+        connection = self._acquire()
+        try:
+            try:
+                connection.smtp_connection.sendmail(
+                    mail_from, [recipient_email], msg_string)
+            except Exception as e:
+                if not _is_disconnection(e):
+                    raise
+                log.debug('SMTP connection was closed - reconnecting: %r', e)
+                connection.close()
+                connection = self._open()
+                connection.smtp_connection.sendmail(
+                    mail_from, [recipient_email], msg_string)
+        except smtplib.SMTPException as e:
+            self._release(connection, discard=True)
+            msg = '%r' % e
+            if _is_temporary_failure(e):
+                log.warning('Email to %s deferred: %s', recipient_email, msg)
+                raise MailerDeferred(msg, recipient_only=isinstance(
+                    e, smtplib.SMTPRecipientsRefused))
+            log.exception(msg)
+            raise MailerException(msg)
+        except socket.error as e:
+            # e.g. a timeout, or the reconnected socket failing too - it is
+            # the same as any other failure to send, so it can be retried
+            self._release(connection, discard=True)
+            msg = '%r' % e
+            log.exception(msg)
+            raise MailerException(msg)
+        except Exception:
+            self._release(connection, discard=True)
+            raise
+        connection.messages_sent += 1
+        self._release(connection)
+
+    def close(self):
+        '''Closes the idle connections (ones in use are closed when they are
+        returned).'''
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _open(self):
+        return _PooledConnection(_connect(_get_smtp_settings()))
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    connection = self._idle.pop() if self._idle else None
+                if connection is None:
+                    return self._open()
+                if not connection.is_worn_out(self.max_messages,
+                                              self.max_age):
+                    return connection
+                connection.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, connection, discard=False):
+        try:
+            if discard or connection.is_worn_out(self.max_messages,
+                                                 self.max_age):
+                connection.close()
+            else:
+                with self._lock:
+                    self._idle.append(connection)
+        finally:
+            self._slots.release()
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = SMTPConnectionPool(
+                size=int(config.get(
+                    'ckanext.subscribe.smtp.pool_size', 4)),
+                max_messages=int(config.get(
+                    'ckanext.subscribe.smtp.max_messages_per_connection',
+                    100)),
+                max_age=int(config.get(
+                    'ckanext.subscribe.smtp.max_connection_age', 60)),
+            )
+        return _connection_pool
+
+
+class TokenBucket(object):
+    '''Limits a rate of events to `rate` a second, on average, allowing
+    bursts of up to `capacity` at once. It is safe to share between threads.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self._tokens = self.capacity
+        self._updated = time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        '''Takes a token, first waiting until one is due, if there are none
+        left. Callers are served in turn, because each takes its token
+        straight away, leaving a debt that the next caller waits longer for.
+        '''
+        with self._lock:
+            now = time()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+
+def get_domain(email):
+    return email.rpartition('@')[2].lower()
+
+
+class SendLimiter(object):
+    '''Keeps the sending within the limits of the relay and the receiving
+    domains: overall, to `max_rate` emails a second (with bursts of up to
+    `burst`), and for each recipient domain, to `domain_max_rate` emails a
+    second and `domain_concurrency` at once. A limit of 0 means no limit.
+
+    After an email is deferred (an SMTP 4xx reply), emails to that domain
+    (or all emails, if the whole email was refused) are held off until it is
+    time to retry, by deferring them straight away, rather than sending more
+    into the throttling.
+
+    The limits are kept in memory, so they only apply within a process -
+    each sending process has its own (see get_send_limiter()).
+    '''
+    def __init__(self, max_rate=0, burst=None, domain_max_rate=0,
+                 domain_concurrency=0):
+        self._bucket = TokenBucket(max_rate, burst) if max_rate else None
+        self.domain_max_rate = domain_max_rate
+        self.domain_concurrency = domain_concurrency
+        # {domain: TokenBucket}
+        self._domain_buckets = {}
+        # {domain: BoundedSemaphore}
+        self._domain_slots = {}
+        # {domain (or None for all): time}
+        self._held_off_until = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, recipient_email):
+        '''Waits until an email can be sent to this recipient, then holds a
+        slot for their domain while it is sent.
+
+        :raises MailerDeferred: if sending is being held off
+        '''
+        domain = get_domain(recipient_email)
+        self._check_held_off(domain)
+        with self._lock:
+            slots = self._domain_slots.get(domain)
+            if slots is None and self.domain_concurrency:
+                slots = self._domain_slots[domain] = \
+                    threading.BoundedSemaphore(self.domain_concurrency)
+            bucket = self._domain_buckets.get(domain)
+            if bucket is None and self.domain_max_rate:
+                bucket = self._domain_buckets[domain] = \
+                    TokenBucket(self.domain_max_rate)
+        if slots:
+            slots.acquire()
+        try:
+            if bucket:
+                bucket.take()
+            if self._bucket:
+                self._bucket.take()
+            yield
+        finally:
+            if slots:
+                slots.release()
+
+    def hold_off(self, recipient_email, deferred):
+        '''Holds off sending after an email has been deferred.
+
+        :param deferred: the MailerDeferred
+        '''
+        domain = get_domain(recipient_email) \
+            if deferred.recipient_only else None
+        until = time() + deferred.retry_after
+        with self._lock:
+            self._held_off_until[domain] = max(
+                until, self._held_off_until.get(domain, 0))
+
+    def _check_held_off(self, domain):
+        now = time()
+        with self._lock:
+            for key in (None, domain):
+                if self._held_off_until.get(key, now) <= now:
+                    self._held_off_until.pop(key, None)
+            all_until = self._held_off_until.get(None, 0)
+            domain_until = self._held_off_until.get(domain, 0)
+        if max(all_until, domain_until) > now:
+            raise MailerDeferred(
+                'Sending to {} is held off after an email was deferred'
+                .format(domain),
+                retry_after=max(all_until, domain_until) - now,
+                recipient_only=all_until <= now)
+
+
+_send_limiter = None
+
+
+def get_send_limiter():
+    global _send_limiter
+    with _connection_pool_lock:
+        if _send_limiter is None:
+            max_rate = float(config.get(
+                'ckanext.subscribe.smtp.max_rate', 0))
+            _send_limiter = SendLimiter(
+                max_rate=max_rate,
+                burst=int(config.get(
+                    'ckanext.subscribe.smtp.burst', max(1, int(max_rate)))),
+                domain_max_rate=float(config.get(
+                    'ckanext.subscribe.smtp.domain_max_rate', 0)),
+                domain_concurrency=int(config.get(
+                    'ckanext.subscribe.smtp.domain_concurrency', 0)),
+            )
+        return _send_limiter
+
+
+@atexit.register
+def close_connections():
+    global _connection_pool
+    with _connection_pool_lock:
+        pool, _connection_pool = _connection_pool, None
+    if pool:
+        pool.close()
 
 
 def mail_recipient(recipient_name, recipient_email, subject,
@@ -118,3 +469,24 @@ def mail_recipient(recipient_name, recipient_email, subject,
     return _mail_recipient(recipient_name, recipient_email,
                            site_title, site_url, subject, body,
                            body_html=body_html, headers=headers)
+
+
+def make_message(recipient_name, recipient_email, subject,
+                 body, body_html=None, headers=None):
+    '''Builds the email as a MIME message, to be sent later with
+    send_message(). Unlike send_message(), this needs the CKAN config and
+    translations, so call it on the main thread.
+    '''
+    site_title = config.get('ckan.site_title')
+    site_url = config.get('ckan.site_url')
+    return _make_message(recipient_name, recipient_email,
+                         site_title, site_url, subject, body,
+                         body_html=body_html, headers=headers)
+
+
+def send_message(msg, recipient_email):
+    '''Sends a message made by make_message(). Safe to call from a worker
+    thread.
+    '''
+    mail_from = config.get('smtp.mail_from')
+    _mail_payload(msg, mail_from, recipient_email)
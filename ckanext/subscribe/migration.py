@@ -0,0 +1,268 @@
+# encoding: utf-8
+
+'''
+Schema migrations for the ckanext-subscribe tables.
+
+Each migration is a function in MIGRATIONS, numbered by its position. The
+numbers of the ones applied are stored in the subscribe_migration table, so
+an install can be brought up to date with:
+
+    ckan subscribe migrate
+
+Installs that predate the migrations have no subscribe_migration table, so
+are at version 0. The migrations check what exists before changing it, so
+they are safe to run over a schema that was created some other way.
+
+To change the schema, alter the table definition in model.define_tables()
+(which is what new installs get) and append a migration that makes the same
+change to an existing install.
+'''
+
+import datetime
+
+from sqlalchemy import and_, func, inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from ckan import model
+
+from ckanext.subscribe import model as subscribe_model
+
+log = __import__('logging').getLogger(__name__)
+
+
+def _create_tables(connection):
+    '''Create the original tables'''
+    for table in (subscribe_model.subscription_table,
+                  subscribe_model.login_code_table,
+                  subscribe_model.subscribe_table):
+        table.create(bind=connection, checkfirst=True)
+
+
+def _create_subscription_object_index_table(connection):
+    '''Create the subscription object index table'''
+    subscribe_model.subscription_object_index_table.create(
+        bind=connection, checkfirst=True)
+
+
+def _add_lookup_indexes(connection):
+    '''Add indexes for looking up subscriptions and login codes'''
+    _create_missing_indexes(connection, subscribe_model.subscription_table, [
+        'idx_subscription_email',
+        'idx_subscription_frequency_verified_object_id',
+        'idx_subscription_verification_code'])
+    _create_missing_indexes(connection, subscribe_model.login_code_table, [
+        'idx_subscribe_login_code_code'])
+
+
+def _merge_duplicate_subscriptions(connection):
+    '''Merge duplicate subscriptions and make them unique'''
+    subscription_table = subscribe_model.subscription_table
+    index_table = subscribe_model.subscription_object_index_table
+    key_columns = [subscription_table.c.email,
+                   subscription_table.c.object_type,
+                   subscription_table.c.object_id]
+    duplicates = connection.execute(
+        select(key_columns)
+        .group_by(*key_columns)
+        .having(func.count() > 1)).fetchall()
+    for key in duplicates:
+        subscriptions = connection.execute(
+            select([subscription_table])
+            .where(and_(*[column == value
+                          for column, value in zip(key_columns, key)]))
+            .order_by(subscription_table.c.created)).fetchall()
+        # keep the first, so activity since then is still notified, but with
+        # the frequency most recently asked for
+        keep = subscriptions[0]
+        connection.execute(
+            subscription_table.update()
+            .where(subscription_table.c.id == keep.id)
+            .values(verified=any(s.verified for s in subscriptions),
+                    frequency=subscriptions[-1].frequency))
+        duplicate_ids = [s.id for s in subscriptions[1:]]
+        connection.execute(
+            index_table.delete()
+            .where(index_table.c.subscription_id.in_(duplicate_ids)))
+        connection.execute(
+            subscription_table.delete()
+            .where(subscription_table.c.id.in_(duplicate_ids)))
+        log.info('Merged {} duplicate subscriptions for {}'.format(
+            len(duplicate_ids), keep.email))
+    _create_missing_indexes(connection, subscription_table,
+                            ['idx_subscription_email_object'])
+
+
+def _create_outbox_table(connection):
+    '''Create the outbox table'''
+    subscribe_model.outbox_table.create(bind=connection, checkfirst=True)
+
+
+def _add_outbox_retries(connection):
+    '''Add outbox retry columns'''
+    outbox_table = subscribe_model.outbox_table
+    _add_missing_columns(connection, outbox_table, ['next_attempt_at'])
+    # failures used to be final
+    connection.execute(
+        outbox_table.update()
+        .where(outbox_table.c.status == u'failed')
+        .values(status=u'dead'))
+
+
+def _add_outbox_claims(connection):
+    '''Add outbox worker claim columns'''
+    _add_missing_columns(connection, subscribe_model.outbox_table,
+                         ['claimed_by', 'lease_expires'])
+
+
+def _create_lock_table(connection):
+    '''Create the lock table'''
+    subscribe_model.lock_table.create(bind=connection, checkfirst=True)
+
+
+def _create_pending_notification_table(connection):
+    '''Create the pending notification table'''
+    subscribe_model.pending_notification_table.create(
+        bind=connection, checkfirst=True)
+
+
+def _create_event_table(connection):
+    '''Create the event table'''
+    subscribe_model.event_table.create(bind=connection, checkfirst=True)
+
+
+MIGRATIONS = [
+    _create_tables,  # 1
+    _create_subscription_object_index_table,  # 2
+    _add_lookup_indexes,  # 3
+    _merge_duplicate_subscriptions,  # 4
+    _create_outbox_table,  # 5
+    _add_outbox_retries,  # 6
+    _add_outbox_claims,  # 7
+    _create_lock_table,  # 8
+    _create_pending_notification_table,  # 9
+    _create_event_table,  # 10
+]
+
+
+def _create_missing_indexes(connection, table, index_names):
+    '''Creates the given indexes, as defined on the table, if they don't
+    exist yet'''
+    existing_index_names = set(
+        index['name']
+        for index in inspect(connection).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name in index_names and \
+                index.name not in existing_index_names:
+            index.create(bind=connection)
+            log.info('Created index {}'.format(index.name))
+
+
+def _add_missing_columns(connection, table, column_names):
+    '''Adds the given columns, as defined on the table, if they don't exist
+    yet. (They need to be nullable, or have a server default.)'''
+    existing_column_names = set(
+        column['name']
+        for column in inspect(connection).get_columns(table.name))
+    for column_name in column_names:
+        if column_name in existing_column_names:
+            continue
+        column = table.c[column_name]
+        connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, column.name,
+            column.type.compile(dialect=connection.dialect)))
+        log.info('Added column {}.{}'.format(table.name, column.name))
+
+
+def latest_version():
+    return len(MIGRATIONS)
+
+
+def current_version(connection=None):
+    '''Returns the version of the schema in the database - the number of the
+    last migration applied (or 0 if none have been)
+    '''
+    connection = connection or model.meta.engine
+    migration_table = subscribe_model.migration_table
+    if not migration_table.exists(bind=connection):
+        return 0
+    return connection.execute(
+        select([func.max(migration_table.c.version)])).scalar() or 0
+
+
+class SchemaOutOfDate(Exception):
+    '''The ckanext-subscribe tables need migrating'''
+
+
+def _out_of_date_message(version):
+    return 'The ckanext-subscribe database tables are at version {}, but ' \
+        'version {} is needed. Run: ckan subscribe migrate' \
+        .format(version, latest_version())
+
+
+def _get_version(engine):
+    migration_table = subscribe_model.migration_table
+    try:
+        return engine.execute(
+            select([func.max(migration_table.c.version)])).scalar() or 0
+    except SQLAlchemyError:
+        # no migration table - either not initialized or from before
+        # migrations
+        return 0
+
+
+def check_version():
+    '''Logs a warning if the schema needs migrating. This is a single query,
+    so is cheap enough to do at start-up.
+
+    :returns: whether the schema is up to date (or None if the database isn't
+        available yet)
+    '''
+    engine = getattr(model.meta, 'engine', None)
+    if engine is None:
+        return None
+    version = _get_version(engine)
+    if version < latest_version():
+        log.warning(_out_of_date_message(version))
+        return False
+    return True
+
+
+# set once the schema is found to be up to date, as it stays that way
+_up_to_date = False
+
+
+def require_current_version():
+    '''Raises SchemaOutOfDate if the schema needs migrating. Called before
+    the things that need the current schema (signup and sending
+    notifications), so that on a site that was upgraded without running the
+    migrate command they fail with a clear error, rather than a database one.
+    '''
+    global _up_to_date
+    if _up_to_date:
+        return
+    version = _get_version(model.meta.engine)
+    if version < latest_version():
+        raise SchemaOutOfDate(_out_of_date_message(version))
+    _up_to_date = True
+
+
+def upgrade():
+    '''Applies any migrations that haven't been applied yet, each in its own
+    transaction.
+
+    :returns: the list of version numbers applied
+    '''
+    engine = model.meta.engine
+    subscribe_model.migration_table.create(bind=engine, checkfirst=True)
+    applied = []
+    for version, migration in enumerate(MIGRATIONS, 1):
+        with engine.begin() as connection:
+            if current_version(connection) >= version:
+                continue
+            log.info('Applying subscribe migration {}: {}'.format(
+                version, migration.__doc__))
+            migration(connection)
+            connection.execute(subscribe_model.migration_table.insert().values(
+                version=version, applied=datetime.datetime.utcnow()))
+        applied.append(version)
+    return applied
@@ -2,11 +2,11 @@ import logging
 import datetime
 from enum import Enum
 
-from sqlalchemy import Table, Column, types
+from sqlalchemy import Table, Column, ForeignKey, Index, types
 
 from ckan import model
 from ckan.model.meta import metadata, mapper, Session
-from ckan.model.types import make_uuid
+from ckan.model.types import make_uuid, JsonDictType
 from ckan.model.domain_object import DomainObject
 
 log = logging.getLogger(__name__)
@@ -18,27 +18,34 @@ __all__ = [
 subscription_table = None
 login_code_table = None
 subscribe_table = None
+subscription_object_index_table = None
+migration_table = None
+outbox_table = None
+lock_table = None
+pending_notification_table = None
+event_table = None
 
 
 def setup():
-
-    if subscription_table is None:
-        define_tables()
-        log.debug('Subscription tables defined in memory')
+    '''Defines the tables and creates them in the database, or brings them
+    up to date. (At start-up only the definitions are needed - see
+    setup_definitions())
+    '''
+    setup_definitions()
 
     if not model.package_table.exists():
         log.debug('Subscription table creation deferred')
         return
 
-    if not subscription_table.exists():
+    # create the tables, or bring them up to date
+    from ckanext.subscribe import migration
+    migration.upgrade()
 
-        # Create each table individually rather than
-        # using metadata.create_all()
-        subscription_table.create()
-        login_code_table.create()
-        subscribe_table.create()
 
-        log.debug('Subscription tables created')
+def setup_definitions():
+    if subscription_table is None:
+        define_tables()
+        log.debug('Subscription tables defined in memory')
 
 
 class _DomainObject(DomainObject):
@@ -153,9 +160,33 @@ class Subscribe(_DomainObject):
             return None
 
 
+class Event(_DomainObject):
+    '''A compact copy of an activity, with just what the notification
+    emails need, if ckanext.subscribe.event_store is enabled - see
+    event_store.py
+    '''
+    def __repr__(self):
+        return '<Event id={} object_id={} activity_type={} timestamp={}>' \
+            .format(self.id, self.object_id, self.activity_type,
+                    self.timestamp)
+
+
+class OutboxMessage(_DomainObject):
+    '''An email in the outbox, to be sent by the worker (see outbox.py). The
+    row is kept after sending, with its status, so failures can be seen,
+    until it is pruned (see outbox.prune()).
+    '''
+    def __repr__(self):
+        return '<OutboxMessage id={} recipient_email={} status={} ' \
+            'attempts={}>'.format(
+                self.id, self.recipient_email, self.status, self.attempts)
+
+
 def define_tables():
 
-    global subscription_table, login_code_table, subscribe_table
+    global subscription_table, login_code_table, subscribe_table, \
+        subscription_object_index_table, migration_table, outbox_table, \
+        lock_table, pending_notification_table, event_table
 
     subscription_table = Table(
         'subscription',
@@ -171,6 +202,16 @@ def define_tables():
         Column('created', types.DateTime, default=datetime.datetime.utcnow),
         # frequency is: immediate, daily, weekly
         Column('frequency', types.Integer),
+        # for the manage/unsubscribe pages
+        Index('idx_subscription_email', 'email'),
+        # an email can only subscribe to an object once
+        Index('idx_subscription_email_object',
+              'email', 'object_type', 'object_id', unique=True),
+        # for finding the subscriptions to notify
+        Index('idx_subscription_frequency_verified_object_id',
+              'frequency', 'verified', 'object_id'),
+        # for verifying
+        Index('idx_subscription_verification_code', 'verification_code'),
     )
 
     login_code_table = Table(
@@ -180,6 +221,7 @@ def define_tables():
         Column('email', types.UnicodeText, nullable=False),
         Column('code', types.UnicodeText, nullable=False),
         Column('expires', types.DateTime),
+        Index('idx_subscribe_login_code_code', 'code'),
     )
 
     subscribe_table = Table(
@@ -191,6 +233,98 @@ def define_tables():
         Column('emails_last_sent', types.DateTime, nullable=False),
     )
 
+    # the objects that each subscription covers, i.e. the subscription's
+    # object, plus the datasets in a subscribed org/group. Only used if
+    # ckanext.subscribe.object_index is enabled - see object_index.py
+    subscription_object_index_table = Table(
+        'subscription_object_index',
+        metadata,
+        Column('subscription_id', types.UnicodeText,
+               ForeignKey('subscription.id', ondelete='CASCADE'),
+               primary_key=True),
+        Column('object_id', types.UnicodeText, primary_key=True),
+        Index('idx_subscription_object_index_object_id', 'object_id'),
+    )
+
+    # emails waiting to be sent, or that have been sent or given up on, if
+    # ckanext.subscribe.outbox is enabled - see outbox.py
+    outbox_table = Table(
+        'subscribe_outbox',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('recipient_name', types.UnicodeText),
+        Column('recipient_email', types.UnicodeText, nullable=False),
+        Column('subject', types.UnicodeText, nullable=False),
+        Column('body', types.UnicodeText, nullable=False),
+        Column('body_html', types.UnicodeText),
+        Column('headers', JsonDictType),
+        # status is: pending, sent, dead (i.e. failed too many times)
+        Column('status', types.UnicodeText, nullable=False,
+               default=u'pending'),
+        Column('attempts', types.Integer, nullable=False, default=0),
+        Column('last_error', types.UnicodeText),
+        # when a failed message is due to be retried
+        Column('next_attempt_at', types.DateTime),
+        # the worker sending it, which has it until the lease expires
+        Column('claimed_by', types.UnicodeText),
+        Column('lease_expires', types.DateTime),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+        Column('sent', types.DateTime),
+        # for finding the pending messages
+        Index('idx_subscribe_outbox_status_created', 'status', 'created'),
+    )
+
+    # leases, e.g. held by the node that is running the notification
+    # scheduler - see leader.py
+    lock_table = Table(
+        'subscribe_lock',
+        metadata,
+        Column('name', types.UnicodeText, primary_key=True),
+        Column('holder', types.UnicodeText, nullable=False),
+        Column('expires', types.DateTime, nullable=False),
+    )
+
+    # objects that have changed and have immediate subscribers, recorded by
+    # the plugin's hooks, if ckanext.subscribe.push_notifications is enabled
+    # - see pending.py
+    pending_notification_table = Table(
+        'subscribe_pending_notification',
+        metadata,
+        Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+        Column('object_id', types.UnicodeText, nullable=False),
+        Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    )
+
+    # compact copies of the recent activity - see event_store.py
+    event_table = Table(
+        'subscribe_event',
+        metadata,
+        # the activity id
+        Column('id', types.UnicodeText, primary_key=True),
+        Column('object_id', types.UnicodeText, nullable=False),
+        # set if it is a dataset's activity (otherwise it is a group/org's)
+        Column('package_id', types.UnicodeText),
+        Column('activity_type', types.UnicodeText),
+        Column('timestamp', types.DateTime, nullable=False),
+        # of the dataset/group/org
+        Column('name', types.UnicodeText),
+        Column('title', types.UnicodeText),
+        # for the notification queries
+        Index('idx_subscribe_event_object_id_timestamp',
+              'object_id', 'timestamp'),
+        # for syncing and pruning
+        Index('idx_subscribe_event_timestamp', 'timestamp'),
+    )
+
+    # the schema migrations that have been applied - see migration.py
+    migration_table = Table(
+        'subscribe_migration',
+        metadata,
+        Column('version', types.Integer, primary_key=True,
+               autoincrement=False),
+        Column('applied', types.DateTime, default=datetime.datetime.utcnow),
+    )
+
     mapper(
         Subscription,
         subscription_table,
@@ -203,3 +337,11 @@ def define_tables():
         Subscribe,
         subscribe_table,
     )
+    mapper(
+        OutboxMessage,
+        outbox_table,
+    )
+    mapper(
+        Event,
+        event_table,
+    )
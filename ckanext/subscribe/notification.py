@@ -1,24 +1,51 @@
 import datetime
-from collections import defaultdict
+import json
+from collections import OrderedDict, defaultdict, deque
+from itertools import groupby, islice
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import (
+    and_, or_, exists, union_all, cast, type_coerce, UnicodeText)
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Bundle
 
 from ckan import model
 from ckan.model import Activity, Package, Group, Member
 from ckan.lib.dictization import model_dictize
 from ckan.plugins import toolkit
 from ckan.lib.email_notifications import string_to_timedelta
+from ckan.lib.mailer import MailerException
 
 from ckanext.subscribe import dictization
+from ckanext.subscribe import model as subscribe_model
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 from ckanext.subscribe.model import (
     Subscription,
     Subscribe,
     Frequency,
+    Event,
 )
 from ckanext.subscribe import notification_email
 from ckanext.subscribe import email_auth
+from ckanext.subscribe import mailer
+from ckanext.subscribe import migration
+from ckanext.subscribe import outbox
 
 log = __import__('logging').getLogger(__name__)
 
+# number of (subscription, activity) rows fetched at a time, when streaming
+STREAM_BATCH_SIZE = 1000
+
+# number of recipients that login codes are created for at a time
+CODE_BATCH_SIZE = 500
+
+# number of recipients in each background send job
+SEND_JOB_BATCH_SIZE = 100
+
+# maximum number of dictized activities kept in an activity_cache (the least
+# recently used are dropped) - with include_data, each has its whole dataset
+ACTIVITY_CACHE_SIZE = 500
+
 _config = {}
 
 
@@ -39,64 +66,203 @@ def get_config(key):
                 toolkit.config.get('daily_and_weekly_notification_time',
                                    '9:00'),
                 '%H:%M')
+        _config['send_workers'] = int(
+            toolkit.config.get('ckanext.subscribe.send_workers', 1))
+        _config['object_index'] = toolkit.asbool(
+            toolkit.config.get('ckanext.subscribe.object_index', False))
+        _config['activity_projection'] = toolkit.asbool(
+            toolkit.config.get('ckanext.subscribe.activity_projection',
+                               False))
+        _config['event_store'] = toolkit.asbool(
+            toolkit.config.get('ckanext.subscribe.event_store', False))
+        _config['send_jobs'] = toolkit.asbool(
+            toolkit.config.get('ckanext.subscribe.send_jobs', False))
+        _config['send_jobs_queue'] = toolkit.config.get(
+            'ckanext.subscribe.send_jobs.queue', u'subscribe')
+        _config['push_notifications'] = toolkit.asbool(
+            toolkit.config.get('ckanext.subscribe.push_notifications',
+                               False))
 
     return _config[key]
 
 
-def send_any_immediate_notifications():
-    log.debug('send_any_immediate_notifications')
-    notification_datetime = datetime.datetime.now()
-    notifications_by_email = get_immediate_notifications(notification_datetime)
-    if not notifications_by_email:
-        log.debug('no emails to send (immediate frequency)')
-    else:
-        log.debug('sending {} emails (immediate frequency)'
-                  .format(len(notifications_by_email)))
-        send_emails(notifications_by_email)
+def send_any_notifications(leadership=None):
+    '''Sends the immediate notifications, plus the daily and weekly ones if
+    it's time to. The activity for all the due frequencies is worked out
+    together, in one pass.
 
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(frequency=Frequency.IMMEDIATE.value,
-                                   emails_last_sent=notification_datetime)
-    model.Session.commit()
+    :param leadership: see send_notifications() (optional)
+    '''
+    frequencies = [Frequency.IMMEDIATE]
+    if is_it_time_to_send_weekly_notifications():
+        frequencies.append(Frequency.WEEKLY)
+    if is_it_time_to_send_daily_notifications():
+        frequencies.append(Frequency.DAILY)
+    send_notifications(frequencies, leadership=leadership)
+
+
+def send_any_immediate_notifications():
+    send_notifications([Frequency.IMMEDIATE])
 
 
 def send_weekly_notifications_if_its_time_to():
     if not is_it_time_to_send_weekly_notifications():
         return
+    send_notifications([Frequency.WEEKLY])
+
+
+def send_daily_notifications_if_its_time_to():
+    if not is_it_time_to_send_daily_notifications():
+        return
+    send_notifications([Frequency.DAILY])
+
+
+def send_notifications(frequencies, leadership=None):
+    '''Sends the notifications for the given frequencies, and records that
+    each is 'all done' up to now.
+
+    The (subscription, activity) rows are streamed from the database in
+    order of frequency and email, and each recipient's email is built and
+    sent before the next recipient's rows are read, so memory use doesn't
+    grow with the number of recipients.
+
+    If the outbox is enabled, the emails are queued in it instead of sent,
+    and each frequency's emails are committed in the same transaction as the
+    record that it is done - so if the run fails part way, it is just repeated
+    for the frequencies not done, without any emails being duplicated. The
+    worker then sends them - see outbox.py.
+
+    Emails that fail to send don't stop the run - they are retried later,
+    along with any earlier failures that are due a retry, at the end of each
+    run - see send_emails().
 
-    log.debug('send_weekly_notifications')
+    If send jobs are enabled, the emails are instead built and sent by CKAN's
+    background job workers - this just enqueues jobs of the subscription and
+    activity ids, a batch of recipients per job - see send_notifications_job().
+
+    :param frequencies: list of Frequency
+    :param leadership: the scheduler's leader.Leadership, if it is running
+        on several nodes. The run is stopped, raising LostLeadership, if the
+        lease is lost part way through - before the next email, or recording
+        a frequency as done - so that it doesn't overlap with the new leader's
+        run. (optional)
+
+    :raises migration.SchemaOutOfDate: if the tables need migrating
+    '''
+    migration.require_current_version()
     notification_datetime = datetime.datetime.now()
-    notifications_by_email = get_weekly_notifications(notification_datetime)
-    if not notifications_by_email:
-        log.debug('no emails to send (weekly frequency)')
+    fence = leadership.check if leadership else None
+    sync_event_store()
+    if get_config('send_jobs'):
+        def send(rows):
+            return enqueue_send_jobs(iter_notification_ids_by_email(rows),
+                                     fence=fence)
     else:
-        log.debug('sending {} emails (weekly frequency)'
-                  .format(len(notifications_by_email)))
-        send_emails(notifications_by_email)
+        if outbox.is_enabled():
+            send_by_email = queue_emails
+        else:
+            send_by_email = send_emails
 
-    # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(frequency=Frequency.WEEKLY.value,
-                                   emails_last_sent=notification_datetime)
-    model.Session.commit()
+        def send(rows):
+            return send_by_email(
+                iter_notifications_by_email(rows, activity_cache),
+                fence=fence)
+    include_activity_from = get_include_activity_from_by_frequency(
+        frequencies, notification_datetime)
+    # in order of frequency value, like the rows
+    frequencies_to_do = sorted(frequencies, key=lambda f: f.value)
+    # each activity is dictized once this run, however many subscribers
+    # (while it is still in the cache)
+    activity_cache = OrderedDict()
 
+    # with push notifications, the immediate notifications are just for the
+    # objects with pending notifications, which are removed when done
+    object_ids_by_frequency = {}
+    pending_ids_by_frequency = {}
+    if Frequency.IMMEDIATE in frequencies and \
+            get_config('push_notifications'):
+        pending = get_pending_notifications()
+        pending_ids_by_frequency[Frequency.IMMEDIATE] = \
+            [id_ for id_, _ in pending]
+        object_ids = set(object_id for _, object_id in pending)
+        if object_ids:
+            object_ids_by_frequency[Frequency.IMMEDIATE.value] = object_ids
+        else:
+            del include_activity_from[Frequency.IMMEDIATE.value]
 
-def send_daily_notifications_if_its_time_to():
-    if not is_it_time_to_send_daily_notifications():
+    # read with a separate session, so that the commits done while sending
+    # (e.g. for the login codes) don't end the streaming query
+    read_session = model.meta.create_local_session()
+    try:
+        if include_activity_from:
+            rows = get_subscription_activities(
+                include_activity_from, object_ids_by_frequency) \
+                .with_session(read_session) \
+                .yield_per(STREAM_BATCH_SIZE)
+        else:
+            rows = []
+        for frequency_value, frequency_rows in \
+                groupby(rows, key=lambda row: row[0].frequency):
+            # frequencies with no rows are done already
+            while frequencies_to_do[0].value != frequency_value:
+                frequency = frequencies_to_do.pop(0)
+                _record_notifications_sent(
+                    frequency, notification_datetime, 0,
+                    pending_ids_by_frequency.get(frequency), fence=fence)
+            frequency = frequencies_to_do.pop(0)
+            log.debug('send_{}_notifications'.format(frequency.name.lower()))
+            num_emails = send(frequency_rows)
+            _record_notifications_sent(
+                frequency, notification_datetime, num_emails,
+                pending_ids_by_frequency.get(frequency), fence=fence)
+    finally:
+        read_session.close()
+    for frequency in frequencies_to_do:
+        _record_notifications_sent(frequency, notification_datetime, 0,
+                                   pending_ids_by_frequency.get(frequency),
+                                   fence=fence)
+    retry_failed_emails()
+
+
+def sync_event_store():
+    '''Brings the event store up to date, if it is enabled'''
+    if not get_config('event_store'):
         return
+    # (imported here, because event_store imports this module)
+    from ckanext.subscribe import event_store
+    event_store.sync()
+    model.Session.commit()
 
-    log.debug('send_daily_notifications')
-    notification_datetime = datetime.datetime.now()
-    notifications_by_email = get_daily_notifications(notification_datetime)
-    if not notifications_by_email:
-        log.debug('no emails to send (daily frequency)')
+
+def get_pending_notifications():
+    '''Returns the pending notifications recorded by the plugin's hooks - see
+    pending.py
+
+    :returns: [(id, object_id), ...]
+    '''
+    table = subscribe_model.pending_notification_table
+    return model.Session.query(table.c.id, table.c.object_id).all()
+
+
+def _record_notifications_sent(frequency, notification_datetime, num_emails,
+                               pending_notification_ids=None, fence=None):
+    if fence:
+        fence()
+    frequency_name = frequency.name.lower()
+    if not num_emails:
+        log.debug('no emails to send ({} frequency)'.format(frequency_name))
     else:
-        log.debug('sending {} emails (daily frequency)'
-                  .format(len(notifications_by_email)))
-        send_emails(notifications_by_email)
+        log.debug('{} {} emails ({} frequency)'.format(
+            'queued' if outbox.is_enabled() else 'sent',
+            num_emails, frequency_name))
 
     # record that notifications are 'all done' up to this time
-    Subscribe.set_emails_last_sent(frequency=Frequency.DAILY.value,
+    Subscribe.set_emails_last_sent(frequency=frequency.value,
                                    emails_last_sent=notification_datetime)
+    if pending_notification_ids:
+        table = subscribe_model.pending_notification_table
+        model.Session.execute(
+            table.delete().where(table.c.id.in_(pending_notification_ids)))
     model.Session.commit()
 
 
@@ -104,33 +270,315 @@ def get_immediate_notifications(notification_datetime=None):
     '''Work out what immediate notifications need sending out, based on
     activity, subscriptions and past notifications.
     '''
-    # just interested in activity which is recent and has a subscriber
-    subscription_frequency = Frequency.IMMEDIATE.value
+    return get_notifications_by_frequency(
+        [Frequency.IMMEDIATE], notification_datetime)[Frequency.IMMEDIATE]
 
-    # {object_id: [subscriptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}
 
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.IMMEDIATE.value)
+def get_weekly_notifications(notification_datetime=None):
+    '''Work out what weekly notifications need sending out, based on activity,
+    subscriptions and past notifications.
+    '''
+    return get_notifications_by_frequency(
+        [Frequency.WEEKLY], notification_datetime)[Frequency.WEEKLY]
+
+
+def get_daily_notifications(notification_datetime=None):
+    '''Work out what daily notifications need sending out, based on activity,
+    subscriptions and past notifications.
+    '''
+    return get_notifications_by_frequency(
+        [Frequency.DAILY], notification_datetime)[Frequency.DAILY]
+
+
+def get_notifications_by_frequency(frequencies, notification_datetime=None):
+    '''Work out what notifications need sending out for several frequencies
+    at once. The subscriptions are scanned, and orgs and groups expanded to
+    their datasets, just once, and the results partitioned by frequency.
+
+    (This holds all the notifications in memory - for sending, the rows are
+    streamed instead - see send_notifications().)
+
+    This only reads - if the event store is enabled, it is not synced first
+    (see sync_event_store()).
+
+    :param frequencies: list of Frequency
+
+    :returns: {frequency: {email: [notification, ...]}}
+    '''
     now = notification_datetime or datetime.datetime.now()
+    include_activity_from = get_include_activity_from_by_frequency(
+        frequencies, now)
+
+    notifications_by_frequency = dict(
+        (frequency, {}) for frequency in frequencies)
+    activity_cache = OrderedDict()
+    for frequency_value, frequency_rows in groupby(
+            get_subscription_activities(include_activity_from),
+            key=lambda row: row[0].frequency):
+        notifications_by_frequency[Frequency(frequency_value)] = \
+            dict(iter_notifications_by_email(frequency_rows, activity_cache))
+    return notifications_by_frequency
+
+
+def get_include_activity_from_by_frequency(frequencies, now):
+    ''':returns: {frequency_value: datetime}'''
+    return dict(
+        (frequency.value, get_include_activity_from(frequency, now))
+        for frequency in frequencies)
+
+
+def get_include_activity_from(frequency, now):
+    '''Returns the time from which activity should be notified, for a given
+    frequency. It is since the emails were last sent, but limited to the
+    period of the frequency plus the catch-up period.
+    '''
+    emails_last_sent = Subscribe.get_emails_last_sent(
+        frequency=frequency.value)
     catch_up_period = get_config('email_notifications_since')
+    if frequency == Frequency.IMMEDIATE:
+        # just interested in activity which is recent
+        if emails_last_sent:
+            return max(emails_last_sent, (now - catch_up_period))
+        return now - catch_up_period
+    # interested in activity which is this day/week
+    period = datetime.timedelta(
+        days=7 if frequency == Frequency.WEEKLY else 1)
     if emails_last_sent:
-        include_activity_from = max(
-            emails_last_sent, (now - catch_up_period))
+        return max(emails_last_sent, (now - period - catch_up_period))
+    return now - period
+
+
+def get_subscription_activities(include_activity_from,
+                                object_ids_by_frequency=None):
+    '''Query for the activity that subscribers need notifying about - the
+    (subscription, activity) pairs are worked out in the database with a join,
+    rather than fetching the subscribed objects and passing them back in a
+    (potentially huge) IN clause.
+
+    Activity that occurred before the subscription was created is excluded.
+    Rows are ordered by frequency, then email.
+
+    :param include_activity_from: {frequency_value: datetime} - the
+        subscription frequencies to include, and the time from which each
+        one's activity is relevant
+    :param object_ids_by_frequency: {frequency_value: object_ids} - limits
+        the activity for those frequencies to just these objects (optional)
+
+    :returns: query of (subscription, activity) - where activity is an
+        Activity object, or if the activity projection is enabled, a compact
+        record - see activity_projection(), or if the event store is enabled,
+        an Event
+    '''
+    if get_config('event_store'):
+        # the compact copy of the activity - see event_store.py
+        source = activity = Event
+    elif get_config('activity_projection'):
+        source = Activity
+        activity = activity_projection()
+    else:
+        source = activity = Activity
+    object_ids_by_frequency = object_ids_by_frequency or {}
+    frequency_criteria = []
+    for frequency, activity_from in include_activity_from.items():
+        criteria = [Subscription.frequency == frequency,
+                    source.timestamp > activity_from]
+        if frequency in object_ids_by_frequency:
+            criteria.append(source.object_id.in_(
+                object_ids_by_frequency[frequency]))
+        frequency_criteria.append(and_(*criteria))
+    subscribed_objects = \
+        subscribed_objects_query(list(include_activity_from.keys())).alias()
+    return model.Session.query(Subscription, activity) \
+        .join(subscribed_objects,
+              subscribed_objects.c.subscription_id == Subscription.id) \
+        .join(source,
+              source.object_id == subscribed_objects.c.object_id) \
+        .filter(source.timestamp > min(include_activity_from.values())) \
+        .filter(or_(*frequency_criteria)) \
+        .filter(source.timestamp >= Subscription.created) \
+        .order_by(Subscription.frequency, Subscription.email,
+                  source.timestamp)
+
+
+# the parts of activity['data'] that the notification emails use
+ACTIVITY_DATA_OBJECT_TYPES = ('package', 'group')
+ACTIVITY_DATA_FIELDS = ('id', 'name', 'title')
+
+
+def activity_projection():
+    '''Just the activity columns that the notification emails use, rather
+    than the whole Activity, whose data holds the entire dataset/group dict.
+
+    On PostgreSQL the package/group name and title are extracted from the
+    data in the database. Elsewhere the data is fetched and they are
+    extracted in Python, in compact_activity_dict().
+
+    :returns: Bundle of activity columns, for use in a query
+    '''
+    columns = [Activity.id, Activity.object_id, Activity.timestamp,
+               Activity.activity_type]
+    if model.Session.get_bind().dialect.name == 'postgresql':
+        data = cast(Activity.data, JSONB)
+        for object_type in ACTIVITY_DATA_OBJECT_TYPES:
+            for field in ACTIVITY_DATA_FIELDS:
+                columns.append(
+                    data[(object_type, field)].astext
+                    .label('{}_{}'.format(object_type, field)))
+    else:
+        # (as the raw JSON, because query rows need to be hashable)
+        columns.append(type_coerce(Activity.data, UnicodeText).label('data'))
+    return Bundle('activity', *columns)
+
+
+def compact_activity_dict(activity):
+    '''Dictizes an activity record from activity_projection(), in the same
+    shape as a dictized Activity, but with only the fields the notification
+    emails use.
+    '''
+    if 'data' in activity.keys():
+        full_data = json.loads(activity.data or '{}')
+        data = dict(
+            (object_type, dict(
+                (field, full_data[object_type].get(field))
+                for field in ACTIVITY_DATA_FIELDS))
+            for object_type in ACTIVITY_DATA_OBJECT_TYPES
+            if isinstance(full_data.get(object_type), dict))
     else:
-        include_activity_from = (now - catch_up_period)
+        data = {}
+        for object_type in ACTIVITY_DATA_OBJECT_TYPES:
+            object_dict = dict(
+                (field, getattr(activity, '{}_{}'.format(object_type, field)))
+                for field in ACTIVITY_DATA_FIELDS)
+            if object_dict['id'] is not None:
+                data[object_type] = object_dict
+    return {
+        'id': activity.id,
+        'object_id': activity.object_id,
+        'timestamp': activity.timestamp.isoformat(),
+        'activity_type': activity.activity_type,
+        'data': data,
+    }
+
+
+def event_activity_dict(event):
+    '''Dictizes an Event from the event store, in the same shape as
+    compact_activity_dict()
+    '''
+    data = {}
+    if event.package_id:
+        data['package'] = dict(id=event.package_id, name=event.name,
+                               title=event.title)
+    elif event.name or event.title:
+        data['group'] = dict(id=event.object_id, name=event.name,
+                             title=event.title)
+    return {
+        'id': event.id,
+        'object_id': event.object_id,
+        'timestamp': event.timestamp.isoformat(),
+        'activity_type': event.activity_type,
+        'data': data,
+    }
+
+
+# set once the object index is found to cover every subscription
+_object_index_complete = False
+
+
+def use_object_index():
+    '''Returns whether to look up the subscription object index. It is
+    enabled by ckanext.subscribe.object_index, but is only used once it
+    covers every subscription - after it is enabled on an existing site,
+    that is once rebuild-object-index has been run. Until then, the
+    subscriptions are expanded as if it were disabled, and an error is
+    logged each time, so that no one misses out on notifications.
+    '''
+    global _object_index_complete
+    if not get_config('object_index'):
+        return False
+    if _object_index_complete:
+        return True
+    # every subscription has at least the row for its own object
+    index_table = subscribe_model.subscription_object_index_table
+    unindexed = model.Session.query(Subscription.id) \
+        .filter(~exists().where(
+            index_table.c.subscription_id == Subscription.id)) \
+        .first()
+    if unindexed:
+        log.error('The subscription object index is not being used, because '
+                  'it is incomplete (e.g. subscription {} is not in it). '
+                  'Run: ckan subscribe rebuild-object-index'
+                  .format(unindexed[0]))
+        return False
+    _object_index_complete = True
+    return True
+
 
-    activities = model.Session.query(Activity) \
-        .filter(Activity.timestamp > include_activity_from) \
-        .filter(Activity.object_id.in_(objects_subscribed_to.keys())) \
-        .all()
-    if not activities:
-        return {}
-    return get_notifications_by_email(activities,
-                                      objects_subscribed_to,
-                                      subscription_frequency)
+def subscribed_objects_query(subscription_frequencies):
+    '''SQL for the objects we're listening for activity on - each
+    subscription's object, plus the datasets in subscribed orgs and groups.
+
+    If the subscription object index is enabled (and built - see
+    use_object_index()), this is a lookup on that, rather than expanding the
+    orgs and groups each time.
+
+    :param subscription_frequencies: list of frequency values to include
+
+    :returns: select of (subscription_id, object_id)
+    '''
+    criteria = [Subscription.verified.is_(True),
+                Subscription.frequency.in_(subscription_frequencies)]
+    if not use_object_index():
+        return expand_subscriptions_query(criteria)
+    index_table = subscribe_model.subscription_object_index_table
+    return model.Session.query(
+        index_table.c.subscription_id.label('subscription_id'),
+        index_table.c.object_id.label('object_id')) \
+        .join(Subscription, Subscription.id == index_table.c.subscription_id) \
+        .filter(*criteria) \
+        .statement
+
+
+def expand_subscriptions_query(criteria, package_id=None):
+    '''SQL that expands subscriptions to the objects they cover - each
+    subscription's object, plus the datasets in subscribed orgs and groups.
+
+    :param criteria: list of filters on Subscription, to say which
+        subscriptions to expand
+    :param package_id: only include rows for this dataset (optional)
+
+    :returns: UNION select of (subscription_id, object_id)
+    '''
+    # direct subscriptions - i.e. datasets, orgs & groups
+    direct = model.Session.query(
+        Subscription.id.label('subscription_id'),
+        Subscription.object_id.label('object_id')) \
+        .filter(*criteria)
+    # also include the datasets attached to the subscribed orgs
+    org_datasets = model.Session.query(
+        Subscription.id.label('subscription_id'),
+        Package.id.label('object_id')) \
+        .filter(*criteria) \
+        .join(Group, Group.id == Subscription.object_id) \
+        .filter(Group.state == 'active') \
+        .filter(Group.is_organization.is_(True)) \
+        .join(Package, Package.owner_org == Group.id)
+    # also include the datasets attached to the subscribed groups
+    group_datasets = model.Session.query(
+        Subscription.id.label('subscription_id'),
+        Package.id.label('object_id')) \
+        .filter(*criteria) \
+        .join(Group, Group.id == Subscription.object_id) \
+        .filter(Group.state == 'active') \
+        .filter(Group.is_organization.is_(False)) \
+        .join(Member, Member.group_id == Group.id) \
+        .filter(Member.state == 'active') \
+        .join(Package, Package.id == Member.table_id)
+    if package_id:
+        direct = direct.filter(Subscription.object_id == package_id)
+        org_datasets = org_datasets.filter(Package.id == package_id)
+        group_datasets = group_datasets.filter(Package.id == package_id)
+    return union_all(direct.statement, org_datasets.statement,
+                     group_datasets.statement)
 
 
 def get_objects_subscribed_to(subscription_frequency):
@@ -139,51 +587,45 @@ def get_objects_subscribed_to(subscription_frequency):
 
     :returns: {object_id: [subscriptions]}
     '''
-    objects_subscribed_to = defaultdict(list)  # {object_id: [subscriptions]}
-    # direct subscriptions - i.e. datasets, orgs & groups
-    for subscription in model.Session.query(Subscription) \
-            .filter(Subscription.verified.is_(True)) \
-            .filter(Subscription.frequency == subscription_frequency).all():
-        objects_subscribed_to[subscription.object_id].append(subscription)
-    # also include the datasets attached to the subscribed orgs
-    for subscription, package_id in model.Session.query(Subscription, Package.id) \
-            .filter(Subscription.verified.is_(True)) \
-            .filter(Subscription.frequency == subscription_frequency) \
-            .join(Group, Group.id == Subscription.object_id) \
-            .filter(Group.state == 'active') \
-            .filter(Group.is_organization.is_(True)) \
-            .join(Package, Package.owner_org == Group.id) \
-            .all():
-        objects_subscribed_to[package_id].append(subscription)
-    # also include the datasets attached to the subscribed orgs
-    for subscription, package_id in model.Session.query(Subscription, Package.id) \
-            .filter(Subscription.verified.is_(True)) \
-            .filter(Subscription.frequency == subscription_frequency) \
-            .join(Group, Group.id == Subscription.object_id) \
-            .filter(Group.state == 'active') \
-            .filter(Group.is_organization.is_(False)) \
-            .join(Member, Member.group_id == Group.id) \
-            .filter(Member.state == 'active') \
-            .join(Package, Package.id == Member.table_id) \
+    return get_objects_subscribed_to_by_frequency(
+        [subscription_frequency])[subscription_frequency]
+
+
+def get_objects_subscribed_to_by_frequency(subscription_frequencies):
+    ''' Returns the objects we're listening for activity to, and the
+    subscriptions they are related to, for several frequencies in one pass
+
+    :returns: {frequency_value: {object_id: [subscriptions]}}
+    '''
+    objects_by_frequency = dict(
+        (frequency, defaultdict(list))
+        for frequency in subscription_frequencies)
+    subscribed_objects = \
+        subscribed_objects_query(subscription_frequencies).alias()
+    for subscription, object_id in model.Session.query(
+            Subscription, subscribed_objects.c.object_id) \
+            .join(subscribed_objects,
+                  subscribed_objects.c.subscription_id == Subscription.id) \
             .all():
-        objects_subscribed_to[package_id].append(subscription)
-    return objects_subscribed_to
+        objects_by_frequency[subscription.frequency][object_id].append(
+            subscription)
+    return objects_by_frequency
 
 
-def is_it_time_to_send_weekly_notifications():
+def is_it_time_to_send_weekly_notifications(now=None):
     emails_last_sent = Subscribe.get_emails_last_sent(
         frequency=Frequency.WEEKLY.value)
     if not emails_last_sent:
         return True
-    return most_recent_weekly_notification_datetime() > emails_last_sent
+    return most_recent_weekly_notification_datetime(now) > emails_last_sent
 
 
-def is_it_time_to_send_daily_notifications():
+def is_it_time_to_send_daily_notifications(now=None):
     emails_last_sent = Subscribe.get_emails_last_sent(
         frequency=Frequency.DAILY.value)
     if not emails_last_sent:
         return True
-    return most_recent_daily_notification_datetime() > emails_last_sent
+    return most_recent_daily_notification_datetime(now) > emails_last_sent
 
 
 def most_recent_weekly_notification_datetime(now=None):
@@ -207,117 +649,175 @@ def most_recent_daily_notification_datetime(now=None):
     return todays_notification_time
 
 
-def get_weekly_notifications(notification_datetime=None):
-    '''Work out what weekly notifications need sending out, based on activity,
-    subscriptions and past notifications.
+def get_notifications_by_email(subscription_activities):
+    '''Groups the activity by email address, so we can send each email
+    address one email with all their notifications, and also have access to
+    the subscription object with the object_type etc.
+
+    :param subscription_activities: [(subscription, activity), ...]
+
+    :returns: {email: [{'subscription': {...}, 'activities': [{...}, ...]}]}
     '''
-    # interested in activity which is this week and has a subscriber
-    subscription_frequency = Frequency.WEEKLY.value
+    return dict(iter_notifications_by_email(
+        sorted(subscription_activities, key=lambda row: row[0].email)))
 
-    # {object_id: [subsciptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}
 
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.WEEKLY.value)
-    now = notification_datetime or datetime.datetime.now()
-    catch_up_period = get_config('email_notifications_since')
-    week = datetime.timedelta(days=7)
-    if emails_last_sent:
-        include_activity_from = max(
-            emails_last_sent, (now - week - catch_up_period))
-    else:
-        include_activity_from = (now - week)
+def iter_notifications_by_email(subscription_activities,
+                                activity_cache=None):
+    '''Groups the activity by email address, one recipient at a time.
 
-    activities = model.Session.query(Activity) \
-        .filter(Activity.timestamp > include_activity_from) \
-        .filter(Activity.object_id.in_(objects_subscribed_to.keys())) \
-        .all()
-    if not activities:
-        return {}
-    return get_notifications_by_email(activities,
-                                      objects_subscribed_to,
-                                      subscription_frequency)
+    :param subscription_activities: iterable of (subscription, activity),
+        ordered by email
+    :param activity_cache: shared between the recipients, so each activity is
+        only dictized once - see dictize_notifications() (optional)
 
+    :returns: generator of
+        (email, [{'subscription': {...}, 'activities': [{...}, ...]}])
+    '''
+    if activity_cache is None:
+        activity_cache = OrderedDict()
+    for email, rows in groupby(subscription_activities,
+                               key=lambda row: row[0].email):
+        # {subscription: [activity, ...], ...}
+        subscription_activities_ = OrderedDict()
+        for subscription, activity in rows:
+            subscription_activities_.setdefault(subscription, []) \
+                .append(activity)
+        yield email, dictize_notifications(subscription_activities_,
+                                           activity_cache)
 
-def get_daily_notifications(notification_datetime=None):
-    '''Work out what daily notifications need sending out, based on activity,
-    subscriptions and past notifications.
+
+def iter_notification_ids_by_email(subscription_activities):
+    '''Groups the subscription and activity ids by email address, one
+    recipient at a time, for send_notifications_job().
+
+    :param subscription_activities: iterable of (subscription, activity),
+        ordered by email
+
+    :returns: generator of [(subscription_id, [activity_id, ...]), ...]
     '''
-    # interested in activity which is this week and has a subscriber
-    subscription_frequency = Frequency.DAILY.value
+    for email, rows in groupby(subscription_activities,
+                               key=lambda row: row[0].email):
+        activity_ids = OrderedDict()
+        for subscription, activity in rows:
+            activity_ids.setdefault(subscription.id, []).append(activity.id)
+        yield list(activity_ids.items())
 
-    # {object_id: [subscriptions]}
-    objects_subscribed_to = get_objects_subscribed_to(subscription_frequency)
-    if not objects_subscribed_to:
-        return {}
 
-    emails_last_sent = Subscribe.get_emails_last_sent(
-        frequency=Frequency.DAILY.value)
-    now = notification_datetime or datetime.datetime.now()
-    catch_up_period = get_config('email_notifications_since')
-    day = datetime.timedelta(days=1)
-    if emails_last_sent:
-        include_activity_from = max(
-            emails_last_sent, (now - day - catch_up_period))
-    else:
-        include_activity_from = (now - day)
-
-    activities = model.Session.query(Activity) \
-        .filter(Activity.timestamp > include_activity_from) \
-        .filter(Activity.object_id.in_(objects_subscribed_to.keys())) \
-        .all()
-    if not activities:
-        return {}
-    return get_notifications_by_email(activities,
-                                      objects_subscribed_to,
-                                      subscription_frequency)
-
-
-def get_notifications_by_email(activities, objects_subscribed_to,
-                               subscription_frequency):
-    # group by email address
-    # so we can send each email address one email with all their notifications
-    # and also have access to the subscription object with the object_type etc
-    # (done in a loop rather than sql merely because of ease/clarity)
-    # email: {subscription: [activity, ...], ...}
-    notifications = defaultdict(lambda: defaultdict(list))
-    for activity in activities:
-        for subscription in objects_subscribed_to[activity.object_id]:
-            # ignore activity that occurs before this subscription was created
-            if subscription.created > activity.timestamp:
-                continue
+def enqueue_send_jobs(recipients, fence=None):
+    '''Enqueues background jobs to send the notification emails, a batch of
+    recipients per job.
+
+    :param recipients: iterable of recipients' notification ids - see
+        iter_notification_ids_by_email()
+    :param fence: called before each job is enqueued, to stop by raising an
+        exception - see send_notifications() (optional)
+
+    :returns: the number of emails enqueued
+    '''
+    recipients = iter(recipients)
+    num_emails = 0
+    while True:
+        batch = list(islice(recipients, SEND_JOB_BATCH_SIZE))
+        if not batch:
+            return num_emails
+        if fence:
+            fence()
+        toolkit.enqueue_job(
+            send_notifications_job, [batch],
+            title=u'subscribe notifications ({} recipients)'.format(
+                len(batch)),
+            queue=get_config('send_jobs_queue'))
+        num_emails += len(batch)
+
 
-            notifications[subscription.email][subscription].append(activity)
+def send_notifications_job(recipients):
+    '''Background job that builds and sends the notification emails for a
+    batch of recipients, from the ids enqueued by send_notifications().
+    Subscriptions that have been deleted since are skipped.
 
-    # dictize
-    notifications_by_email_dictized = defaultdict(list)
-    for email, subscription_activities in notifications.items():
-        notifications_by_email_dictized[email] = \
-            dictize_notifications(subscription_activities)
+    :param recipients: list of recipients' notification ids - see
+        iter_notification_ids_by_email()
+    '''
+    migration.require_current_version()
+    subscription_ids = set(
+        subscription_id
+        for recipient in recipients
+        for subscription_id, _ in recipient)
+    activity_ids = set(
+        activity_id
+        for recipient in recipients
+        for _, activity_ids_ in recipient
+        for activity_id in activity_ids_)
+    subscriptions = dict(
+        (subscription.id, subscription)
+        for subscription in model.Session.query(Subscription)
+        .filter(Subscription.id.in_(subscription_ids)))
+    activities = dict(
+        (activity.id, activity) for activity in get_activities(activity_ids))
+
+    def notifications_by_email():
+        activity_cache = OrderedDict()
+        for recipient in recipients:
+            subscription_activities = OrderedDict()
+            for subscription_id, activity_ids_ in recipient:
+                subscription = subscriptions.get(subscription_id)
+                activities_ = [activities[activity_id]
+                               for activity_id in activity_ids_
+                               if activity_id in activities]
+                if subscription and activities_:
+                    subscription_activities[subscription] = activities_
+            if subscription_activities:
+                email = next(iter(subscription_activities)).email
+                yield email, dictize_notifications(subscription_activities,
+                                                   activity_cache)
 
-    return notifications_by_email_dictized
+    if outbox.is_enabled():
+        num_emails = queue_emails(notifications_by_email())
+        model.Session.commit()
+    else:
+        num_emails = send_emails(notifications_by_email())
+    log.debug('sent {} emails (job)'.format(num_emails))
 
 
-def dictize_notifications(subscription_activities):
+def get_activities(activity_ids):
+    '''Returns the activities with the given ids, in the form that
+    get_subscription_activities() returns them.
+    '''
+    if not activity_ids:
+        return []
+    if get_config('event_store'):
+        return model.Session.query(Event) \
+            .filter(Event.id.in_(activity_ids)).all()
+    if get_config('activity_projection'):
+        return [activity for activity, in
+                model.Session.query(activity_projection())
+                .filter(Activity.id.in_(activity_ids))]
+    return model.Session.query(Activity) \
+        .filter(Activity.id.in_(activity_ids)).all()
+
+
+def dictize_notifications(subscription_activities, activity_cache=None):
     '''Dictizes a subscription and its activity objects
 
     :param subscription_activities: {subscription: [activity, ...], ...}
+    :param activity_cache: OrderedDict of activity dicts, keyed by activity
+        id, which is filled in and reused, so that an activity notified to
+        many subscribers is only dictized once. It keeps the
+        ACTIVITY_CACHE_SIZE most recently used. The dicts are shared between
+        notifications, so must not be modified. (optional)
 
     :returns: [{'subscription': {...}, {'activities': [{...}, ...]}}]
     '''
     context = {'model': model, 'session': model.Session}
+    if activity_cache is None:
+        activity_cache = OrderedDict()
     notifications_dictized = []
     for subscription, activities in subscription_activities.items():
         subscription_dict = \
             dictization.dictize_subscription(subscription, context)
-        if IS_CKAN_29_OR_HIGHER:
-            activity_dicts = model_dictize.activity_list_dictize(
-                activities, context, include_data=True)
-        else:
-            activity_dicts = model_dictize.activity_list_dictize(
-                activities, context)
+        activity_dicts = dictize_activities(activities, context,
+                                            activity_cache)
         notifications_dictized.append(
             {
                 'subscription': subscription_dict,
@@ -327,7 +827,223 @@ def dictize_notifications(subscription_activities):
     return notifications_dictized
 
 
-def send_emails(notifications_by_email):
-    for email, notifications in notifications_by_email.items():
-        code = email_auth.create_code(email)
-        notification_email.send_notification_email(code, email, notifications)
+def dictize_activities(activities, context, activity_cache):
+    '''Dictizes activity objects (or compact activity records), using and
+    filling activity_cache (OrderedDict of {activity_id: activity_dict}, in
+    order of use), and dropping the least recently used from it beyond
+    ACTIVITY_CACHE_SIZE.
+    '''
+    # {activity_id: activity_dict} for these activities
+    activity_dicts_by_id = {}
+    for activity in activities:
+        if activity.id in activity_cache:
+            activity_dicts_by_id[activity.id] = activity_cache[activity.id]
+    to_dictize = [activity for activity in activities
+                  if activity.id not in activity_dicts_by_id]
+    if to_dictize and isinstance(to_dictize[0], Event):
+        for event in to_dictize:
+            activity_dicts_by_id[event.id] = event_activity_dict(event)
+    elif to_dictize and not isinstance(to_dictize[0], Activity):
+        # compact records, from activity_projection()
+        for activity in to_dictize:
+            activity_dicts_by_id[activity.id] = \
+                compact_activity_dict(activity)
+    elif to_dictize:
+        if IS_CKAN_29_OR_HIGHER:
+            activity_dicts = model_dictize.activity_list_dictize(
+                to_dictize, context, include_data=True)
+        else:
+            activity_dicts = model_dictize.activity_list_dictize(
+                to_dictize, context)
+        for activity, activity_dict in zip(to_dictize, activity_dicts):
+            activity_dicts_by_id[activity.id] = activity_dict
+    for activity_id, activity_dict in activity_dicts_by_id.items():
+        # (re)add it at the end, as the most recently used (python 2's
+        # OrderedDict has no move_to_end())
+        activity_cache.pop(activity_id, None)
+        activity_cache[activity_id] = activity_dict
+    while len(activity_cache) > ACTIVITY_CACHE_SIZE:
+        activity_cache.popitem(last=False)
+    return [activity_dicts_by_id[activity.id] for activity in activities]
+
+
+def send_emails(notifications_by_email, fence=None):
+    '''Sends each email address an email with their notifications.
+
+    If an email fails to send, the reason is logged and the email is put in
+    the outbox to be retried later (see retry_failed_emails()), and the other
+    recipients' emails are still sent - so one bad address doesn't stop the
+    run from being recorded as done, which would mean everyone else's emails
+    being sent again next time.
+
+    :param notifications_by_email: {email: notifications} or an iterable of
+        (email, notifications)
+    :param fence: called before each email, to stop by raising an exception
+        - see send_notifications() (optional)
+
+    :returns: the number of emails sent
+    '''
+    if hasattr(notifications_by_email, 'items'):
+        notifications_by_email = notifications_by_email.items()
+    workers = get_config('send_workers')
+    if workers > 1:
+        return send_emails_in_parallel(notifications_by_email, workers,
+                                       fence=fence)
+    # recipients with the same notifications share the rendering
+    body_cache = OrderedDict()
+    num_emails = num_failed = 0
+    for code, email, notifications in \
+            iter_with_codes(notifications_by_email, fence=fence):
+        try:
+            notification_email.send_notification_email(
+                code, email, notifications, body_cache=body_cache)
+        except MailerException as exc:
+            _retry_email_later(code, email, notifications, body_cache, exc)
+            num_failed += 1
+            continue
+        num_emails += 1
+    if num_failed:
+        model.Session.commit()
+    return num_emails
+
+
+def _retry_email_later(code, email, notifications, body_cache, error):
+    log.warning('Could not send notification email to {} - it will be '
+                'retried: {}'.format(email, error))
+    subject, plain_text_body, html_body = \
+        notification_email.get_notification_email_contents(
+            code, email, notifications, body_cache=body_cache)
+    outbox.retry_later(recipient_name=email,
+                       recipient_email=email,
+                       subject=subject,
+                       body=plain_text_body,
+                       body_html=html_body,
+                       error=error)
+
+
+def retry_failed_emails():
+    '''Retries the emails that failed to send and are due a retry. If the
+    outbox is enabled, its worker does this instead.
+
+    :returns: (number sent, number failed)
+    '''
+    if outbox.is_enabled():
+        return 0, 0
+    return outbox.send_pending()
+
+
+def queue_emails(notifications_by_email, fence=None):
+    '''Renders each email address's notification email and adds it to the
+    outbox, for the worker to send. Nothing is committed (including the login
+    codes), so that the caller can commit the emails in the same transaction
+    as recording that they are done.
+
+    :param notifications_by_email: {email: notifications} or an iterable of
+        (email, notifications)
+    :param fence: see send_emails() (optional)
+
+    :returns: the number of emails queued
+    '''
+    if hasattr(notifications_by_email, 'items'):
+        notifications_by_email = notifications_by_email.items()
+    body_cache = OrderedDict()
+
+    def messages():
+        for code, email, notifications in \
+                iter_with_codes(notifications_by_email, commit=False,
+                                fence=fence):
+            subject, plain_text_body, html_body = \
+                notification_email.get_notification_email_contents(
+                    code, email, notifications, body_cache=body_cache)
+            yield dict(recipient_name=email,
+                       recipient_email=email,
+                       subject=subject,
+                       body=plain_text_body,
+                       body_html=html_body)
+    return outbox.queue(messages())
+
+
+def iter_with_codes(notifications_by_email, commit=True, fence=None):
+    '''Adds a login code for each recipient. The codes are created for a
+    batch of recipients at a time, in one database round trip.
+
+    :param notifications_by_email: iterable of (email, notifications)
+    :param commit: whether to commit each batch of codes
+    :param fence: called before each recipient is yielded, to stop by
+        raising an exception (optional)
+
+    :returns: generator of (code, email, notifications)
+    '''
+    notifications_by_email = iter(notifications_by_email)
+    while True:
+        batch = list(islice(notifications_by_email, CODE_BATCH_SIZE))
+        if not batch:
+            return
+        codes = email_auth.create_codes((email for email, _ in batch),
+                                        commit=commit)
+        for email, notifications in batch:
+            if fence:
+                fence()
+            yield codes[email], email, notifications
+
+
+def send_emails_in_parallel(notifications_by_email, workers, fence=None):
+    '''Sends the emails using a pool of threads, so that several SMTP
+    conversations are in progress at once.
+
+    The code creation and rendering are done on this thread, because they
+    need the database session and CKAN's request context - only the sending
+    is done by the workers. Like the serial version, failed emails are put
+    in the outbox to be retried later, and the rest are still sent.
+
+    :param notifications_by_email: iterable of (email, notifications)
+    :param fence: see send_emails() (optional)
+
+    :returns: the number of emails sent
+    '''
+    # limit how far the rendering gets ahead of the sending
+    max_in_flight = workers * 4
+    # (result, code, email, notifications)
+    in_flight = deque()
+    body_cache = OrderedDict()
+    num_emails = num_failed = 0
+
+    def wait_for_oldest():
+        result, code, email, notifications = in_flight.popleft()
+        try:
+            # raises the worker's exception, if it failed
+            result.get()
+        except MailerException as exc:
+            _retry_email_later(code, email, notifications, body_cache, exc)
+            return False
+        return True
+
+    pool = ThreadPool(workers)
+    try:
+        for code, email, notifications in \
+                iter_with_codes(notifications_by_email, fence=fence):
+            msg = notification_email.make_notification_email(
+                code, email, notifications, body_cache=body_cache)
+            in_flight.append(
+                (pool.apply_async(mailer.send_message, (msg, email)),
+                 code, email, notifications))
+            if len(in_flight) >= max_in_flight:
+                if wait_for_oldest():
+                    num_emails += 1
+                else:
+                    num_failed += 1
+        while in_flight:
+            if wait_for_oldest():
+                num_emails += 1
+            else:
+                num_failed += 1
+    except Exception:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    if num_failed:
+        model.Session.commit()
+    return num_emails
@@ -1,20 +1,35 @@
-from jinja2 import Template
+from collections import OrderedDict
 
 from ckan import plugins as p
 from ckan import model
 
 from ckanext.subscribe import mailer
+from ckanext.subscribe import email_templates
 from ckanext.subscribe.email_auth import get_footer_contents
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 
-from lib.helpers import literal
+from markupsafe import Markup, escape
 
 config = p.toolkit.config
 
 
-def send_notification_email(code, email, notifications):
+# Stand-ins for the parts of a notification email that differ between
+# recipients, so the rest can be rendered once and shared
+RECIPIENT_PLACEHOLDERS = {
+    'email': '%%subscribe:email%%',
+    'plain_text_footer': '%%subscribe:plain_text_footer%%',
+    'html_footer': '%%subscribe:html_footer%%',
+}
+
+# Maximum number of rendered bodies kept in a body_cache (the least recently
+# used is dropped)
+BODY_CACHE_SIZE = 100
+
+
+def send_notification_email(code, email, notifications, body_cache=None):
     subject, plain_text_body, html_body = \
-        get_notification_email_contents(code, email, notifications)
+        get_notification_email_contents(code, email, notifications,
+                                        body_cache=body_cache)
     mailer.mail_recipient(recipient_name=email,
                           recipient_email=email,
                           subject=subject,
@@ -23,55 +38,96 @@ def send_notification_email(code, email, notifications):
                           headers={})
 
 
-def get_notification_email_contents(code, email, notifications):
-    email_vars = get_notification_email_vars(email, notifications)
+def make_notification_email(code, email, notifications, body_cache=None):
+    '''Renders the notification email as a MIME message, ready for
+    mailer.send_message()'''
+    subject, plain_text_body, html_body = \
+        get_notification_email_contents(code, email, notifications,
+                                        body_cache=body_cache)
+    return mailer.make_message(recipient_name=email,
+                               recipient_email=email,
+                               subject=subject,
+                               body=plain_text_body,
+                               body_html=html_body,
+                               headers={})
+
+
+def get_notification_email_contents(code, email, notifications,
+                                    body_cache=None):
+    '''Renders a notification email.
+
+    Recipients with the same notifications (e.g. everyone subscribed to one
+    org) get the same email, apart from their email address and footer. So
+    the email is rendered with placeholders for those, and kept in
+    body_cache, keyed by the notified objects and activities. Other
+    recipients with the same key just have their details spliced in.
+
+    :param body_cache: OrderedDict to share between the recipients of a
+        run, kept in order of use (optional)
+
+    :returns: (subject, plain_text_body, html_body)
+    '''
+    if body_cache is None:
+        body_cache = OrderedDict()
+    key = notifications_key(notifications)
+    if key in body_cache:
+        # move it to the end, as the most recently used (python 2's
+        # OrderedDict has no move_to_end())
+        body_cache[key] = body_cache.pop(key)
+    else:
+        if len(body_cache) >= BODY_CACHE_SIZE:
+            body_cache.popitem(last=False)
+        body_cache[key] = render_notification_email(notifications)
+
     plain_text_footer, html_footer = \
         get_footer_contents(code=code, email=email)
-    email_vars['plain_text_footer'] = plain_text_footer
-    email_vars['html_footer'] = html_footer
+    recipient_vars = dict(
+        email=email,
+        plain_text_footer=plain_text_footer,
+        html_footer=html_footer,
+    )
+    subject, plain_text_body, html_body = body_cache[key]
+    html_recipient_vars = dict(recipient_vars, email=escape(email))
+    return (personalize(subject, recipient_vars),
+            personalize(plain_text_body, recipient_vars),
+            personalize(html_body, html_recipient_vars))
+
+
+def notifications_key(notifications):
+    '''Identifies the content of a notification email - the objects and
+    the activity ids
+    '''
+    return tuple(
+        (notification['subscription']['object_type'],
+         notification['subscription']['object_id'],
+         tuple(activity['id'] for activity in notification['activities']))
+        for notification in notifications)
+
+
+def render_notification_email(notifications):
+    '''Renders the parts of a notification email that are the same for all
+    recipients, with placeholders for the rest - see personalize()
+
+    :returns: (subject, plain_text_body, html_body)
+    '''
+    email_vars = get_notification_email_vars(
+        RECIPIENT_PLACEHOLDERS['email'], notifications)
+    email_vars.update(RECIPIENT_PLACEHOLDERS)
 
     subject = '{site_title} notification'.format(**email_vars)
     # Make sure subject is only one line
     subject = subject.split('\n')[0]
 
-    html_body = Template('''
-<p>Changes have occurred in relation to your subscription(s)</p>
-
-{% for notification in notifications %}
-
-  <h3><a href="{{ notification.object_link }}">"{{ notification.object_title }}" ({{ notification.object_name }})</a>:</h3>
-
-  {% for activity in notification.activities %}
-    <p>
-      - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} -
-      {{ activity.activity_type }}
-      {% if notification.object_type != 'dataset' %}
-        - {{ activity.dataset_link }}
-      {% endif %}
-    </p>
-  {% endfor %}
-{% endfor %}
-
---
-{{ html_footer }}
-''').render(**email_vars)
-    plain_text_body = Template('''
-Changes have occurred in relation to your subscription(s)
-
-{% for notification in notifications %}
-  "{{ notification.object_title }}" - {{ notification.object_link }}
-
-  {% for activity in notification.activities %}
-      - {{ activity.timestamp.strftime('%Y-%m-%d %H:%M') }} - {{ activity.activity_type }} {% if (
-          notification.object_type != 'dataset') %} - {{ activity.dataset_href }} {% endif %}
+    html_body = email_templates.render('notification.html', **email_vars)
+    plain_text_body = email_templates.render('notification.txt',
+                                             **email_vars)
+    return subject, plain_text_body, html_body
 
-  {% endfor %}
-{% endfor %}
 
---
-{{ plain_text_footer }}
-''').render(**email_vars)
-    return subject, plain_text_body, html_body
+def personalize(content, recipient_vars):
+    for key, placeholder in RECIPIENT_PLACEHOLDERS.items():
+        content = content.replace(placeholder, recipient_vars[key])
+    return content
 
 
 def get_notification_email_vars(email, notifications):
@@ -139,7 +195,8 @@ def dataset_link_from_activity(activity):
         return ''
     try:
         title = activity['data']['package']['title']
-        return literal('<a href="{}">{}</a>'.format(href, title))
+        # (Markup.format escapes the href and title)
+        return Markup(u'<a href="{}">{}</a>').format(href, title)
     except KeyError:
         return ''
 
@@ -0,0 +1,99 @@
+# encoding: utf-8
+
+'''
+The subscription object index is a table of the objects that each
+subscription covers - the dataset/group/org subscribed to, plus the datasets
+in a subscribed org or group. With it, finding the subscribers to some
+activity is an indexed lookup, rather than joining the groups, members and
+datasets every time notifications are checked.
+
+It is kept up to date by the plugin's hooks as subscriptions, datasets and
+groups change. If it gets out of step (e.g. after a bulk change that bypasses
+the action functions), it can be repaired with:
+
+    ckan subscribe rebuild-object-index
+
+The index is only maintained and used if ckanext.subscribe.object_index is
+enabled.
+'''
+
+from sqlalchemy import select
+
+from ckan import model
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.model import Subscription
+from ckanext.subscribe.notification import (
+    get_config,
+    expand_subscriptions_query,
+)
+
+log = __import__('logging').getLogger(__name__)
+
+
+def is_enabled():
+    return get_config('object_index')
+
+
+def rebuild():
+    '''Recreates the whole index from the subscriptions, groups and datasets.
+    (The caller needs to commit.)
+    '''
+    index_table = subscribe_model.subscription_object_index_table
+    model.Session.flush()
+    model.Session.execute(index_table.delete())
+    _insert(expand_subscriptions_query([]))
+    log.debug('Subscription object index rebuilt')
+
+
+def add_subscription(subscription_id):
+    '''Indexes a new subscription. (The caller needs to commit.)'''
+    remove_subscriptions([subscription_id])
+    _insert(expand_subscriptions_query([Subscription.id == subscription_id]))
+
+
+def remove_subscriptions(subscription_ids):
+    '''Removes subscriptions from the index, before they are deleted.
+    (The caller needs to commit.)
+    '''
+    index_table = subscribe_model.subscription_object_index_table
+    model.Session.flush()
+    model.Session.execute(
+        index_table.delete()
+        .where(index_table.c.subscription_id.in_(subscription_ids)))
+
+
+def refresh_package(package_id):
+    '''Re-indexes the subscriptions that cover a dataset, e.g. after it has
+    changed org or joined/left a group. (The caller needs to commit.)
+    '''
+    index_table = subscribe_model.subscription_object_index_table
+    model.Session.flush()
+    model.Session.execute(
+        index_table.delete().where(index_table.c.object_id == package_id))
+    _insert(expand_subscriptions_query([], package_id=package_id))
+
+
+def refresh_group(group_id):
+    '''Re-indexes the subscriptions to a group or org, e.g. after it has been
+    deleted. (The caller needs to commit.)
+    '''
+    index_table = subscribe_model.subscription_object_index_table
+    model.Session.flush()
+    group_subscription_ids = select([Subscription.id]) \
+        .where(Subscription.object_id == group_id)
+    model.Session.execute(
+        index_table.delete()
+        .where(index_table.c.subscription_id.in_(group_subscription_ids)))
+    _insert(expand_subscriptions_query([Subscription.object_id == group_id]))
+
+
+def _insert(subscribed_objects):
+    # INSERT ... SELECT, so the rows never leave the database
+    index_table = subscribe_model.subscription_object_index_table
+    subscribed_objects = subscribed_objects.alias()
+    model.Session.execute(
+        index_table.insert().from_select(
+            ['subscription_id', 'object_id'],
+            select([subscribed_objects.c.subscription_id,
+                    subscribed_objects.c.object_id]).distinct()))
@@ -0,0 +1,357 @@
+# encoding: utf-8
+
+'''
+The outbox lets emails be sent in the background, rather than by the process
+that causes them (e.g. the verification email on signup, during the web
+request, or the notification emails, during send-any-notifications), so a
+slow or failing SMTP server doesn't hold up the request, or make a
+notification run fail part way through.
+
+When ckanext.subscribe.outbox is enabled, emails are just stored in the
+subscribe_outbox table, and a worker process sends them:
+
+    ckan subscribe worker -r
+
+Several workers can be run at once, on different hosts, to share the
+sending. Each claims a batch of emails at a time, with a lease, so no two
+workers send the same email, and if a worker dies, its emails are sent by
+another once the lease expires.
+
+If sending fails, the email is retried later, with an exponential backoff,
+and after several attempts it is given up on and marked 'dead'. If it is
+deferred (a 4xx reply, e.g. the receiving domain is throttling us - see
+mailer.SendLimiter), it is just retried after the deferral delay. The rows
+are kept after sending, with their status and the last error, so failures
+can be seen in the table, until they are older than
+ckanext.subscribe.outbox.retention - see prune().
+
+When it is not enabled, deliver() sends the email straight away.
+'''
+
+import datetime
+import os
+import socket
+from itertools import islice
+
+from sqlalchemy import func, or_
+
+import ckan.plugins as p
+from ckan import model
+from ckan.lib.mailer import MailerException
+
+from ckanext.subscribe import mailer
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.model import OutboxMessage
+
+log = __import__('logging').getLogger(__name__)
+
+config = p.toolkit.config
+
+# number of emails a worker loads, or that are queued, at a time
+BATCH_SIZE = 100
+
+# the longest a failed email waits before it is retried
+MAX_RETRY_DELAY = datetime.timedelta(days=1)
+
+# how long an email keeps being deferred (SMTP 4xx replies) before it is given
+# up on - similar to how long mail servers keep retrying
+MAX_DEFERRAL_AGE = datetime.timedelta(days=2)
+
+# how often send_pending() deletes the old sent and dead emails
+PRUNE_INTERVAL = datetime.timedelta(hours=1)
+
+# when send_pending() last did that (in this process)
+_last_pruned = None
+
+
+def is_enabled():
+    return p.toolkit.asbool(config.get('ckanext.subscribe.outbox', False))
+
+
+def get_max_attempts():
+    return int(config.get('ckanext.subscribe.outbox.max_attempts', 5))
+
+
+def get_retry_delay(attempts):
+    '''Returns how long to wait before retrying an email that has failed
+    the given number of times - doubling each time.'''
+    first_delay = int(config.get('ckanext.subscribe.outbox.retry_delay', 60))
+    return min(datetime.timedelta(seconds=first_delay * 2 ** (attempts - 1)),
+               MAX_RETRY_DELAY)
+
+
+def get_retention():
+    '''Returns how long sent and dead emails are kept in the outbox.'''
+    return datetime.timedelta(
+        days=int(config.get('ckanext.subscribe.outbox.retention', 7)))
+
+
+def deliver(recipient_name, recipient_email, subject, body, body_html=None,
+            headers=None):
+    '''Sends an email - via the outbox, if it is enabled, otherwise straight
+    away. (Takes the same parameters as mailer.mail_recipient())
+    '''
+    if not is_enabled():
+        try:
+            return mailer.mail_recipient(recipient_name=recipient_name,
+                                         recipient_email=recipient_email,
+                                         subject=subject,
+                                         body=body,
+                                         body_html=body_html,
+                                         headers=headers)
+        except mailer.MailerDeferred as exc:
+            # it is worth sending later, rather than failing now
+            retry_later(recipient_name, recipient_email, subject, body,
+                        body_html=body_html, headers=headers, error=exc)
+            model.Session.commit()
+            return
+    model.Session.add(OutboxMessage(
+        recipient_name=recipient_name,
+        recipient_email=recipient_email,
+        subject=subject,
+        body=body,
+        body_html=body_html,
+        headers=headers or {},
+    ))
+    model.Session.commit()
+    log.debug('Queued email to {}'.format(recipient_email))
+
+
+def queue(messages):
+    '''Adds emails to the outbox, a batch at a time, without committing - so
+    the caller can commit them in the same transaction as the work that
+    produced them.
+
+    :param messages: iterable of dicts of the parameters of deliver()
+
+    :returns: the number of emails queued
+    '''
+    messages = iter(messages)
+    num_queued = 0
+    while True:
+        batch = list(islice(messages, BATCH_SIZE))
+        if not batch:
+            return num_queued
+        for message in batch:
+            message.setdefault('headers', {})
+        model.Session.execute(subscribe_model.outbox_table.insert(), batch)
+        num_queued += len(batch)
+
+
+def retry_later(recipient_name, recipient_email, subject, body,
+                body_html=None, headers=None, error=None):
+    '''Adds an email that has just failed to send to the outbox, to be
+    retried later, like one the worker failed to send. This is used whether
+    or not the outbox is enabled - see notification.retry_failed_emails().
+    (The caller needs to commit.)
+
+    :param error: the MailerException it failed with. If it was deferred
+        (MailerDeferred), it is retried when the deferral says, and it doesn't
+        count as an attempt.
+    '''
+    if isinstance(error, mailer.MailerDeferred):
+        attempts = 0
+        next_attempt_at = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=error.retry_after)
+    else:
+        attempts = 1
+        next_attempt_at = datetime.datetime.utcnow() + get_retry_delay(1)
+    model.Session.add(OutboxMessage(
+        recipient_name=recipient_name,
+        recipient_email=recipient_email,
+        subject=subject,
+        body=body,
+        body_html=body_html,
+        headers=headers or {},
+        attempts=attempts,
+        last_error=u'{}'.format(error) if error else None,
+        next_attempt_at=next_attempt_at,
+    ))
+
+
+def get_worker_id():
+    return u'{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def get_lease_duration():
+    return datetime.timedelta(
+        seconds=int(config.get('ckanext.subscribe.outbox.lease', 300)))
+
+
+def send_pending(worker_id=None):
+    '''Sends the emails waiting in the outbox that are due, oldest first, a
+    claimed batch at a time - see claim_batch(). Any number of workers can do
+    this at once.
+
+    :param worker_id: identifies this worker in the claims (optional)
+
+    :returns: (number sent, number failed)
+    '''
+    global _last_pruned
+    now = datetime.datetime.utcnow()
+    if _last_pruned is None or now - _last_pruned >= PRUNE_INTERVAL:
+        prune(now)
+        _last_pruned = now
+    worker_id = worker_id or get_worker_id()
+    num_sent = num_failed = 0
+    while True:
+        messages = claim_batch(worker_id)
+        if not messages:
+            return num_sent, num_failed
+        for message in messages:
+            if datetime.datetime.utcnow() >= message.lease_expires:
+                # the rest may have been claimed by another worker by now
+                log.warning('Lease expired on outbox batch - releasing the '
+                            'remaining emails')
+                break
+            if send_message(message):
+                num_sent += 1
+            else:
+                num_failed += 1
+
+
+def prune(now=None):
+    '''Deletes the emails that were sent, or given up on, longer ago than
+    the retention period (see get_retention()), so that the outbox doesn't
+    keep growing. (Dead emails are aged from when they were created.)
+    send_pending() does this every PRUNE_INTERVAL.
+
+    :returns: the number of emails deleted
+    '''
+    now = now or datetime.datetime.utcnow()
+    cutoff = now - get_retention()
+    num_deleted = model.Session.query(OutboxMessage) \
+        .filter(OutboxMessage.status.in_([u'sent', u'dead'])) \
+        .filter(func.coalesce(OutboxMessage.sent,
+                              OutboxMessage.created) < cutoff) \
+        .delete(synchronize_session=False)
+    model.Session.commit()
+    if num_deleted:
+        log.info('Deleted {} old emails from the outbox'.format(num_deleted))
+    return num_deleted
+
+
+def any_due():
+    '''Returns whether there are any emails due to be sent - a cheap check,
+    to save claiming a batch when there are none.
+    '''
+    now = datetime.datetime.utcnow()
+    return _filter_due(model.Session.query(OutboxMessage.id), now) \
+        .first() is not None
+
+
+def _filter_due(query, now):
+    # pending, due a (re)try, and not claimed by a worker
+    return query \
+        .filter(OutboxMessage.status == u'pending') \
+        .filter(or_(OutboxMessage.next_attempt_at.is_(None),
+                    OutboxMessage.next_attempt_at <= now)) \
+        .filter(or_(OutboxMessage.lease_expires.is_(None),
+                    OutboxMessage.lease_expires <= now))
+
+
+def claim_batch(worker_id, batch_size=BATCH_SIZE):
+    '''Claims a batch of the due emails for this worker to send, by setting
+    a lease on them. Other workers skip leased emails, until the lease
+    expires - so if this worker dies, its emails are sent by another one.
+
+    On PostgreSQL the emails are selected with FOR UPDATE SKIP LOCKED, so
+    that concurrent workers each get a different batch without waiting. On
+    other databases the lease is set with a conditional UPDATE, and only the
+    emails it succeeded on are returned.
+
+    :returns: list of OutboxMessage, oldest first
+    '''
+    now = datetime.datetime.utcnow()
+    lease_expires = now + get_lease_duration()
+    due = _filter_due(model.Session.query(OutboxMessage.id), now) \
+        .order_by(OutboxMessage.created) \
+        .limit(batch_size)
+    claim = {'claimed_by': worker_id, 'lease_expires': lease_expires}
+    if model.Session.get_bind().dialect.name == 'postgresql':
+        ids = [id_ for id_, in due.with_for_update(skip_locked=True)]
+        model.Session.query(OutboxMessage) \
+            .filter(OutboxMessage.id.in_(ids)) \
+            .update(claim, synchronize_session=False)
+    else:
+        ids = [id_ for id_, in due]
+        # another worker may have claimed some of them since the select
+        model.Session.query(OutboxMessage) \
+            .filter(OutboxMessage.id.in_(ids)) \
+            .filter(or_(OutboxMessage.lease_expires.is_(None),
+                        OutboxMessage.lease_expires <= now)) \
+            .update(claim, synchronize_session=False)
+    model.Session.commit()
+    if not ids:
+        return []
+    return model.Session.query(OutboxMessage) \
+        .filter(OutboxMessage.id.in_(ids)) \
+        .filter_by(**claim) \
+        .order_by(OutboxMessage.created) \
+        .populate_existing() \
+        .all()
+
+
+def send_message(message):
+    '''Sends an outbox message and records the outcome. If it fails, it is
+    scheduled for a retry, or if it has had too many attempts, marked dead.
+    If it is deferred, it is rescheduled - see defer_message().
+
+    :returns: whether it was sent
+    '''
+    message.claimed_by = message.lease_expires = None
+    try:
+        mailer.mail_recipient(recipient_name=message.recipient_name,
+                              recipient_email=message.recipient_email,
+                              subject=message.subject,
+                              body=message.body,
+                              body_html=message.body_html,
+                              headers=message.headers)
+    except mailer.MailerDeferred as exc:
+        defer_message(message, exc)
+        model.Session.commit()
+        return False
+    except MailerException as exc:
+        message.attempts += 1
+        message.last_error = u'{}'.format(exc)
+        if message.attempts >= get_max_attempts():
+            log.error('Could not send email to {} - giving up after {} '
+                      'attempts: {}'.format(message.recipient_email,
+                                            message.attempts, exc))
+            message.status = u'dead'
+            message.next_attempt_at = None
+        else:
+            message.next_attempt_at = datetime.datetime.utcnow() + \
+                get_retry_delay(message.attempts)
+            log.warning('Could not send email to {} - will retry at {}: {}'
+                        .format(message.recipient_email,
+                                message.next_attempt_at, exc))
+        model.Session.commit()
+        return False
+    message.attempts += 1
+    message.status = u'sent'
+    message.next_attempt_at = None
+    message.sent = datetime.datetime.utcnow()
+    model.Session.commit()
+    return True
+
+
+def defer_message(message, deferred):
+    '''Reschedules an outbox message that was deferred (see
+    mailer.MailerDeferred) for when the deferral says. Deferrals don't count
+    as attempts, but the message is given up on if it is still being
+    deferred after MAX_DEFERRAL_AGE.
+    '''
+    now = datetime.datetime.utcnow()
+    message.last_error = u'{}'.format(deferred)
+    if message.created and now - message.created >= MAX_DEFERRAL_AGE:
+        log.error('Could not send email to {} - giving up after it was '
+                  'deferred for {}: {}'.format(message.recipient_email,
+                                               MAX_DEFERRAL_AGE, deferred))
+        message.status = u'dead'
+        message.next_attempt_at = None
+        return
+    message.next_attempt_at = now + \
+        datetime.timedelta(seconds=deferred.retry_after)
+    log.info('Email to {} deferred until {}: {}'.format(
+        message.recipient_email, message.next_attempt_at, deferred))
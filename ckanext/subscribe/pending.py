@@ -0,0 +1,79 @@
+# encoding: utf-8
+
+'''
+Pending notifications are a record of the objects that have changed and have
+immediate subscribers. They are written by the plugin's hooks, as datasets,
+groups and orgs change, so the immediate notifications only need to look at
+the activity of those objects, rather than scanning all the recent activity -
+and when there are none, there is nothing to do.
+
+They are only recorded and used if ckanext.subscribe.push_notifications is
+enabled. (Activity that doesn't go through the action functions, and so the
+hooks, is only picked up by the daily and weekly notifications.)
+'''
+
+from sqlalchemy import and_, exists
+
+from ckan import model
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.model import Subscription, Frequency
+from ckanext.subscribe.notification import (
+    get_config,
+    expand_subscriptions_query,
+    use_object_index,
+)
+
+log = __import__('logging').getLogger(__name__)
+
+
+def is_enabled():
+    return get_config('push_notifications')
+
+
+def add_for_package(package_id):
+    '''Records that a dataset has changed, if anyone is subscribed to it
+    (directly or via its org or groups) for immediate notifications.
+    (The caller needs to commit.)
+    '''
+    criteria = [Subscription.verified.is_(True),
+                Subscription.frequency == Frequency.IMMEDIATE.value]
+    model.Session.flush()
+    if use_object_index():
+        index_table = subscribe_model.subscription_object_index_table
+        subscribed = model.Session.query(
+            exists().where(and_(
+                index_table.c.object_id == package_id,
+                index_table.c.subscription_id == Subscription.id,
+                *criteria))).scalar()
+    else:
+        subscribed = model.Session.execute(
+            expand_subscriptions_query(criteria, package_id=package_id)
+            .limit(1)).first() is not None
+    if subscribed:
+        _add(package_id)
+
+
+def add_for_group(group_id):
+    '''Records that a group or org has changed, if anyone is subscribed to it
+    for immediate notifications. (The caller needs to commit.)
+    '''
+    subscribed = model.Session.query(
+        exists().where(and_(
+            Subscription.object_id == group_id,
+            Subscription.verified.is_(True),
+            Subscription.frequency == Frequency.IMMEDIATE.value))).scalar()
+    if subscribed:
+        _add(group_id)
+
+
+def _add(object_id):
+    model.Session.execute(
+        subscribe_model.pending_notification_table.insert()
+        .values(object_id=object_id))
+    log.debug('Pending notification for {}'.format(object_id))
+
+
+def any_pending():
+    table = subscribe_model.pending_notification_table
+    return model.Session.query(table.c.id).first() is not None
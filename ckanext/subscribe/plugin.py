@@ -1,10 +1,15 @@
 # encoding: utf-8
 from ckan import plugins
+from ckan import model
 from ckan.plugins import toolkit
 
 from ckanext.subscribe import action, cli
 from ckanext.subscribe import auth
+from ckanext.subscribe import email_auth
+from ckanext.subscribe import object_index
+from ckanext.subscribe import pending
 from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import migration
 from ckanext.subscribe.controller import SubscribeController
 from ckanext.subscribe.constants import IS_CKAN_29_OR_HIGHER
 
@@ -16,10 +21,14 @@ if IS_CKAN_29_OR_HIGHER:
 
 class SubscribePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IRoutes)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.ITemplateHelpers)
+    plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IGroupController, inherit=True)
+    plugins.implements(plugins.IOrganizationController, inherit=True)
 
     if IS_CKAN_29_OR_HIGHER:
         plugins.implements(plugins.IBlueprint)
@@ -61,7 +70,15 @@ class SubscribePlugin(plugins.SingletonPlugin):
         toolkit.add_public_directory(config_, 'public')
         toolkit.add_resource('fanstatic', 'subscribe')
 
-        subscribe_model.setup()
+        # The tables are created and upgraded by the initdb and migrate
+        # commands - here they just need defining, and a check that they are
+        # up to date
+        subscribe_model.setup_definitions()
+        migration.check_version()
+
+    # IConfigurable
+    def configure(self, config_):
+        email_auth.check_config()
 
     # IRoutes
     def before_map(self, l_map):
@@ -99,8 +116,52 @@ class SubscribePlugin(plugins.SingletonPlugin):
             action.subscribe_request_manage_code,
             'subscribe_send_any_notifications':
             action.subscribe_send_any_notifications,
+            # chained, to keep the subscription object index up to date
+            'member_create': action.member_create,
+            'member_delete': action.member_delete,
+            'package_owner_org_update': action.package_owner_org_update,
         }
 
+    # IPackageController
+    def after_create(self, context, pkg_dict):
+        self._package_changed(pkg_dict)
+
+    def after_update(self, context, pkg_dict):
+        self._package_changed(pkg_dict)
+
+    def after_delete(self, context, pkg_dict):
+        self._package_changed(pkg_dict)
+
+    @staticmethod
+    def _package_changed(pkg_dict):
+        if not (object_index.is_enabled() or pending.is_enabled()):
+            return
+        # pkg_dict['id'] might be the name, for after_delete
+        pkg = model.Package.get(pkg_dict['id'])
+        if not pkg:
+            return
+        if object_index.is_enabled():
+            object_index.refresh_package(pkg.id)
+        if pending.is_enabled():
+            pending.add_for_package(pkg.id)
+
+    # IGroupController, IOrganizationController
+    # (IPackageController also has edit() and delete(), so check the type)
+    def edit(self, entity):
+        if isinstance(entity, model.Group):
+            self._group_changed(entity)
+
+    def delete(self, entity):
+        if isinstance(entity, model.Group):
+            self._group_changed(entity)
+
+    @staticmethod
+    def _group_changed(group):
+        if object_index.is_enabled():
+            object_index.refresh_group(group.id)
+        if pending.is_enabled():
+            pending.add_for_group(group.id)
+
     # IAuthFunctions
     def get_auth_functions(self):
         return {
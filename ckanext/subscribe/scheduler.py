@@ -0,0 +1,157 @@
+# encoding: utf-8
+
+'''
+The scheduler is a long-running process that sends the notifications as they
+become due:
+
+    ckan subscribe send-any-notifications -r
+
+Rather than checking everything at a fixed interval, it works out when the
+next daily and weekly notifications are due, and sleeps until then. For the
+immediate notifications it just checks if there is any new activity (a cheap
+query) and only does the full check when there is. While there is no
+activity, it checks less and less often, up to a maximum interval - so an
+immediate notification can wait up to that long. With push notifications
+(see pending.py) the check is cheaper still, so it doesn't back off.
+
+It stops when sent SIGTERM (or SIGINT), after finishing any notifications it
+is in the middle of sending.
+
+If run on several nodes, only the leader sends notifications - see leader.py.
+If it loses the lease part way through a run, it stops the run, leaving the
+rest to the new leader.
+'''
+
+import datetime
+import threading
+
+import ckan.plugins as p
+from ckan import model
+from ckan.model import Activity
+
+from ckanext.subscribe import leader
+from ckanext.subscribe import notification
+from ckanext.subscribe import outbox
+from ckanext.subscribe import pending
+from ckanext.subscribe.model import Frequency
+
+log = __import__('logging').getLogger(__name__)
+
+config = p.toolkit.config
+
+
+def get_min_poll_interval():
+    return int(config.get('ckanext.subscribe.scheduler.min_poll_interval',
+                          10))
+
+
+def get_max_poll_interval():
+    return int(config.get('ckanext.subscribe.scheduler.max_poll_interval',
+                          60))
+
+
+def has_new_activity(now=None):
+    '''Returns whether there has been any activity since the immediate
+    notifications were last sent (i.e. if they might need sending). With push
+    notifications, that is whether there are any pending notifications.
+    '''
+    if pending.is_enabled():
+        return pending.any_pending()
+    now = now or datetime.datetime.now()
+    activity_from = notification.get_include_activity_from(
+        Frequency.IMMEDIATE, now)
+    return model.Session.query(Activity.id) \
+        .filter(Activity.timestamp > activity_from) \
+        .first() is not None
+
+
+def next_deadline(frequency, now=None):
+    '''Returns when the daily or weekly notifications are next due (which
+    is now, if they are overdue)
+    '''
+    now = now or datetime.datetime.now()
+    if frequency == Frequency.DAILY:
+        if notification.is_it_time_to_send_daily_notifications(now):
+            return now
+        return notification.most_recent_daily_notification_datetime(now) + \
+            datetime.timedelta(days=1)
+    if notification.is_it_time_to_send_weekly_notifications(now):
+        return now
+    return notification.most_recent_weekly_notification_datetime(now) + \
+        datetime.timedelta(days=7)
+
+
+class Scheduler(object):
+    def __init__(self):
+        self._stop = threading.Event()
+        # {frequency: datetime} - when the daily and weekly notifications are
+        # next due
+        self.deadlines = {}
+        self.poll_interval = get_min_poll_interval()
+
+    def stop(self, *args):
+        '''Asks the scheduler to stop. (Can be used as a signal handler.)'''
+        log.info('Scheduler stopping')
+        self._stop.set()
+
+    def run(self):
+        with leader.Leadership(leader.SCHEDULER) as leadership:
+            while not self._stop.is_set():
+                if leadership.is_leader():
+                    try:
+                        wait = self.run_once(leadership=leadership)
+                    except leader.LostLeadership as e:
+                        log.warning('Notification run stopped: {}'.format(e))
+                        model.Session.remove()
+                        self.deadlines = {}
+                        wait = get_min_poll_interval()
+                else:
+                    # the leader may change the deadlines
+                    self.deadlines = {}
+                    wait = get_min_poll_interval()
+                log.debug('Scheduler sleeping for {}s'.format(wait))
+                self._stop.wait(wait)
+
+    def run_once(self, now=None, leadership=None):
+        '''Sends any notifications that are due.
+
+        :param leadership: the leader.Leadership, to check while sending
+            (optional)
+
+        :returns: seconds to wait before the next check
+        :raises LostLeadership: if the lease was lost while sending
+        '''
+        now = now or datetime.datetime.now()
+        frequencies = []
+        if has_new_activity(now):
+            frequencies.append(Frequency.IMMEDIATE)
+        for frequency in (Frequency.DAILY, Frequency.WEEKLY):
+            if frequency not in self.deadlines:
+                self.deadlines[frequency] = next_deadline(frequency, now)
+            if self.deadlines[frequency] <= now:
+                frequencies.append(frequency)
+
+        if frequencies:
+            notification.send_notifications(frequencies,
+                                            leadership=leadership)
+            for frequency in frequencies:
+                self.deadlines.pop(frequency, None)
+            self.poll_interval = get_min_poll_interval()
+        else:
+            # (send_notifications() does this too) - only if there are any
+            # due, which is cheap to check, to keep the idle load down
+            if not outbox.is_enabled() and outbox.any_due():
+                notification.retry_failed_emails()
+            if not pending.is_enabled():
+                # probing the pending notifications is cheap enough to keep
+                # doing at the min interval
+                self.poll_interval = min(self.poll_interval * 2,
+                                         get_max_poll_interval())
+        # release the connection while sleeping
+        model.Session.remove()
+
+        seconds_to_deadline = min(
+            (deadline - now).total_seconds()
+            for deadline in self.deadlines.values()) \
+            if self.deadlines else self.poll_interval
+        return max(0, min(self.poll_interval, seconds_to_deadline))
@@ -16,6 +16,7 @@ from ckanext.subscribe.tests.factories import (
     DatasetActivity,
     )
 from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import migration
 
 
 @pytest.mark.usefixtures('reset_db', 'with_plugins')
@@ -44,6 +45,25 @@ class TestSubscribeSignup(object):
             .get(subscription['id'])
         assert subscription_obj
 
+    @mock.patch('ckanext.subscribe.migration._up_to_date', False)
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_refused_if_the_tables_need_migrating(self, send_request_email):
+        dataset = factories.Dataset()
+        model.meta.engine.execute(
+            subscribe_model.migration_table.delete()
+            .where(subscribe_model.migration_table.c.version ==
+                   migration.latest_version()))
+
+        with pytest.raises(migration.SchemaOutOfDate):
+            helpers.call_action(
+                'subscribe_signup',
+                {},
+                email='bob@example.com',
+                dataset_id=dataset['id'],
+            )
+
+        send_request_email.assert_not_called()
+
     @mock.patch('ckanext.subscribe.email_verification.send_request_email')
     def test_dataset_name(self, send_request_email):
         dataset = factories.Dataset()
@@ -171,6 +191,22 @@ class TestSubscribeSignup(object):
         assert subscription['email'] == 'bob@example.com'
         assert not subscription['verified']
 
+    @mock.patch('ckanext.subscribe.email_verification.send_request_email')
+    def test_signup_again_changes_frequency(self, send_request_email):
+        dataset = factories.Dataset()
+        first = helpers.call_action(
+            'subscribe_signup', {}, email='bob@example.com',
+            dataset_id=dataset['id'], frequency='immediate')
+
+        second = helpers.call_action(
+            'subscribe_signup', {}, email='bob@example.com',
+            dataset_id=dataset['id'], frequency='weekly')
+
+        assert second['id'] == first['id']
+        assert second['frequency'] == 'WEEKLY'
+        assert model.Session.query(subscribe_model.Subscription) \
+            .filter_by(email='bob@example.com').count() == 1
+
     @mock.patch('ckanext.subscribe.email_verification.send_request_email')
     def test_dataset_doesnt_exist(self, send_request_email):
         with pytest.raises(ValidationError) as cm:
@@ -0,0 +1,103 @@
+# encoding: utf-8
+
+import datetime
+
+import pytest
+
+from ckan.tests import helpers
+from ckan import model
+from ckan.exceptions import CkanConfigurationException
+
+from ckanext.subscribe import email_auth
+from ckanext.subscribe import model as subscribe_model
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSignedCodes(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    @helpers.change_config('ckanext.subscribe.signed_codes', 'true')
+    @helpers.change_config('ckanext.subscribe.code_secret', 'secret')
+    def test_round_trip(self):
+        code = email_auth.create_code('bob@example.com')
+
+        assert email_auth.authenticate_with_code(code) == 'bob@example.com'
+        assert model.Session.query(subscribe_model.LoginCode).count() == 0
+
+    @helpers.change_config('ckanext.subscribe.signed_codes', 'true')
+    @helpers.change_config('ckanext.subscribe.code_secret', 'secret')
+    def test_create_codes(self):
+        codes = email_auth.create_codes(['a@example.com', 'b@example.com'])
+
+        assert dict(
+            (email, email_auth.authenticate_with_code(code))
+            for email, code in codes.items()) == {
+                'a@example.com': 'a@example.com',
+                'b@example.com': 'b@example.com'}
+        assert model.Session.query(subscribe_model.LoginCode).count() == 0
+
+    @helpers.change_config('ckanext.subscribe.signed_codes', 'true')
+    @helpers.change_config('ckanext.subscribe.code_secret', 'secret')
+    def test_tampered(self):
+        code = email_auth.create_code('bob@example.com')
+        other_code = email_auth.create_code('mallory@example.com')
+        forged_code = other_code.split('.')[0] + '.' + code.split('.')[1]
+
+        with pytest.raises(ValueError) as exc:
+            email_auth.authenticate_with_code(forged_code)
+        assert 'Code not recognized' in str(exc.value)
+
+    @helpers.change_config('ckanext.subscribe.signed_codes', 'true')
+    @helpers.change_config('ckanext.subscribe.code_secret', 'secret')
+    def test_expired(self):
+        code = email_auth.make_signed_code(
+            'bob@example.com',
+            expires=datetime.datetime.now() - datetime.timedelta(minutes=1))
+
+        with pytest.raises(ValueError) as exc:
+            email_auth.authenticate_with_code(code)
+        assert 'Code expired' in str(exc.value)
+
+    @helpers.change_config('ckanext.subscribe.signed_codes', 'true')
+    @helpers.change_config('ckanext.subscribe.code_secret', 'secret')
+    def test_non_ascii_signature(self):
+        code = email_auth.create_code('bob@example.com')
+        code = code.split('.')[0] + u'.\u00e9'
+
+        with pytest.raises(ValueError) as exc:
+            email_auth.authenticate_with_code(code)
+        assert 'Code not recognized' in str(exc.value)
+
+    def test_no_secret(self):
+        with helpers.changed_config('ckanext.subscribe.code_secret', 'one'):
+            code = email_auth.make_signed_code('bob@example.com')
+
+        with helpers.changed_config('ckanext.subscribe.code_secret', ''), \
+                helpers.changed_config('beaker.session.secret', ''):
+            with pytest.raises(ValueError):
+                email_auth.authenticate_with_code(code)
+
+    @helpers.change_config('ckanext.subscribe.signed_codes', 'true')
+    @helpers.change_config('ckanext.subscribe.code_secret', '')
+    @helpers.change_config('beaker.session.secret', '')
+    def test_config_is_checked(self):
+        with pytest.raises(CkanConfigurationException):
+            email_auth.check_config()
+
+    def test_other_secret(self):
+        with helpers.changed_config('ckanext.subscribe.code_secret', 'one'):
+            code = email_auth.make_signed_code('bob@example.com')
+
+        with helpers.changed_config('ckanext.subscribe.code_secret', 'two'):
+            with pytest.raises(ValueError):
+                email_auth.authenticate_with_code(code)
+
+    def test_database_code_still_works(self):
+        code = email_auth.create_code('bob@example.com')
+
+        with helpers.changed_config('ckanext.subscribe.signed_codes', 'true'):
+            assert email_auth.authenticate_with_code(code) == \
+                'bob@example.com'
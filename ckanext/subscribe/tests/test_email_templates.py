@@ -0,0 +1,64 @@
+# encoding: utf-8
+
+import mock
+
+from ckanext.subscribe import email_templates
+
+
+class TestRender(object):
+
+    def setup(self):
+        email_templates._environment = None
+
+    def teardown(self):
+        email_templates._environment = None
+
+    def test_basic(self):
+        body = email_templates.render(
+            'footer.txt', object_type='dataset', object_title='Spending',
+            unsubscribe_link='http://unsubscribe', manage_link='http://manage')
+
+        assert 'dataset: "Spending" by going to http://unsubscribe' in body
+        assert 'Manage your settings at http://manage' in body
+
+    def test_html_is_escaped(self):
+        body = email_templates.render(
+            'subscription_confirmation.html', object_type='dataset',
+            object_title='<script>alert(1)</script>', object_name='spending',
+            object_link='http://dataset', email='bob@example.com',
+            manage_link='http://manage?a=1&b=2', html_footer='<p>footer</p>')
+
+        assert '<script>' not in body
+        assert '&lt;script&gt;alert(1)&lt;/script&gt;' in body
+        assert 'http://manage?a=1&amp;b=2' in body
+        # the footer is HTML already
+        assert '<p>footer</p>' in body
+
+    def test_text_is_not_escaped(self):
+        body = email_templates.render(
+            'subscription_confirmation.txt', object_type='dataset',
+            object_title='Spending & Income', object_name='spending',
+            object_link='http://dataset', email='bob@example.com',
+            manage_link='http://manage?a=1&b=2', plain_text_footer='footer')
+
+        assert 'Spending & Income' in body
+        assert 'http://manage?a=1&b=2' in body
+
+    def test_site_override(self, tmpdir):
+        tmpdir.mkdir('subscribe').mkdir('emails') \
+            .join('footer.txt').write('Custom footer {{ manage_link }}')
+
+        with mock.patch.dict(email_templates.config,
+                             {'computed_template_paths': [str(tmpdir)]}):
+            body = email_templates.render(
+                'footer.txt', manage_link='http://manage')
+
+        assert body == 'Custom footer http://manage'
+
+    def test_compiled_once(self):
+        email_templates.render('footer.txt', manage_link='http://manage')
+
+        with mock.patch('jinja2.Environment.compile') as compile_:
+            email_templates.render('footer.txt', manage_link='http://manage')
+
+        compile_.assert_not_called()
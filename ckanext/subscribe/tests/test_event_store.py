@@ -0,0 +1,102 @@
+# encoding: utf-8
+
+import datetime
+
+import mock
+import pytest
+
+from ckan.tests import helpers
+from ckan import model
+
+from ckanext.subscribe import event_store
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import notification as subscribe_notification
+from ckanext.subscribe.model import Event
+from ckanext.subscribe.tests import factories
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSync(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def teardown(self):
+        subscribe_notification._config = {}
+
+    def test_activity_is_copied(self):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+
+        event_store.sync()
+
+        event = Event.get(activity.id)
+        assert event.id == activity.id
+        assert event.object_id == dataset['id']
+        assert event.package_id == dataset['id']
+        assert event.activity_type == 'new package'
+        assert event.name == dataset['name']
+        assert event.title == dataset['title']
+
+    def test_incremental(self):
+        factories.DatasetActivity()
+        event_store.sync()
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+
+        event_store.sync()
+
+        assert Event.get(activity.id)
+        assert model.Session.query(Event).count() == \
+            model.Session.query(model.Activity).count()
+
+    def test_old_activity_is_not_copied(self):
+        dataset, activity = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(days=30),
+            return_activity=True)
+
+        event_store.backfill()
+
+        assert Event.get(activity.id) is None
+
+    def test_old_events_are_pruned(self):
+        model.Session.execute(subscribe_model.event_table.insert().values(
+            id='old', object_id='dataset', activity_type='new package',
+            timestamp=datetime.datetime.now() - datetime.timedelta(days=30)))
+
+        event_store.sync()
+
+        assert Event.get('old') is None
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestNotificationsFromEventStore(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def teardown(self):
+        subscribe_notification._config = {}
+
+    @helpers.change_config('ckanext.subscribe.event_store', 'true')
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_immediate(self, send_notification_email):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+        factories.Subscription(dataset_id=dataset['id'])
+
+        subscribe_notification.send_any_immediate_notifications()
+
+        code, email, notifications = send_notification_email.call_args[0]
+        assert email == 'bob@example.com'
+        assert notifications[0]['activities'] == [{
+            'id': activity.id,
+            'object_id': dataset['id'],
+            'timestamp': activity.timestamp.isoformat(),
+            'activity_type': 'new package',
+            'data': {'package': {'id': dataset['id'],
+                                 'name': dataset['name'],
+                                 'title': dataset['title']}},
+        }]
+        assert model.Session.query(Event).count() == 1
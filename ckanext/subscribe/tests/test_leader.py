@@ -0,0 +1,85 @@
+# encoding: utf-8
+
+import datetime
+
+import mock
+import pytest
+
+from ckan.tests import helpers
+from ckan import model
+
+from ckanext.subscribe import leader
+from ckanext.subscribe import model as subscribe_model
+
+
+def _expire_leases():
+    model.meta.engine.execute(subscribe_model.lock_table.update().values(
+        expires=datetime.datetime.utcnow()))
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestTryAcquire(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_only_one_holder(self):
+        assert leader.try_acquire('scheduler', 'node1') is True
+        assert leader.try_acquire('scheduler', 'node2') is False
+        # renew
+        assert leader.try_acquire('scheduler', 'node1') is True
+
+    def test_locks_are_separate(self):
+        assert leader.try_acquire('scheduler', 'node1') is True
+        assert leader.try_acquire('other', 'node2') is True
+
+    def test_expired_lease_is_taken_over(self):
+        leader.try_acquire('scheduler', 'node1')
+        _expire_leases()
+
+        assert leader.try_acquire('scheduler', 'node2') is True
+        assert leader.try_acquire('scheduler', 'node1') is False
+
+    def test_release(self):
+        leader.try_acquire('scheduler', 'node1')
+        leader.release('scheduler', 'node2')
+        assert leader.try_acquire('scheduler', 'node2') is False
+
+        leader.release('scheduler', 'node1')
+        assert leader.try_acquire('scheduler', 'node2') is True
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestLeadership(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_one_leader(self):
+        with leader.Leadership('scheduler', 'node1') as leadership1:
+            with leader.Leadership('scheduler', 'node2') as leadership2:
+                assert leadership1.is_leader() is True
+                assert leadership2.is_leader() is False
+
+    def test_released_on_exit(self):
+        with leader.Leadership('scheduler', 'node1'):
+            pass
+
+        with leader.Leadership('scheduler', 'node2') as leadership:
+            assert leadership.is_leader() is True
+
+    @mock.patch('ckanext.subscribe.leader.time')
+    def test_lost_when_the_lease_runs_out(self, time_):
+        time_.return_value = 1000
+        with leader.Leadership('scheduler', 'node1') as leadership:
+            leadership.check()
+
+            # the heartbeat hasn't renewed it in time
+            time_.return_value = 1000 + \
+                leader.get_lease_duration().total_seconds()
+
+            assert leadership.is_leader() is False
+            with pytest.raises(leader.LostLeadership):
+                leadership.check()
@@ -0,0 +1,213 @@
+# encoding: utf-8
+
+import smtplib
+import socket
+
+import mock
+import pytest
+
+from ckan.lib.mailer import MailerException
+
+from ckanext.subscribe.mailer import (
+    SMTPConnectionPool,
+    MailerDeferred,
+    TokenBucket,
+    SendLimiter,
+)
+
+
+@pytest.mark.usefixtures('with_plugins')
+class TestSMTPConnectionPool(object):
+
+    @mock.patch('smtplib.SMTP')
+    def test_connection_is_reused(self, smtp):
+        pool = SMTPConnectionPool(size=1)
+
+        pool.sendmail('from@example.com', 'a@example.com', 'msg')
+        pool.sendmail('from@example.com', 'b@example.com', 'msg')
+
+        assert smtp.call_count == 1
+        assert smtp.return_value.ehlo.call_count == 1
+        assert smtp.return_value.sendmail.call_count == 2
+
+    @mock.patch('smtplib.SMTP')
+    def test_connection_recycled_after_max_messages(self, smtp):
+        pool = SMTPConnectionPool(size=1, max_messages=2)
+
+        for _ in range(3):
+            pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+        assert smtp.call_count == 2
+        assert smtp.return_value.quit.call_count == 1
+
+    @mock.patch('ckanext.subscribe.mailer.time')
+    @mock.patch('smtplib.SMTP')
+    def test_connection_recycled_after_max_age(self, smtp, time_):
+        pool = SMTPConnectionPool(size=1, max_age=60)
+        time_.return_value = 1000
+        pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+        time_.return_value = 1061
+        pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+        assert smtp.call_count == 2
+
+    @mock.patch('smtplib.SMTP')
+    def test_reconnects_after_server_disconnect(self, smtp):
+        pool = SMTPConnectionPool(size=1)
+        pool.sendmail('from@example.com', 'a@example.com', 'msg')
+        smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPServerDisconnected('gone'), {}]
+
+        pool.sendmail('from@example.com', 'b@example.com', 'msg')
+
+        assert smtp.call_count == 2
+        assert smtp.return_value.sendmail.call_count == 3
+
+    @mock.patch('smtplib.SMTP')
+    def test_smtp_error_raises_mailer_exception(self, smtp):
+        pool = SMTPConnectionPool(size=1)
+        smtp.return_value.sendmail.side_effect = \
+            smtplib.SMTPRecipientsRefused({})
+
+        with pytest.raises(MailerException):
+            pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+        # the bad connection is dropped, and the slot is freed up
+        smtp.return_value.sendmail.side_effect = None
+        pool.sendmail('from@example.com', 'a@example.com', 'msg')
+        assert smtp.call_count == 2
+
+    @mock.patch('smtplib.SMTP')
+    def test_socket_error_after_reconnect_raises_mailer_exception(self, smtp):
+        pool = SMTPConnectionPool(size=1)
+        smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPServerDisconnected('gone'), socket.timeout('timed out')]
+
+        with pytest.raises(MailerException):
+            pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+        # the bad connection is dropped, and the slot is freed up
+        smtp.return_value.sendmail.side_effect = None
+        pool.sendmail('from@example.com', 'a@example.com', 'msg')
+        assert smtp.call_count == 3
+
+    @mock.patch('smtplib.SMTP')
+    def test_socket_error_during_handshake_raises_mailer_exception(self, smtp):
+        pool = SMTPConnectionPool(size=1)
+        smtp.return_value.ehlo.side_effect = socket.timeout('timed out')
+
+        with pytest.raises(MailerException):
+            pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+    @mock.patch('smtplib.SMTP')
+    def test_4xx_reply_raises_mailer_deferred(self, smtp):
+        pool = SMTPConnectionPool(size=1)
+        smtp.return_value.sendmail.side_effect = \
+            smtplib.SMTPRecipientsRefused(
+                {'a@example.com': (450, 'Too many emails, slow down')})
+
+        with pytest.raises(MailerDeferred) as exc_info:
+            pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+        assert exc_info.value.recipient_only
+
+    @mock.patch('smtplib.SMTP')
+    def test_5xx_reply_is_not_deferred(self, smtp):
+        pool = SMTPConnectionPool(size=1)
+        smtp.return_value.sendmail.side_effect = \
+            smtplib.SMTPRecipientsRefused(
+                {'a@example.com': (550, 'No such user')})
+
+        with pytest.raises(MailerException) as exc_info:
+            pool.sendmail('from@example.com', 'a@example.com', 'msg')
+
+        assert not isinstance(exc_info.value, MailerDeferred)
+
+
+@mock.patch('ckanext.subscribe.mailer.sleep')
+@mock.patch('ckanext.subscribe.mailer.time')
+class TestTokenBucket(object):
+
+    def test_burst_is_not_delayed(self, time_, sleep):
+        time_.return_value = 1000
+        bucket = TokenBucket(rate=2, capacity=3)
+
+        for _ in range(3):
+            bucket.take()
+
+        sleep.assert_not_called()
+
+    def test_waits_for_tokens_after_burst(self, time_, sleep):
+        time_.return_value = 1000
+        bucket = TokenBucket(rate=2, capacity=1)
+
+        bucket.take()
+        bucket.take()
+        bucket.take()
+
+        assert [call[0][0] for call in sleep.call_args_list] == [0.5, 1.0]
+
+    def test_refills_over_time(self, time_, sleep):
+        time_.return_value = 1000
+        bucket = TokenBucket(rate=2, capacity=1)
+        bucket.take()
+
+        time_.return_value = 1000.5
+        bucket.take()
+
+        sleep.assert_not_called()
+
+
+@mock.patch('ckanext.subscribe.mailer.sleep')
+@mock.patch('ckanext.subscribe.mailer.time')
+class TestSendLimiter(object):
+
+    def test_domain_rate_is_per_domain(self, time_, sleep):
+        time_.return_value = 1000
+        limiter = SendLimiter(domain_max_rate=1)
+
+        for email in ('a@example.com', 'b@example.org', 'c@example.com'):
+            with limiter.limit(email):
+                pass
+
+        # only the second email to example.com waits
+        assert [call[0][0] for call in sleep.call_args_list] == [1.0]
+
+    def test_domain_concurrency(self, time_, sleep):
+        time_.return_value = 1000
+        limiter = SendLimiter(domain_concurrency=1)
+
+        with limiter.limit('a@example.com'):
+            slots = limiter._domain_slots['example.com']
+            assert not slots.acquire(False)
+        assert slots.acquire(False)
+
+    def test_deferral_holds_off_the_domain(self, time_, sleep):
+        time_.return_value = 1000
+        limiter = SendLimiter()
+
+        limiter.hold_off('a@example.com', MailerDeferred(
+            'slow down', retry_after=60, recipient_only=True))
+
+        with pytest.raises(MailerDeferred) as exc_info:
+            with limiter.limit('b@example.com'):
+                pass
+        assert exc_info.value.retry_after == 60
+        with limiter.limit('c@example.org'):
+            pass
+        time_.return_value = 1060
+        with limiter.limit('b@example.com'):
+            pass
+
+    def test_deferral_of_whole_email_holds_off_everything(self, time_, sleep):
+        time_.return_value = 1000
+        limiter = SendLimiter()
+
+        limiter.hold_off('a@example.com', MailerDeferred(
+            'service not available', retry_after=60))
+
+        with pytest.raises(MailerDeferred) as exc_info:
+            with limiter.limit('c@example.org'):
+                pass
+        assert not exc_info.value.recipient_only
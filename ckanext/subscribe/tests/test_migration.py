@@ -0,0 +1,148 @@
+# encoding: utf-8
+
+import datetime
+
+import pytest
+from sqlalchemy import inspect
+
+from ckan.tests import helpers
+from ckan.tests.factories import Dataset
+from ckan import model
+
+from ckanext.subscribe import migration
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.model import Frequency
+
+
+def _index_names(table):
+    return set(index['name']
+               for index in inspect(model.meta.engine).get_indexes(table.name))
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestUpgrade(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_new_install_is_up_to_date(self):
+        assert migration.current_version() == migration.latest_version()
+        assert migration.upgrade() == []
+
+    def test_indexes_are_added_to_an_old_install(self):
+        model.meta.engine.execute('DROP INDEX idx_subscription_email')
+        model.meta.engine.execute('DROP INDEX idx_subscribe_login_code_code')
+        model.meta.engine.execute(
+            subscribe_model.migration_table.delete()
+            .where(subscribe_model.migration_table.c.version >= 3))
+
+        assert migration.upgrade() == \
+            list(range(3, migration.latest_version() + 1))
+
+        assert 'idx_subscription_email' in \
+            _index_names(subscribe_model.subscription_table)
+        assert 'idx_subscribe_login_code_code' in \
+            _index_names(subscribe_model.login_code_table)
+        assert migration.current_version() == migration.latest_version()
+
+    def test_duplicate_subscriptions_are_merged(self):
+        dataset = Dataset()
+        model.meta.engine.execute('DROP INDEX idx_subscription_email_object')
+        subscription_table = subscribe_model.subscription_table
+        now = datetime.datetime.utcnow()
+        for i, (verified, frequency) in enumerate([
+                (False, Frequency.IMMEDIATE.value),
+                (True, Frequency.DAILY.value),
+                (False, Frequency.WEEKLY.value)]):
+            model.meta.engine.execute(subscription_table.insert().values(
+                id='sub{}'.format(i), email='bob@example.com',
+                object_type='dataset', object_id=dataset['id'],
+                verified=verified, frequency=frequency,
+                created=now + datetime.timedelta(minutes=i)))
+        model.meta.engine.execute(
+            subscribe_model.migration_table.delete()
+            .where(subscribe_model.migration_table.c.version >= 4))
+
+        migration.upgrade()
+
+        rows = model.meta.engine.execute(
+            subscription_table.select()).fetchall()
+        assert [(row.id, row.verified, row.frequency) for row in rows] == \
+            [('sub0', True, Frequency.WEEKLY.value)]
+        assert 'idx_subscription_email_object' in \
+            _index_names(subscription_table)
+
+    def test_outbox_retries_are_added(self):
+        model.meta.engine.execute(
+            'ALTER TABLE subscribe_outbox DROP COLUMN next_attempt_at')
+        model.meta.engine.execute(
+            subscribe_model.outbox_table.insert().values(
+                id='message1', recipient_email='bob@example.com',
+                subject='Subject', body='Body', status='failed'))
+        model.meta.engine.execute(
+            subscribe_model.migration_table.delete()
+            .where(subscribe_model.migration_table.c.version >= 6))
+
+        migration.upgrade()
+
+        rows = model.meta.engine.execute(
+            subscribe_model.outbox_table.select()).fetchall()
+        assert [(row.id, row.status, row.next_attempt_at)
+                for row in rows] == [('message1', 'dead', None)]
+
+    def test_install_without_migration_table(self):
+        subscribe_model.migration_table.drop(bind=model.meta.engine)
+
+        assert migration.current_version() == 0
+        assert migration.upgrade() == \
+            list(range(1, migration.latest_version() + 1))
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestCheckVersion(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_up_to_date(self):
+        assert migration.check_version() is True
+
+    def test_needs_migrating(self):
+        model.meta.engine.execute(
+            subscribe_model.migration_table.delete()
+            .where(subscribe_model.migration_table.c.version ==
+                   migration.latest_version()))
+
+        assert migration.check_version() is False
+
+    def test_no_migration_table(self):
+        subscribe_model.migration_table.drop(bind=model.meta.engine)
+
+        assert migration.check_version() is False
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestRequireCurrentVersion(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        migration._up_to_date = False
+
+    def teardown(self):
+        migration._up_to_date = False
+
+    def test_up_to_date(self):
+        migration.require_current_version()
+
+    def test_needs_migrating(self):
+        model.meta.engine.execute(
+            subscribe_model.migration_table.delete()
+            .where(subscribe_model.migration_table.c.version ==
+                   migration.latest_version()))
+
+        with pytest.raises(migration.SchemaOutOfDate) as exc:
+            migration.require_current_version()
+        assert 'ckan subscribe migrate' in str(exc.value)
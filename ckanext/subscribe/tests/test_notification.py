@@ -1,28 +1,34 @@
 # encoding: utf-8
 
 import datetime
+from collections import OrderedDict
 
 import pytest
 import mock
 
 from ckan.tests import helpers
+from ckan.lib.mailer import MailerException
 from ckan.tests.factories import Dataset, Organization, Group
 from ckan import model
 
 from ckanext.subscribe import model as subscribe_model
 from ckanext.subscribe.model import Frequency
 from ckanext.subscribe.notification import (
+    send_any_notifications,
     send_any_immediate_notifications,
     get_immediate_notifications,
     send_weekly_notifications_if_its_time_to,
     get_weekly_notifications,
     send_daily_notifications_if_its_time_to,
     get_daily_notifications,
+    get_objects_subscribed_to,
     send_emails,
     dictize_notifications,
     most_recent_weekly_notification_datetime,
 )
 from ckanext.subscribe import notification as subscribe_notification
+from ckanext.subscribe import email_auth
+from ckanext.subscribe import leader
 from ckanext.subscribe.tests import factories
 
 
@@ -52,6 +58,231 @@ class TestSendAnyImmediateNotifications(object):
             < datetime.timedelta(seconds=1)
 
 
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSendAnyNotifications(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_all_frequencies_due(self, send_notification_email):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'], email='a@example.com',
+                               frequency='immediate')
+        factories.Subscription(dataset_id=dataset['id'], email='b@example.com',
+                               frequency='daily')
+        factories.Subscription(dataset_id=dataset['id'], email='c@example.com',
+                               frequency='weekly')
+
+        send_any_notifications()
+
+        emails = sorted(call[0][1]
+                        for call in send_notification_email.call_args_list)
+        assert emails == ['a@example.com', 'b@example.com', 'c@example.com']
+        for frequency in Frequency:
+            assert time_since_emails_last_sent(frequency.value) \
+                < datetime.timedelta(seconds=1)
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_daily_not_due(self, send_notification_email):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'], email='a@example.com',
+                               frequency='immediate')
+        factories.Subscription(dataset_id=dataset['id'], email='b@example.com',
+                               frequency='daily')
+        subscribe_model.Subscribe.set_emails_last_sent(
+            frequency=Frequency.DAILY.value,
+            emails_last_sent=datetime.datetime.now())
+        model.Session.commit()
+
+        send_any_notifications()
+
+        emails = [call[0][1]
+                  for call in send_notification_email.call_args_list]
+        assert emails == ['a@example.com']
+
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_one_email_per_recipient(self, send_notification_email):
+        dataset1 = factories.DatasetActivity()
+        dataset2 = factories.DatasetActivity()
+        for email in ('b@example.com', 'a@example.com'):
+            for dataset in (dataset1, dataset2):
+                factories.Subscription(dataset_id=dataset['id'], email=email,
+                                       frequency='immediate')
+
+        send_any_notifications()
+
+        calls = [(call[0][1], len(call[0][2]))
+                 for call in send_notification_email.call_args_list]
+        assert calls == [('a@example.com', 2), ('b@example.com', 2)]
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_queued_in_outbox(self, mail_recipient):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'], email='a@example.com',
+                               frequency='immediate')
+        factories.Subscription(dataset_id=dataset['id'], email='b@example.com',
+                               frequency='daily')
+
+        send_any_notifications()
+
+        mail_recipient.assert_not_called()
+        messages = model.Session.query(subscribe_model.OutboxMessage).all()
+        assert sorted(message.recipient_email for message in messages) == \
+            ['a@example.com', 'b@example.com']
+        assert time_since_emails_last_sent(Frequency.IMMEDIATE.value) \
+            < datetime.timedelta(seconds=1)
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    def test_nothing_queued_if_it_fails_part_way(self):
+        dataset = factories.DatasetActivity()
+        for email in ('a@example.com', 'b@example.com'):
+            factories.Subscription(dataset_id=dataset['id'], email=email,
+                                   frequency='immediate')
+
+        with mock.patch(
+                'ckanext.subscribe.notification_email.'
+                'get_notification_email_contents',
+                side_effect=[('subject', 'body', 'html'),
+                             Exception('Render failed')]):
+            with pytest.raises(Exception):
+                send_any_notifications()
+        model.Session.rollback()
+
+        assert model.Session.query(subscribe_model.OutboxMessage).count() == 0
+        assert model.Session.query(subscribe_model.LoginCode).count() == 0
+        assert subscribe_model.Subscribe.get_emails_last_sent(
+            Frequency.IMMEDIATE.value) is None
+
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_stops_if_leadership_is_lost(self, mail_recipient):
+        dataset = factories.DatasetActivity()
+        for email in ('a@example.com', 'b@example.com'):
+            factories.Subscription(dataset_id=dataset['id'], email=email,
+                                   frequency='immediate')
+        leadership = mock.Mock()
+        leadership.check.side_effect = [None, leader.LostLeadership('lost')]
+
+        with pytest.raises(leader.LostLeadership):
+            subscribe_notification.send_notifications(
+                [Frequency.IMMEDIATE], leadership=leadership)
+
+        mail_recipient.assert_called_once()
+        assert subscribe_model.Subscribe.get_emails_last_sent(
+            Frequency.IMMEDIATE.value) is None
+
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_failed_email_is_retried_later(self, mail_recipient):
+        dataset = factories.DatasetActivity()
+        for email in ('a@example.com', 'b@example.com'):
+            factories.Subscription(dataset_id=dataset['id'], email=email,
+                                   frequency='immediate')
+        mail_recipient.side_effect = [MailerException('Mailbox unavailable'),
+                                      None]
+
+        send_any_notifications()
+
+        # the other email is still sent and the run is recorded as done
+        assert mail_recipient.call_count == 2
+        assert time_since_emails_last_sent(Frequency.IMMEDIATE.value) \
+            < datetime.timedelta(seconds=1)
+        message = model.Session.query(subscribe_model.OutboxMessage).one()
+        assert message.recipient_email == \
+            mail_recipient.call_args_list[0][1]['recipient_email']
+        assert message.status == u'pending'
+        assert message.attempts == 1
+        assert message.last_error == u'Mailbox unavailable'
+        assert message.next_attempt_at > datetime.datetime.utcnow()
+
+        # it is retried once it is due
+        message.next_attempt_at = datetime.datetime.utcnow()
+        model.Session.commit()
+        mail_recipient.side_effect = None
+        mail_recipient.reset_mock()
+
+        send_any_notifications()
+
+        mail_recipient.assert_called_once()
+        assert mail_recipient.call_args[1]['recipient_email'] == \
+            message.recipient_email
+        message = model.Session.query(subscribe_model.OutboxMessage) \
+            .populate_existing().one()
+        assert message.status == u'sent'
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSendJobs(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def teardown(self):
+        subscribe_notification._config = {}
+
+    @helpers.change_config('ckanext.subscribe.send_jobs', 'true')
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_jobs_carry_ids_and_send(self, send_notification_email,
+                                     enqueue_job):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+        subscription_a = factories.Subscription(
+            dataset_id=dataset['id'], email='a@example.com')
+        subscription_b = factories.Subscription(
+            dataset_id=dataset['id'], email='b@example.com')
+
+        send_any_immediate_notifications()
+
+        send_notification_email.assert_not_called()
+        enqueue_job.assert_called_once()
+        job_function, job_args = enqueue_job.call_args[0]
+        assert enqueue_job.call_args[1]['queue'] == 'subscribe'
+        assert job_args == [[
+            [(subscription_a['id'], [activity.id])],
+            [(subscription_b['id'], [activity.id])],
+        ]]
+        assert time_since_emails_last_sent(Frequency.IMMEDIATE.value) \
+            < datetime.timedelta(seconds=1)
+
+        # run the job, as a worker would
+        job_function(*job_args)
+
+        emails = [call[0][1]
+                  for call in send_notification_email.call_args_list]
+        assert emails == ['a@example.com', 'b@example.com']
+        notifications = send_notification_email.call_args[0][2]
+        assert [a['id'] for a in notifications[0]['activities']] == \
+            [activity.id]
+
+    @helpers.change_config('ckanext.subscribe.send_jobs', 'true')
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_job_skips_deleted_subscriptions(self, send_notification_email):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+
+        subscribe_notification.send_notifications_job(
+            [[('deleted-subscription', [activity.id])]])
+
+        send_notification_email.assert_not_called()
+
+    @helpers.change_config('ckanext.subscribe.send_jobs', 'true')
+    @mock.patch('ckan.plugins.toolkit.enqueue_job')
+    def test_batches(self, enqueue_job):
+        dataset = factories.DatasetActivity()
+        for i in range(5):
+            factories.Subscription(dataset_id=dataset['id'],
+                                   email='user{}@example.com'.format(i))
+
+        with mock.patch(
+                'ckanext.subscribe.notification.SEND_JOB_BATCH_SIZE', 2):
+            send_any_immediate_notifications()
+
+        assert [len(call[0][1][0])
+                for call in enqueue_job.call_args_list] == [2, 2, 1]
+
+
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
 class TestGetImmediateNotifications(object):
 
@@ -169,6 +400,80 @@ class TestGetImmediateNotifications(object):
         assert not _get_activities(notifies)
 
 
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestActivityProjection(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def teardown(self):
+        subscribe_notification._config = {}
+
+    @helpers.change_config('ckanext.subscribe.activity_projection', 'true')
+    def test_only_the_fields_used_are_fetched(self):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'])
+
+        notifies = get_immediate_notifications()
+
+        activity = notifies['bob@example.com'][0]['activities'][0]
+        assert activity['activity_type'] == 'new package'
+        assert activity['object_id'] == dataset['id']
+        assert activity['data'] == {'package': {
+            'id': dataset['id'],
+            'name': dataset['name'],
+            'title': dataset['title']}}
+
+    @helpers.change_config('ckanext.subscribe.activity_projection', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_email(self, mail_recipient):
+        dataset = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset['id'])
+
+        send_any_immediate_notifications()
+
+        mail_recipient.assert_called_once()
+        body = mail_recipient.call_args[1]['body']
+        assert 'new dataset' in body
+        assert dataset['title'] in body
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestGetObjectsSubscribedTo(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_org_and_group_are_expanded_to_their_datasets(self):
+        org = Organization()
+        group = Group()
+        org_dataset = Dataset(owner_org=org['id'])
+        group_dataset = Dataset(groups=[{'id': group['id']}])
+        org_subscription = factories.Subscription(organization_id=org['id'])
+        group_subscription = factories.Subscription(group_id=group['id'])
+
+        objects = get_objects_subscribed_to(Frequency.IMMEDIATE.value)
+
+        assert sorted(objects.keys()) == sorted([
+            org['id'], org_dataset['id'], group['id'], group_dataset['id']])
+        assert [s.id for s in objects[org_dataset['id']]] == \
+            [org_subscription['id']]
+        assert [s.id for s in objects[group_dataset['id']]] == \
+            [group_subscription['id']]
+
+    def test_other_frequencies_are_not_included(self):
+        org = Organization()
+        Dataset(owner_org=org['id'])
+        factories.Subscription(organization_id=org['id'], frequency='daily')
+
+        objects = get_objects_subscribed_to(Frequency.IMMEDIATE.value)
+
+        assert not objects
+
+
 def _create_dataset_and_activity(activity_in_minutes_ago=()):
     minutes_ago = activity_in_minutes_ago.pop(0)
     dataset = factories.DatasetActivity(
@@ -429,6 +734,10 @@ class TestSendEmails(object):
     def setup(self):
         helpers.reset_db()
         subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def teardown(self):
+        subscribe_notification._config = {}
 
     @mock.patch('ckanext.subscribe.mailer.mail_recipient')
     def test_basic(self, mail_recipient):
@@ -452,7 +761,166 @@ class TestSendEmails(object):
         body = mail_recipient.call_args[1]['body']
         assert 'new dataset' in body
 
+    @helpers.change_config('ckanext.subscribe.send_workers', '3')
+    @mock.patch('ckanext.subscribe.mailer.send_message')
+    def test_parallel(self, send_message):
+        dataset, activity = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10),
+            return_activity=True
+        )
+        notifications_by_email = {}
+        for i in range(5):
+            email = 'user{}@example.com'.format(i)
+            subscription_activities = {
+                factories.Subscription(dataset_id=dataset['id'], email=email,
+                                       return_object=True):
+                [activity]
+            }
+            notifications_by_email[email] = \
+                dictize_notifications(subscription_activities)
+
+        send_emails(notifications_by_email)
+
+        assert sorted(call[0][1] for call in send_message.call_args_list) == \
+            sorted(notifications_by_email.keys())
+        msg = send_message.call_args[0][0]
+        assert 'new dataset' in msg.as_string()
+
+    @helpers.change_config('ckanext.subscribe.send_workers', '3')
+    @mock.patch('ckanext.subscribe.mailer.send_message')
+    def test_parallel_failure_is_retried_later(self, send_message):
+        dataset, activity = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10),
+            return_activity=True
+        )
+        notifications_by_email = {}
+        for email in ('a@example.com', 'b@example.com'):
+            subscription_activities = {
+                factories.Subscription(dataset_id=dataset['id'], email=email,
+                                       return_object=True):
+                [activity]
+            }
+            notifications_by_email[email] = \
+                dictize_notifications(subscription_activities)
+
+        def send(msg, email):
+            if email == 'a@example.com':
+                raise MailerException('refused')
+        send_message.side_effect = send
+
+        num_emails = send_emails(notifications_by_email)
+
+        assert num_emails == 1
+        assert send_message.call_count == 2
+        message = model.Session.query(subscribe_model.OutboxMessage).one()
+        assert message.recipient_email == 'a@example.com'
+        assert message.last_error == u'refused'
+        assert 'new dataset' in message.body
+
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_failure_is_retried_later(self, mail_recipient):
+        dataset, activity = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10),
+            return_activity=True
+        )
+        subscription_activities = {
+            factories.Subscription(dataset_id=dataset['id'],
+                                   return_object=True):
+            [activity]
+        }
+        notifications_by_email = {
+            'bob@example.com': dictize_notifications(subscription_activities)
+        }
+        mail_recipient.side_effect = MailerException('refused')
+
+        num_emails = send_emails(notifications_by_email)
+
+        assert num_emails == 0
+        message = model.Session.query(subscribe_model.OutboxMessage).one()
+        assert message.recipient_email == 'bob@example.com'
+        assert message.subject == mail_recipient.call_args[1]['subject']
+        assert message.status == u'pending'
+
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_login_codes_are_created_in_batches(self, mail_recipient):
+        dataset, activity = factories.DatasetActivity(
+            timestamp=datetime.datetime.now() - datetime.timedelta(minutes=10),
+            return_activity=True
+        )
+        notifications_by_email = {}
+        for i in range(5):
+            email = 'user{}@example.com'.format(i)
+            subscription_activities = {
+                factories.Subscription(dataset_id=dataset['id'], email=email,
+                                       return_object=True):
+                [activity]
+            }
+            notifications_by_email[email] = \
+                dictize_notifications(subscription_activities)
+
+        with mock.patch('ckanext.subscribe.notification.CODE_BATCH_SIZE', 3), \
+                mock.patch('ckanext.subscribe.email_auth.create_codes',
+                           wraps=email_auth.create_codes) as create_codes:
+            send_emails(notifications_by_email)
+
+        assert create_codes.call_count == 2
+        assert mail_recipient.call_count == 5
+        assert model.Session.query(subscribe_model.LoginCode).count() == 5
+        for email in notifications_by_email:
+            login_code = model.Session.query(subscribe_model.LoginCode) \
+                .filter_by(email=email).one()
+            assert email_auth.authenticate_with_code(login_code.code) == email
+
 
 def time_since_emails_last_sent(frequency):
     return (datetime.datetime.now() -
             subscribe_model.Subscribe.get_emails_last_sent(frequency))
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestDictizeNotifications(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_activity_is_dictized_once(self):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+        # {subscription: [activity, ...], ...}
+        subscription_activities = {
+            factories.Subscription(dataset_id=dataset['id'], email=email,
+                                   return_object=True):
+            [activity]
+            for email in ('a@example.com', 'b@example.com')
+        }
+        activity_cache = OrderedDict()
+
+        with mock.patch('ckanext.subscribe.notification.model_dictize'
+                        '.activity_list_dictize',
+                        return_value=[{'id': activity.id}]) \
+                as activity_list_dictize:
+            notifications = dictize_notifications(subscription_activities,
+                                                  activity_cache)
+
+        activity_list_dictize.assert_called_once()
+        assert notifications[0]['activities'][0] is \
+            notifications[1]['activities'][0]
+        assert list(activity_cache.keys()) == [activity.id]
+
+    @mock.patch('ckanext.subscribe.notification.ACTIVITY_CACHE_SIZE', 2)
+    @mock.patch('ckanext.subscribe.notification.compact_activity_dict',
+                side_effect=lambda activity: {'id': activity.id})
+    def test_cache_keeps_the_most_recently_used(self, compact_activity_dict):
+        # compact records, as from activity_projection()
+        activities = dict((id_, mock.Mock(id=id_))
+                          for id_ in ('hot', 'a', 'b'))
+        activity_cache = OrderedDict()
+
+        for id_ in ('hot', 'a', 'hot', 'b', 'hot'):
+            subscribe_notification.dictize_activities(
+                [activities[id_]], {}, activity_cache)
+
+        # 'a' was the least recently used, when 'b' needed the space
+        assert [call[0][0].id for call in
+                compact_activity_dict.call_args_list] == ['hot', 'a', 'b']
+        assert list(activity_cache.keys()) == ['b', 'hot']
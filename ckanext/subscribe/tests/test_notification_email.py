@@ -1,6 +1,8 @@
 # encoding: utf-8
 
+import copy
 import datetime
+from collections import OrderedDict
 
 import pytest
 import mock
@@ -11,6 +13,7 @@ import ckan.tests.factories as ckan_factories
 from ckan.lib.helpers import config
 
 from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import email_templates
 from ckanext.subscribe.notification import dictize_notifications
 from ckanext.subscribe.notification_email import (
     send_notification_email,
@@ -100,6 +103,62 @@ class TestGetNotificationEmailContents(SubscribeBase):
         assert '<a href="{}/dataset/{}">Test Dataset</a>'.format(
             config.get('ckan.site_url'), dataset['name']) in email[2]
 
+    @mock.patch('ckanext.subscribe.email_templates.render',
+                wraps=email_templates.render)
+    def test_shared_body_is_rendered_once(self, render):
+        dataset, activity = factories.DatasetActivity(return_activity=True)
+        notifications = {}
+        for email in ('alice@example.com', 'bob@example.com'):
+            notifications[email] = dictize_notifications({
+                factories.Subscription(dataset_id=dataset['id'], email=email,
+                                       return_object=True):
+                [activity]
+            })
+        body_cache = OrderedDict()
+
+        emails = dict(
+            (email, get_notification_email_contents(
+                code='code-' + email.split('@')[0], email=email,
+                notifications=notifications[email], body_cache=body_cache))
+            for email in notifications)
+
+        notification_templates = [call[0][0] for call in render.call_args_list
+                                  if call[0][0].startswith('notification')]
+        assert sorted(notification_templates) == \
+            ['notification.html', 'notification.txt']
+        for email, (subject, plain_text_body, html_body) in emails.items():
+            code = 'code-' + email.split('@')[0]
+            assert code in plain_text_body
+            assert code in html_body
+            assert '%%subscribe:' not in plain_text_body + html_body
+        assert emails['alice@example.com'][1].split('--')[0] == \
+            emails['bob@example.com'][1].split('--')[0]
+
+    @mock.patch('ckanext.subscribe.notification_email.BODY_CACHE_SIZE', 2)
+    @mock.patch('ckanext.subscribe.notification_email.get_footer_contents',
+                return_value=('footer', 'footer'))
+    @mock.patch('ckanext.subscribe.notification_email.notifications_key',
+                side_effect=lambda notifications: notifications)
+    @mock.patch('ckanext.subscribe.notification_email.'
+                'render_notification_email',
+                side_effect=lambda notifications: (
+                    'Subject', notifications, notifications))
+    def test_hot_body_survives_eviction(self, render_notification_email,
+                                        notifications_key,
+                                        get_footer_contents):
+        body_cache = OrderedDict()
+
+        for notifications in ('hot', 'a', 'hot', 'b', 'hot'):
+            get_notification_email_contents(
+                code='code', email='bob@example.com',
+                notifications=notifications, body_cache=body_cache)
+
+        # 'a' was the least recently used, when 'b' needed the space
+        assert [call[0][0] for call in
+                render_notification_email.call_args_list] == \
+            ['hot', 'a', 'b']
+        assert list(body_cache.keys()) == ['b', 'hot']
+
 
 @pytest.mark.usefixtures('reset_db', 'with_plugins')
 class TestGetNotificationEmailVars(SubscribeBase):
@@ -273,6 +332,14 @@ class TestDatasetLinkFromActivity(object):
         # don't want an exception
         assert not dataset_link_from_activity(CUSTOM_ACTIVITY)
 
+    def test_title_is_escaped(self):
+        activity = copy.deepcopy(CHANGED_PACKAGE_ACTIVITY)
+        activity['data']['package']['title'] = '<b>Stream</b>'
+
+        assert dataset_link_from_activity(activity) == \
+            '<a href="{}/dataset/stream">&lt;b&gt;Stream&lt;/b&gt;</a>'.format(
+                config.get('ckan.site_url'))
+
 
 @pytest.mark.usefixtures('clean_db', 'with_plugins')
 class TestDatasetHrefFromActivity(object):
@@ -0,0 +1,135 @@
+# encoding: utf-8
+
+import datetime
+
+import mock
+import pytest
+
+from ckan.tests import helpers
+from ckan.tests.factories import Dataset, Organization, Group
+from ckan import model
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import notification as subscribe_notification
+from ckanext.subscribe import object_index
+from ckanext.subscribe.model import Frequency
+from ckanext.subscribe.tests import factories
+
+
+def _index_rows():
+    index_table = subscribe_model.subscription_object_index_table
+    return sorted(
+        tuple(row) for row in model.Session.execute(index_table.select()))
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestObjectIndex(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+        subscribe_notification._object_index_complete = False
+
+    def teardown(self):
+        subscribe_notification._config = {}
+        subscribe_notification._object_index_complete = False
+
+    @helpers.change_config('ckanext.subscribe.object_index', 'true')
+    def test_signup_is_indexed(self):
+        org = Organization()
+        dataset = Dataset(owner_org=org['id'])
+
+        subscription = factories.Subscription(organization_id=org['id'])
+
+        assert _index_rows() == sorted([
+            (subscription['id'], org['id']),
+            (subscription['id'], dataset['id'])])
+
+    @helpers.change_config('ckanext.subscribe.object_index', 'true')
+    def test_dataset_added_to_org_and_group(self):
+        org = Organization()
+        group = Group()
+        org_subscription = factories.Subscription(organization_id=org['id'])
+        group_subscription = factories.Subscription(group_id=group['id'])
+
+        dataset = Dataset(owner_org=org['id'], groups=[{'id': group['id']}])
+
+        assert (org_subscription['id'], dataset['id']) in _index_rows()
+        assert (group_subscription['id'], dataset['id']) in _index_rows()
+
+    @helpers.change_config('ckanext.subscribe.object_index', 'true')
+    def test_dataset_moved_out_of_org(self):
+        org = Organization()
+        dataset = Dataset(owner_org=org['id'])
+        subscription = factories.Subscription(organization_id=org['id'])
+
+        helpers.call_action('package_patch', id=dataset['id'], owner_org='')
+
+        assert _index_rows() == [(subscription['id'], org['id'])]
+
+    @helpers.change_config('ckanext.subscribe.object_index', 'true')
+    def test_unsubscribe_removes_rows(self):
+        org = Organization()
+        Dataset(owner_org=org['id'])
+        factories.Subscription(organization_id=org['id'])
+
+        helpers.call_action('subscribe_unsubscribe', email='bob@example.com',
+                            organization_id=org['id'])
+
+        assert _index_rows() == []
+
+    @helpers.change_config('ckanext.subscribe.object_index', 'true')
+    def test_rebuild(self):
+        org = Organization()
+        dataset = Dataset(owner_org=org['id'])
+        subscription = factories.Subscription(organization_id=org['id'])
+        model.Session.execute(
+            subscribe_model.subscription_object_index_table.delete())
+
+        object_index.rebuild()
+
+        assert _index_rows() == sorted([
+            (subscription['id'], org['id']),
+            (subscription['id'], dataset['id'])])
+
+    @helpers.change_config('ckanext.subscribe.object_index', 'true')
+    def test_notifications_use_the_index(self):
+        org = Organization()
+        subscription = factories.Subscription(organization_id=org['id'])
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now())
+        model.Session.commit()
+        dataset = Dataset(owner_org=org['id'])
+
+        notifies = subscribe_notification.get_immediate_notifications()
+
+        assert list(notifies.keys()) == [subscription['email']]
+        assert [a['object_id'] for a in notifies[subscription['email']][0]
+                ['activities']] == [dataset['id']]
+
+    @mock.patch('ckanext.subscribe.notification.log')
+    def test_not_used_until_it_is_built(self, log):
+        # subscribed before the index was enabled, so it isn't in it
+        org = Organization()
+        subscription = factories.Subscription(organization_id=org['id'])
+        subscribe_model.Subscribe.set_emails_last_sent(
+            Frequency.IMMEDIATE.value,
+            datetime.datetime.now())
+        model.Session.commit()
+        dataset = Dataset(owner_org=org['id'])
+
+        with helpers.changed_config('ckanext.subscribe.object_index', 'true'):
+            subscribe_notification._config = {}
+            notifies = subscribe_notification.get_immediate_notifications()
+
+            assert list(notifies.keys()) == [subscription['email']]
+            assert [a['object_id'] for a in notifies[subscription['email']][0]
+                    ['activities']] == [dataset['id']]
+            log.error.assert_called_once()
+            assert 'rebuild-object-index' in log.error.call_args[0][0]
+
+            object_index.rebuild()
+            model.Session.commit()
+            assert subscribe_notification.use_object_index() is True
@@ -0,0 +1,286 @@
+# encoding: utf-8
+
+import datetime
+
+import mock
+import pytest
+
+from ckan.tests import helpers
+from ckan import model
+from ckan.lib.mailer import MailerException
+
+from ckanext.subscribe import outbox
+from ckanext.subscribe.mailer import MailerDeferred
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.model import OutboxMessage
+
+
+def _deliver(email='bob@example.com'):
+    outbox.deliver(recipient_name=email, recipient_email=email,
+                   subject='Subject', body='Body', body_html='<p>Body</p>',
+                   headers={'List-Unsubscribe': '<http://unsubscribe>'})
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestDeliver(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_sends_straight_away_by_default(self, mail_recipient):
+        _deliver()
+
+        mail_recipient.assert_called_once()
+        assert model.Session.query(OutboxMessage).count() == 0
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_queued(self, mail_recipient):
+        _deliver()
+
+        mail_recipient.assert_not_called()
+        message = model.Session.query(OutboxMessage).one()
+        assert message.recipient_email == 'bob@example.com'
+        assert message.headers == {'List-Unsubscribe': '<http://unsubscribe>'}
+        assert message.status == 'pending'
+
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_deferred_is_queued(self, mail_recipient):
+        mail_recipient.side_effect = MailerDeferred('Try again later',
+                                                    retry_after=120)
+
+        _deliver()
+
+        message = model.Session.query(OutboxMessage).one()
+        assert message.status == 'pending'
+        assert message.attempts == 0
+        assert message.last_error == 'Try again later'
+        assert datetime.timedelta(seconds=110) < \
+            message.next_attempt_at - datetime.datetime.utcnow() <= \
+            datetime.timedelta(seconds=120)
+
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_error_is_raised(self, mail_recipient):
+        mail_recipient.side_effect = MailerException('Mailbox unavailable')
+
+        with pytest.raises(MailerException):
+            _deliver()
+
+        assert model.Session.query(OutboxMessage).count() == 0
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestSendPending(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_sent(self, mail_recipient):
+        _deliver()
+
+        assert outbox.send_pending() == (1, 0)
+
+        mail_recipient.assert_called_once_with(
+            recipient_name='bob@example.com',
+            recipient_email='bob@example.com',
+            subject='Subject', body='Body', body_html='<p>Body</p>',
+            headers={'List-Unsubscribe': '<http://unsubscribe>'})
+        message = model.Session.query(OutboxMessage).one()
+        assert message.status == 'sent'
+        assert message.sent
+        assert outbox.send_pending() == (0, 0)
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_failed_is_retried_later(self, mail_recipient):
+        mail_recipient.side_effect = [MailerException('Connection refused'),
+                                      None]
+        _deliver('a@example.com')
+        _deliver('b@example.com')
+
+        assert outbox.send_pending() == (1, 1)
+
+        statuses = dict(
+            (message.recipient_email,
+             (message.status, message.attempts, message.last_error))
+            for message in model.Session.query(OutboxMessage))
+        assert statuses == {
+            'a@example.com': ('pending', 1, 'Connection refused'),
+            'b@example.com': ('sent', 1, None)}
+        # not due yet
+        assert outbox.send_pending() == (0, 0)
+
+        message = model.Session.query(OutboxMessage) \
+            .filter_by(recipient_email='a@example.com').one()
+        assert message.next_attempt_at > datetime.datetime.utcnow()
+        message.next_attempt_at = datetime.datetime.utcnow()
+        model.Session.commit()
+        mail_recipient.side_effect = None
+
+        assert outbox.send_pending() == (1, 0)
+        assert message.status == 'sent'
+        assert message.attempts == 2
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @helpers.change_config('ckanext.subscribe.outbox.max_attempts', '2')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_dead_after_max_attempts(self, mail_recipient):
+        mail_recipient.side_effect = MailerException('Mailbox unavailable')
+        _deliver()
+        message = model.Session.query(OutboxMessage).one()
+        message.attempts = 1
+        model.Session.commit()
+
+        assert outbox.send_pending() == (0, 1)
+
+        assert message.status == 'dead'
+        assert message.attempts == 2
+        assert message.last_error == 'Mailbox unavailable'
+        assert message.next_attempt_at is None
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @helpers.change_config('ckanext.subscribe.outbox.max_attempts', '1')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_deferral_is_not_an_attempt(self, mail_recipient):
+        mail_recipient.side_effect = MailerDeferred('Rate limited',
+                                                    retry_after=300)
+        _deliver()
+
+        assert outbox.send_pending() == (0, 1)
+
+        message = model.Session.query(OutboxMessage).one()
+        assert message.status == 'pending'
+        assert message.attempts == 0
+        assert message.last_error == 'Rate limited'
+        assert message.next_attempt_at > \
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=290)
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_dead_after_being_deferred_too_long(self, mail_recipient):
+        mail_recipient.side_effect = MailerDeferred('Rate limited')
+        _deliver()
+        message = model.Session.query(OutboxMessage).one()
+        message.created = datetime.datetime.utcnow() - \
+            outbox.MAX_DEFERRAL_AGE
+        model.Session.commit()
+
+        assert outbox.send_pending() == (0, 1)
+
+        assert message.status == 'dead'
+        assert message.next_attempt_at is None
+
+
+class TestGetRetryDelay(object):
+
+    def test_doubles(self):
+        assert [outbox.get_retry_delay(attempts).total_seconds()
+                for attempts in (1, 2, 3)] == [60, 120, 240]
+
+    def test_limited(self):
+        assert outbox.get_retry_delay(100) == outbox.MAX_RETRY_DELAY
+
+
+def _old_message(status, days_ago, sent=True):
+    timestamp = datetime.datetime.utcnow() - datetime.timedelta(days=days_ago)
+    message = OutboxMessage(
+        recipient_email=u'{}-{}@example.com'.format(status, days_ago),
+        subject=u'Subject', body=u'Body', status=status, created=timestamp,
+        sent=timestamp if sent else None)
+    model.Session.add(message)
+    model.Session.commit()
+    return message
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestPrune(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        outbox._last_pruned = None
+
+    def teardown(self):
+        outbox._last_pruned = None
+
+    def test_old_sent_and_dead_are_deleted(self):
+        _old_message(u'sent', 8)
+        _old_message(u'dead', 8, sent=False)
+        _old_message(u'sent', 1)
+        _old_message(u'dead', 1, sent=False)
+        _old_message(u'pending', 8, sent=False)
+
+        assert outbox.prune() == 2
+
+        assert sorted(message.recipient_email for message in
+                      model.Session.query(OutboxMessage)) == \
+            ['dead-1@example.com', 'pending-8@example.com',
+             'sent-1@example.com']
+
+    @helpers.change_config('ckanext.subscribe.outbox.retention', '30')
+    def test_retention_is_configurable(self):
+        _old_message(u'sent', 8)
+
+        assert outbox.prune() == 0
+
+    def test_send_pending_prunes_now_and_then(self):
+        _old_message(u'sent', 8)
+        outbox.send_pending()
+        assert model.Session.query(OutboxMessage).count() == 0
+
+        _old_message(u'sent', 8)
+        outbox.send_pending()
+        # not again until PRUNE_INTERVAL has passed
+        assert model.Session.query(OutboxMessage).count() == 1
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestClaimBatch(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    def test_workers_get_different_emails(self):
+        for i in range(3):
+            _deliver('user{}@example.com'.format(i))
+
+        batch1 = outbox.claim_batch('worker1', batch_size=2)
+        batch2 = outbox.claim_batch('worker2', batch_size=2)
+
+        assert [message.recipient_email for message in batch1] == \
+            ['user0@example.com', 'user1@example.com']
+        assert [message.recipient_email for message in batch2] == \
+            ['user2@example.com']
+        assert outbox.claim_batch('worker3') == []
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_claimed_emails_are_not_sent_by_another_worker(
+            self, mail_recipient):
+        _deliver()
+        outbox.claim_batch('worker1')
+
+        assert outbox.send_pending('worker2') == (0, 0)
+        mail_recipient.assert_not_called()
+
+    @helpers.change_config('ckanext.subscribe.outbox', 'true')
+    @mock.patch('ckanext.subscribe.mailer.mail_recipient')
+    def test_expired_claim_is_taken_over(self, mail_recipient):
+        # i.e. worker1 died
+        _deliver()
+        [message] = outbox.claim_batch('worker1')
+        message.lease_expires = datetime.datetime.utcnow()
+        model.Session.commit()
+
+        assert outbox.send_pending('worker2') == (1, 0)
+
+        message = model.Session.query(OutboxMessage).one()
+        assert message.status == 'sent'
+        assert message.claimed_by is None
@@ -0,0 +1,97 @@
+# encoding: utf-8
+
+import mock
+import pytest
+
+from ckan.tests import helpers
+from ckan.tests.factories import Dataset, Organization
+
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe import notification as subscribe_notification
+from ckanext.subscribe.model import Frequency
+from ckanext.subscribe.tests import factories
+
+
+def _pending_object_ids():
+    return sorted(object_id for _, object_id in
+                  subscribe_notification.get_pending_notifications())
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestPendingNotifications(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def teardown(self):
+        subscribe_notification._config = {}
+
+    @helpers.change_config('ckanext.subscribe.push_notifications', 'true')
+    def test_dataset_with_subscriber(self):
+        dataset = Dataset()
+        factories.Subscription(dataset_id=dataset['id'])
+
+        helpers.call_action('package_patch', id=dataset['id'],
+                            notes='changed')
+
+        assert _pending_object_ids() == [dataset['id']]
+
+    @helpers.change_config('ckanext.subscribe.push_notifications', 'true')
+    def test_dataset_in_subscribed_org(self):
+        org = Organization()
+        dataset = Dataset(owner_org=org['id'])
+        factories.Subscription(organization_id=org['id'])
+
+        helpers.call_action('package_patch', id=dataset['id'],
+                            notes='changed')
+
+        assert _pending_object_ids() == [dataset['id']]
+
+    @helpers.change_config('ckanext.subscribe.push_notifications', 'true')
+    def test_dataset_without_subscribers(self):
+        dataset = Dataset()
+        factories.Subscription(dataset_id=dataset['id'], frequency='daily')
+
+        helpers.call_action('package_patch', id=dataset['id'],
+                            notes='changed')
+
+        assert _pending_object_ids() == []
+
+    @helpers.change_config('ckanext.subscribe.push_notifications', 'true')
+    def test_org_with_subscriber(self):
+        org = Organization()
+        factories.Subscription(organization_id=org['id'])
+
+        helpers.call_action('organization_patch', id=org['id'],
+                            description='changed')
+
+        assert _pending_object_ids() == [org['id']]
+
+    def test_not_enabled(self):
+        dataset = Dataset()
+        factories.Subscription(dataset_id=dataset['id'])
+
+        helpers.call_action('package_patch', id=dataset['id'],
+                            notes='changed')
+
+        assert _pending_object_ids() == []
+
+    @helpers.change_config('ckanext.subscribe.push_notifications', 'true')
+    @mock.patch('ckanext.subscribe.notification_email.send_notification_email')
+    def test_immediate_notifications_are_for_pending_objects(
+            self, send_notification_email):
+        dataset1 = factories.DatasetActivity()
+        dataset2 = factories.DatasetActivity()
+        factories.Subscription(dataset_id=dataset1['id'], email='a@example.com')
+        factories.Subscription(dataset_id=dataset2['id'], email='b@example.com')
+        helpers.call_action('package_patch', id=dataset1['id'],
+                            notes='changed')
+
+        subscribe_notification.send_notifications([Frequency.IMMEDIATE])
+
+        emails = [call[0][1]
+                  for call in send_notification_email.call_args_list]
+        assert emails == ['a@example.com']
+        assert _pending_object_ids() == []
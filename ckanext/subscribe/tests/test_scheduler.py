@@ -0,0 +1,160 @@
+# encoding: utf-8
+
+import datetime
+
+import mock
+import pytest
+
+from ckan.tests import helpers
+from ckan import model
+
+from ckanext.subscribe import scheduler
+from ckanext.subscribe import notification as subscribe_notification
+from ckanext.subscribe import model as subscribe_model
+from ckanext.subscribe.model import Frequency, OutboxMessage
+from ckanext.subscribe.tests import factories
+
+
+# a time that is hours away from the daily and weekly notifications being due
+IDLE_TIME = datetime.datetime(2020, 1, 1, 12, 0)
+
+
+def _mark_all_sent(emails_last_sent):
+    for frequency in Frequency:
+        subscribe_model.Subscribe.set_emails_last_sent(
+            frequency=frequency.value, emails_last_sent=emails_last_sent)
+    model.Session.commit()
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestRunOnce(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+        subscribe_notification._config = {}
+
+    def teardown(self):
+        subscribe_notification._config = {}
+
+    @mock.patch('ckanext.subscribe.notification.send_notifications')
+    def test_nothing_due(self, send_notifications):
+        _mark_all_sent(datetime.datetime.now())
+        scheduler_ = scheduler.Scheduler()
+
+        scheduler_.run_once()
+
+        send_notifications.assert_not_called()
+        assert set(scheduler_.deadlines.keys()) == \
+            set([Frequency.DAILY, Frequency.WEEKLY])
+
+    @mock.patch('ckanext.subscribe.notification.send_notifications')
+    def test_new_activity(self, send_notifications):
+        _mark_all_sent(datetime.datetime.now() - datetime.timedelta(minutes=1))
+        factories.DatasetActivity()
+
+        scheduler.Scheduler().run_once()
+
+        send_notifications.assert_called_once_with([Frequency.IMMEDIATE],
+                                                   leadership=None)
+
+    @mock.patch('ckanext.subscribe.notification.send_notifications')
+    def test_daily_due(self, send_notifications):
+        _mark_all_sent(datetime.datetime.now())
+        scheduler_ = scheduler.Scheduler()
+        scheduler_.run_once()
+        now = scheduler_.deadlines[Frequency.DAILY]
+
+        scheduler_.run_once(now)
+
+        send_notifications.assert_called_once_with([Frequency.DAILY],
+                                                   leadership=None)
+        assert Frequency.DAILY not in scheduler_.deadlines
+
+    @mock.patch('ckanext.subscribe.notification.send_notifications')
+    def test_backs_off_when_idle(self, send_notifications):
+        _mark_all_sent(IDLE_TIME)
+        scheduler_ = scheduler.Scheduler()
+
+        waits = [scheduler_.run_once(IDLE_TIME) for _ in range(3)]
+
+        assert waits == [20, 40, 60]
+
+    @helpers.change_config('ckanext.subscribe.scheduler.max_poll_interval',
+                           '30')
+    @mock.patch('ckanext.subscribe.notification.send_notifications')
+    def test_wait_is_limited(self, send_notifications):
+        _mark_all_sent(IDLE_TIME)
+        scheduler_ = scheduler.Scheduler()
+
+        waits = [scheduler_.run_once(IDLE_TIME) for _ in range(3)]
+
+        assert waits == [20, 30, 30]
+
+    @helpers.change_config('ckanext.subscribe.push_notifications', 'true')
+    @mock.patch('ckanext.subscribe.notification.send_notifications')
+    def test_no_back_off_with_push_notifications(self, send_notifications):
+        _mark_all_sent(IDLE_TIME)
+        scheduler_ = scheduler.Scheduler()
+
+        waits = [scheduler_.run_once(IDLE_TIME) for _ in range(3)]
+
+        assert waits == [10, 10, 10]
+
+    @mock.patch('ckanext.subscribe.notification.retry_failed_emails')
+    @mock.patch('ckanext.subscribe.notification.send_notifications')
+    def test_failed_emails_retried_only_when_due(self, send_notifications,
+                                                 retry_failed_emails):
+        _mark_all_sent(IDLE_TIME)
+        scheduler_ = scheduler.Scheduler()
+
+        scheduler_.run_once(IDLE_TIME)
+        retry_failed_emails.assert_not_called()
+
+        # an email that failed, and is now due a retry
+        model.Session.add(OutboxMessage(
+            recipient_email=u'bob@example.com', subject=u'Subject',
+            body=u'Body', attempts=1,
+            next_attempt_at=datetime.datetime.utcnow() -
+            datetime.timedelta(minutes=1)))
+        model.Session.commit()
+
+        scheduler_.run_once(IDLE_TIME)
+        retry_failed_emails.assert_called_once()
+
+
+class TestNextDeadline(object):
+
+    @mock.patch('ckanext.subscribe.notification.'
+                'is_it_time_to_send_daily_notifications', return_value=True)
+    def test_overdue(self, _):
+        now = datetime.datetime(2020, 1, 1, 12, 0)
+        assert scheduler.next_deadline(Frequency.DAILY, now) == now
+
+    @mock.patch('ckanext.subscribe.notification.'
+                'is_it_time_to_send_daily_notifications', return_value=False)
+    def test_daily(self, _):
+        now = datetime.datetime(2020, 1, 1, 12, 0)
+        assert scheduler.next_deadline(Frequency.DAILY, now) == \
+            datetime.datetime(2020, 1, 2, 9, 0)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+class TestNextDeadlineFromEmailsLastSent(object):
+
+    def setup(self):
+        helpers.reset_db()
+        subscribe_model.setup()
+
+    def test_due_later(self):
+        _mark_all_sent(datetime.datetime(2020, 1, 1, 9, 0))
+        now = datetime.datetime(2020, 1, 1, 12, 0)
+
+        assert scheduler.next_deadline(Frequency.DAILY, now) == \
+            datetime.datetime(2020, 1, 2, 9, 0)
+
+    def test_overdue(self):
+        _mark_all_sent(datetime.datetime(2019, 12, 31, 9, 0))
+        now = datetime.datetime(2020, 1, 1, 12, 0)
+
+        assert scheduler.next_deadline(Frequency.DAILY, now) == now